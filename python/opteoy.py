@@ -151,22 +151,15 @@ class OptEOY:
                 # print('len(spots) {0:d}, len(opts) = {1:d}'.format(
                 #     len(spots), len(opts)))
 
-        spots_upload_file = '{0:s}/spots.txt'.format(self.upload_dir)
-        opts_upload_file = '{0:s}/opts.txt'.format(self.upload_dir)
-        with open(spots_upload_file, 'w') as spots_file:
-            for s in spots:
-                spots_file.write('{0:s}\t{1:s}\t{2:d}\n'.
-                                 format(s[0], s[1], s[2]))
-        with open(opts_upload_file, 'w') as opts_file:
-            for o in opts:
-                opts_file.write('{0:s}\t{1:s}\t{2:s}\t{3:d}\t{4:s}\t{5:d}\t'
-                                '{6:d}\t{7:d}\t0\n'.format(o[0], o[1], o[2],
-                                                           o[3], o[4], o[5],
-                                                           o[6], o[7]))
         if self.upload_spots:
-            stxdb.db_upload_file(spots_upload_file, self.spot_tbl, '\t')
+            stxdb.db_upload_lines(
+                ('{0:s}\t{1:s}\t{2:d}\n'.format(s[0], s[1], s[2])
+                 for s in spots), self.spot_tbl, '\t')
         if self.upload_options:
-            stxdb.db_upload_file(opts_upload_file, self.opt_tbl, '\t')
+            stxdb.db_upload_lines(
+                ('{0:s}\t{1:s}\t{2:s}\t{3:d}\t{4:s}\t{5:d}\t{6:d}\t{7:d}\t'
+                 '0\n'.format(o[0], o[1], o[2], o[3], o[4], o[5], o[6], o[7])
+                 for o in opts), self.opt_tbl, '\t')
         d_spots, d_opts = len(spots), len(opts)
         print('{0:s}\t{1:s}\t{2:5d}\t{3:6d}'.format
               (stxcal.print_current_time(), dt, d_spots, d_opts))
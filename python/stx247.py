@@ -39,6 +39,9 @@ class StxAnalyzer:
         self.indicator_names = indicator_names
         self.indicator_tenors = indicator_tenors
         self.num_display_days = num_display_days        
+        # JL setups, start date and time series of the report stocks
+        # (see preload_report_data)
+        self.preloaded = {}
         self.report_style = '''
 <style>
 body {
@@ -210,15 +213,22 @@ img {
         return trend_lines
 
     def get_jl_setups_for_analysis(self, stk, crt_date, num_jl_days):
+        jl_setup_df = self.get_all_jl_setups_for_analysis(
+            [stk], crt_date, num_jl_days)
+        logging.debug(f'{stk} has {len(jl_setup_df)} JL setups')
+        return jl_setup_df
+
+    # The JL setups of all the stocks in stks, read with one query
+    def get_all_jl_setups_for_analysis(self, stks, crt_date, num_jl_days):
         s_date = stxcal.move_busdays(crt_date, -num_jl_days)
         q = sql.Composed([
             sql.SQL("SELECT * FROM time_setups WHERE dt BETWEEN "),
             sql.Literal(s_date),
             sql.SQL(" AND "),
             sql.Literal(crt_date),
-            sql.SQL(" AND stk="),
-            sql.Literal(stk),
-            sql.SQL(" AND ((setup="), sql.Literal("JL_SR"),
+            sql.SQL(" AND stk IN ("),
+            sql.SQL(', ').join([sql.Literal(stk) for stk in stks]),
+            sql.SQL(") AND ((setup="), sql.Literal("JL_SR"),
             sql.SQL(" AND (info->>'num_sr')::int > "), sql.Literal(1),
             sql.SQL(")"),
             sql.SQL(" OR (setup IN ("),
@@ -230,9 +240,7 @@ img {
             sql.SQL('))')
         ])
         logging.debug(f'jl stps sql = {q.as_string(stxdb.db_get_cnx())}')
-        jl_setup_df = pd.read_sql(q, stxdb.db_get_cnx())
-        logging.debug(f'{stk} has {len(jl_setup_df)} JL setups')
-        return jl_setup_df
+        return pd.read_sql(q, stxdb.db_get_cnx())
 
     def find_start_date(self, jl_setup_df, crt_date):
         start_date = crt_date
@@ -258,8 +266,30 @@ img {
             start_date = stxcal.move_busdays(crt_date, -220)
         return start_date
 
-    def get_stk_ts(self, stk, start_date, crt_date):
-        ts = StxTS(stk, start_date, crt_date)
+    # Read the JL setups of all the stocks in a report with one query,
+    # and load all their time series with two queries
+    # (StxTS.bulk_load), instead of a time_setups, an eods and a
+    # dividends query for each stock in setup_report
+    def preload_report_data(self, stks, crt_date, num_jl_days=20):
+        if not stks:
+            self.preloaded = {}
+            return
+        jl_setup_df = self.get_all_jl_setups_for_analysis(stks, crt_date,
+                                                          num_jl_days)
+        stk_setups = {stk: df.reset_index(drop=True)
+                      for stk, df in jl_setup_df.groupby('stk')}
+        jl_setups, start_dates = {}, {}
+        for stk in stks:
+            jl_setups[stk] = stk_setups.get(
+                stk, jl_setup_df.iloc[:0].reset_index(drop=True))
+            start_dates[stk] = self.find_start_date(jl_setups[stk], crt_date)
+        ts_dict = StxTS.bulk_load(stks, start_dates, crt_date)
+        self.preloaded = {stk: (jl_setups[stk], start_dates[stk],
+                                ts_dict.get(stk)) for stk in stks}
+
+    def get_stk_ts(self, stk, start_date, crt_date, ts=None):
+        if ts is None:
+            ts = StxTS(stk, start_date, crt_date)
         try:
             ts.mpf_eod(crt_date)
         except RuntimeError as re:
@@ -324,11 +354,15 @@ img {
                      num_jl_days=20):
         res = []
         stk = row['stk']
-        jl_setup_df = self.get_jl_setups_for_analysis(stk, crt_date,
-                                                      num_jl_days)
-        start_date = self.find_start_date(jl_setup_df, crt_date)
+        ts = None
+        if stk in self.preloaded:
+            jl_setup_df, start_date, ts = self.preloaded.pop(stk)
+        else:
+            jl_setup_df = self.get_jl_setups_for_analysis(stk, crt_date,
+                                                          num_jl_days)
+            start_date = self.find_start_date(jl_setup_df, crt_date)
         logging.debug(f'First date for {stk} is {start_date}')
-        ts = self.get_stk_ts(stk, start_date, crt_date)
+        ts = self.get_stk_ts(stk, start_date, crt_date, ts)
         if ts is None:
             return []
         avg_volume, avg_rg = self.get_avg_stats(ts)
@@ -399,6 +433,7 @@ img {
         res = []
         if triggered:
             res.extend(self.add_timeline_report(setup_df))
+        self.preload_report_data(setup_df['stk'].unique().tolist(), crt_date)
         up_setup_df = setup_df.query("direction=='U'").copy()
         up_setup_df.sort_values(by=['value'], ascending=False, inplace=True)
         down_setup_df = setup_df.query("direction=='D'").copy()
@@ -416,6 +451,7 @@ img {
         jl_s_date = stxcal.move_busdays(crt_date, -350)
         res = []
         res.append('<h3>Index report</h3>')
+        self.preload_report_data(['^GSPC', '^IXIC', '^DJI'], crt_date)
         for index in ['^GSPC', '^IXIC', '^DJI']:
             row = pd.Series({
                 'stk': index,
@@ -429,23 +465,19 @@ img {
             res.extend(self.setup_report(row, crt_date, display_start_date,
                                          is_index=True))
             try:
-                jl_res = StxJL.jl_report(index, jl_s_date, crt_date, 1.0)
+                jl_res = StxJL.jl_report(index, jl_s_date, crt_date,
+                                         [1.0, 2.0])
                 res.append(jl_res)
             except:
-                logging.error(f'{index} JL(1.0) calc failed')
+                logging.error(f'{index} JL calc failed')
                 tb.print_exc()
-                try:
-                    jl_res = StxJL.jl_report(index, jl_s_date, crt_date, 2.0)
-                    res.append(jl_res)
-                except:
-                    logging.error(f'{index} JL(2.0) calc failed')
-                    tb.print_exc()
         return res
 
     def get_report(self, crt_date, setup_df, display_start_date):
         s_date = stxcal.move_busdays(crt_date, -50)
         logging.info(f'setup_df has {len(setup_df)} rows')
         res = []
+        self.preload_report_data(setup_df['stk'].unique().tolist(), crt_date)
         up_setup_df = setup_df.query("direction=='U'").copy()
         up_setup_df.sort_values(by=['value'], ascending=False, inplace=True)
         down_setup_df = setup_df.query("direction=='D'").copy()
@@ -698,6 +730,8 @@ if __name__ == '__main__':
                         help='Start date for batch runs')
     parser.add_argument('-z', '--enddate', type=str,
                         help='End date for batch runs')
+    parser.add_argument('--slow_query_ms', type=float, default=1000,
+                        help='Log DB queries slower than this (milliseconds)')
     args = parser.parse_args()
     logging.basicConfig(
         format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] - '
@@ -705,6 +739,7 @@ if __name__ == '__main__':
         datefmt='%Y-%m-%d %H:%M:%S',
         level=logging.INFO
     )
+    stxdb.db_enable_profiling(slow_query_ms=args.slow_query_ms)
     analysis_type = 'Analysis'
     eod = False
     if args.cron:
@@ -751,3 +786,4 @@ if __name__ == '__main__':
         if pdf_report is None:
             logging.error(f'No report was generated for {crt_date}')
         stx_ana.update_local_directory(crt_date)
+    stxdb.db_dump_query_stats()
@@ -1,16 +1,42 @@
+import argparse
+import functools
+import hashlib
 import numpy as np
+import os
 import pandas as pd
 import pytz
 import stxdb
 import sys
+import time
 
 from datetime import datetime, timedelta
 from dateutil import rrule
 
 this = sys.modules[__name__]
 this.cal = None
+# on-disk cache of the holiday list (see get_cal)
+this.cal_cache_file = os.getenv(
+    'STX_CAL_CACHE', os.path.join(os.path.expanduser('~'), '.stx',
+                                  'stxcal.npz'))
+# dense business day index (see get_busday_index)
+this.bd_start = np.datetime64('1900-01-01')
+this.bd_start_ix = int(this.bd_start.astype(np.int64))  # days since epoch
+this.bd_end = np.datetime64('2100-12-31')
+this.bd_cum = None  # bd_cum[i]: number of business days before day i
+this.bd_isb = None  # bd_isb[i]: True if day i is a business day
+this.bd_days = None  # bd_days[k]: business day with ordinal k
+# monthly expiry table (see get_expiry_table)
+this.exp_months = None  # exp_months[i]: month (datetime64[M])
+this.exp_dates = None  # exp_dates[i]: expiry date for exp_months[i]
+this.exp_ords = None  # exp_ords[i]: ordinal of the last trading day
 epoch = datetime.utcfromtimestamp(0)
 
+# The holiday list is expensive to generate from the rrules, so it is
+# saved in cal_cache_file, together with the start and end dates and a
+# hash of the rules.  The cache is reused as long as the rules did not
+# change and it covers the requested date range.  By default, the
+# calendar ends one year from now, rounded up to the end of that year,
+# so the cache is only rebuilt once a year.
 def get_cal(start=None, end=None):
     if this.cal is None:
         if start is None:
@@ -19,512 +45,675 @@ def get_cal(start=None, end=None):
         if end is None:
             end = datetime.now().date()
             end += timedelta(weeks=52)
+            end = end.replace(month=12, day=31)
         end = pd.Timestamp(end, tz='UTC')
-        print('Initializing calendar between {0:s} and {1:s}'.
-              format(str(start.date()), str(end.date())))
-        non_trading_rules = []
-        new_years = rrule.rrule(
-            rrule.MONTHLY,
-            byyearday=1,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(new_years)
-
-        new_years_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            byyearday=2,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(new_years_sunday)
-
-        mlk_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=1,
-            byweekday=rrule.MO,
-            bysetpos=3,
-            cache=True,
-            dtstart=datetime(1998, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(mlk_day)
-
-        lincoln_birthday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=12,
-            cache=True,
-            dtstart=start,
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(lincoln_birthday)
-
-        lincoln_birthday_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=13,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(lincoln_birthday_sunday)
-
-        lincoln_birthday_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=11,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=start,
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(lincoln_birthday_saturday)
-
-        washington_birthday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=22,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(washington_birthday)
-
-        washington_birthday_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=23,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(washington_birthday_sunday)
-
-        washington_birthday_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            bymonthday=21,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(washington_birthday_saturday)
-
-        presidents_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=2,
-            byweekday=rrule.MO,
-            bysetpos=3,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(presidents_day)
-
-        national_banking_holiday = rrule.rrule(
-            rrule.DAILY,
-            count=6,
-            byweekday=(rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR),
-            cache=True,
-            dtstart=datetime(1933, 3, 6, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(national_banking_holiday)
-
-        good_friday_0 = rrule.rrule(
-            rrule.DAILY,
-            byeaster=-2,
-            cache=True,
-            dtstart=start,
-            until=datetime(1906, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(good_friday_0)
-
-        good_friday = rrule.rrule(
-            rrule.DAILY,
-            byeaster=-2,
-            cache=True,
-            dtstart=datetime(1908, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(good_friday)
-
-        memorial_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=5,
-            bymonthday=30,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(memorial_day)
-
-        memorial_day_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=5,
-            bymonthday=31,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(memorial_day_sunday)
-
-        memorial_day_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=5,
-            bymonthday=29,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=start,
-            until=datetime(1971, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(memorial_day_saturday)
-
-        memorial_day_new = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=5,
-            byweekday=rrule.MO,
-            bysetpos=-1,
-            cache=True,
-            dtstart=datetime(1971, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(memorial_day_new)
-
-        flag_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=14,
-            cache=True,
-            dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(flag_day)
-
-        flag_day_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=15,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(flag_day_sunday)
-
-        flag_day_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=13,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(flag_day_saturday)
-
-        juneteenth = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=19,
-            cache=True,
-            dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(juneteenth)
-
-        juneteenth_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=20,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(juneteenth_sunday)
-
-        juneteenth_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=6,
-            bymonthday=18,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
-            until=end
-        )
-        non_trading_rules.append(juneteenth_saturday)
-        
-        july_4th = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=7,
-            bymonthday=4,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(july_4th)
-
-        july_4th_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=7,
-            bymonthday=5,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(july_4th_sunday)
-
-        july_4th_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=7,
-            bymonthday=3,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(july_4th_saturday)
-
-        labor_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=9,
-            byweekday=rrule.MO,
-            bysetpos=1,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(labor_day)
-
-        columbus_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=10,
-            bymonthday=12,
-            cache=True,
-            dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(columbus_day)
-
-        columbus_day_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=10,
-            bymonthday=13,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(columbus_day_sunday)
-
-        columbus_day_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=10,
-            bymonthday=11,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(columbus_day_saturday)
-
-        election_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=11,
-            bymonthday=(2, 3, 4, 5, 6, 7, 8),
-            byweekday=rrule.TU,
-            cache=True,
-            dtstart=start,
-            until=datetime(1969, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(election_day)
-
-        pres_election_day = rrule.rrule(
-            rrule.YEARLY,
-            interval=4,
-            bymonth=11,
-            bymonthday=(2, 3, 4, 5, 6, 7, 8),
-            byweekday=rrule.TU,
-            cache=True,
-            dtstart=datetime(1972, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1981, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(pres_election_day)
-
-        veterans_day = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=11,
-            bymonthday=11,
-            cache=True,
-            dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(veterans_day)
-
-        veterans_day_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=11,
-            bymonthday=12,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(veterans_day_sunday)
-
-        veterans_day_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=11,
-            bymonthday=10,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
-            until=datetime(1954, 1, 1, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(veterans_day_saturday)
-
-        thanksgiving = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=11,
-            byweekday=rrule.TH,
-            bysetpos=4,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(thanksgiving)
-
-        christmas = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=12,
-            bymonthday=25,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(christmas)
-
-        christmas_sunday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=12,
-            bymonthday=26,
-            byweekday=rrule.MO,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(christmas_sunday)
-
-        # If Christmas is a Saturday then 24th, a Friday is observed.
-        christmas_saturday = rrule.rrule(
-            rrule.MONTHLY,
-            bymonth=12,
-            bymonthday=24,
-            byweekday=rrule.FR,
-            cache=True,
-            dtstart=start,
-            until=end
-        )
-        non_trading_rules.append(christmas_saturday)
-
-        paper_crisis = rrule.rrule(
-            rrule.WEEKLY,
-            count=29,
-            cache=True,
-            dtstart=datetime(1968, 6, 12, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(paper_crisis)
-
-        world_war_one = rrule.rrule(
-            rrule.DAILY,
-            count=96,
-            byweekday=(rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR),
-            cache=True,
-            dtstart=datetime(1914, 7, 31, tzinfo=pytz.utc)
-        )
-        non_trading_rules.append(world_war_one)
-
-        non_trading_ruleset = rrule.rruleset()
-        for rule in non_trading_rules:
-            non_trading_ruleset.rrule(rule)
-
-        non_trading_days = non_trading_ruleset.between(start, end, inc=True)
-        hols = []
-        for non_trading_day in non_trading_days:
-            if non_trading_day.weekday() < 5:
-                hols.append(str(non_trading_day.date()))
-
-        hols.append('1901-09-19')  # PresidentialFuneral-WilliamMcKinley
-        hols.append('1901-07-05')  # DayAfterIndependenceDay
-        hols.append('1903-04-22')  # NewNYSEBuildingOpened
-        hols.append('1917-06-05')  # DraftRegistrationDay
-        hols.append('1918-01-28')  # HeatlessDay
-        hols.append('1918-02-04')  # HeatlessDay
-        hols.append('1918-02-11')  # HeatlessDay
-        hols.append('1918-09-12')  # DraftRegistrationDay
-        hols.append('1918-11-11')  # VeteransDay
-        hols.append('1919-03-25')  # HomecomingOf27thDivision
-        hols.append('1919-05-06')  # Parade-77thDivision
-        hols.append('1919-09-10')  # ReturnOfGeneralJohnPershing
-        hols.append('1921-11-11')  # VeteransDay
-        hols.append('1923-08-03')  # PresidentialDeath-WarrenHarding
-        hols.append('1923-08-10')  # PresidentialFuneral-WarrenHarding
-        hols.append('1927-06-13')  # Parade-CharlesLindbergh
-        hols.append('1929-11-01')  # ClericalBacklogRelief
-        hols.append('1945-08-15')  # VictoryOverJapanDay
-        hols.append('1945-08-16')  # VictoryOverJapanDay
-        hols.append('1945-12-24')  # Christmas Eve
-        hols.append('1950-12-12')  # Saturdayurday-Before-ChristmasEve
-        hols.append('1956-12-24')  # Christmas Eve
-        hols.append('1961-05-29')  # DayBeforeDecorationDay
-        hols.append('1963-11-25')  # PresidentialFuneral-JohnKennedy
-        hols.append('1968-02-12')  # LincolnsBirthday
-        hols.append('1968-04-09')  # DayOfMourning-MartinLutherKing
-        hols.append('1968-07-05')  # DayAfterIndependenceDay
-        hols.append('1969-02-10')  # Weather-Snow
-        hols.append('1969-03-31')  # PresidentialFuneral-DwightEisenhower
-        hols.append('1969-07-21')  # FirstLunarLanding
-        hols.append('1972-12-28')  # PresidentialFuneral-HarryTruman
-        hols.append('1973-01-25')  # PresidentialFuneral-LyndonJohnson
-        hols.append('1977-07-14')  # NewYorkCityBlackout
-        hols.append('1985-09-27')  # Weather-HurricaneGloria
-        hols.append('1994-04-27')  # PresidentialFuneral-RichardNixon
-        hols.append('2001-09-11')  # September 11, 2001
-        hols.append('2001-09-12')  # September 11, 2001
-        hols.append('2001-09-13')  # September 11, 2001
-        hols.append('2001-09-14')  # September 11, 2001
-        hols.append('2004-06-11')  # Reagan's funeral
-        hols.append('2007-01-02')  # Ford's funeral
-        hols.append('2012-10-29')  # Frankenstorm
-        hols.append('2012-10-30')  # Frankenstorm
-        hols.append('2018-12-05')  # George H.W. Bush funeral
-        hols.append('2025-01-09')  # Carter's funeral
-        hols.sort()
+        hols = _load_cal_cache(start, end)
+        if hols is None:
+            print('Initializing calendar between {0:s} and {1:s}'.
+                  format(str(start.date()), str(end.date())))
+            hols = gen_holidays(start, end)
+            _save_cal_cache(start, end, hols)
         this.cal = np.busdaycalendar(holidays=hols)
     return this.cal
 
 
+# Fingerprint of the holiday rules, taken from the compiled code of
+# gen_holidays (cheaper than hashing its source at every startup)
+def cal_rules_hash():
+    code = gen_holidays.__code__
+    h = hashlib.sha1(code.co_code)
+    h.update(repr((code.co_consts, code.co_names)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _load_cal_cache(start, end):
+    if not os.path.isfile(this.cal_cache_file):
+        return None
+    try:
+        with np.load(this.cal_cache_file) as npz:
+            if str(npz['rules_hash']) != cal_rules_hash() or \
+               str(npz['start']) != str(start.date()) or \
+               str(npz['end']) < str(end.date()):
+                return None
+            return npz['holidays']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_cal_cache(start, end, hols):
+    tmp_file = f'{this.cal_cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(this.cal_cache_file), exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, rules_hash=cal_rules_hash(), start=str(start.date()),
+                     end=str(end.date()),
+                     holidays=np.array(hols, dtype='datetime64[D]'))
+        os.replace(tmp_file, this.cal_cache_file)
+    except OSError as ex:
+        print(f'Failed to save calendar cache {this.cal_cache_file}: {ex}')
+
+
+# Generate the sorted list of NYSE holidays between start and end
+def gen_holidays(start, end):
+    non_trading_rules = []
+    new_years = rrule.rrule(
+        rrule.MONTHLY,
+        byyearday=1,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(new_years)
+
+    new_years_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        byyearday=2,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(new_years_sunday)
+
+    mlk_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=1,
+        byweekday=rrule.MO,
+        bysetpos=3,
+        cache=True,
+        dtstart=datetime(1998, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(mlk_day)
+
+    lincoln_birthday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=12,
+        cache=True,
+        dtstart=start,
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(lincoln_birthday)
+
+    lincoln_birthday_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=13,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(lincoln_birthday_sunday)
+
+    lincoln_birthday_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=11,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=start,
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(lincoln_birthday_saturday)
+
+    washington_birthday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=22,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(washington_birthday)
+
+    washington_birthday_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=23,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(washington_birthday_sunday)
+
+    washington_birthday_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        bymonthday=21,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(washington_birthday_saturday)
+
+    presidents_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=2,
+        byweekday=rrule.MO,
+        bysetpos=3,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(presidents_day)
+
+    national_banking_holiday = rrule.rrule(
+        rrule.DAILY,
+        count=6,
+        byweekday=(rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR),
+        cache=True,
+        dtstart=datetime(1933, 3, 6, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(national_banking_holiday)
+
+    good_friday_0 = rrule.rrule(
+        rrule.DAILY,
+        byeaster=-2,
+        cache=True,
+        dtstart=start,
+        until=datetime(1906, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(good_friday_0)
+
+    good_friday = rrule.rrule(
+        rrule.DAILY,
+        byeaster=-2,
+        cache=True,
+        dtstart=datetime(1908, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(good_friday)
+
+    memorial_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=5,
+        bymonthday=30,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(memorial_day)
+
+    memorial_day_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=5,
+        bymonthday=31,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(memorial_day_sunday)
+
+    memorial_day_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=5,
+        bymonthday=29,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=start,
+        until=datetime(1971, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(memorial_day_saturday)
+
+    memorial_day_new = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=5,
+        byweekday=rrule.MO,
+        bysetpos=-1,
+        cache=True,
+        dtstart=datetime(1971, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(memorial_day_new)
+
+    flag_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=14,
+        cache=True,
+        dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(flag_day)
+
+    flag_day_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=15,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(flag_day_sunday)
+
+    flag_day_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=13,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=datetime(1916, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(flag_day_saturday)
+
+    juneteenth = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=19,
+        cache=True,
+        dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(juneteenth)
+
+    juneteenth_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=20,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(juneteenth_sunday)
+
+    juneteenth_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=6,
+        bymonthday=18,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=datetime(2022, 1, 1, tzinfo=pytz.utc),
+        until=end
+    )
+    non_trading_rules.append(juneteenth_saturday)
+    
+    july_4th = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=7,
+        bymonthday=4,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(july_4th)
+
+    july_4th_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=7,
+        bymonthday=5,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(july_4th_sunday)
+
+    july_4th_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=7,
+        bymonthday=3,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(july_4th_saturday)
+
+    labor_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=9,
+        byweekday=rrule.MO,
+        bysetpos=1,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(labor_day)
+
+    columbus_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=10,
+        bymonthday=12,
+        cache=True,
+        dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(columbus_day)
+
+    columbus_day_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=10,
+        bymonthday=13,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(columbus_day_sunday)
+
+    columbus_day_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=10,
+        bymonthday=11,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=datetime(1909, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(columbus_day_saturday)
+
+    election_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=11,
+        bymonthday=(2, 3, 4, 5, 6, 7, 8),
+        byweekday=rrule.TU,
+        cache=True,
+        dtstart=start,
+        until=datetime(1969, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(election_day)
+
+    pres_election_day = rrule.rrule(
+        rrule.YEARLY,
+        interval=4,
+        bymonth=11,
+        bymonthday=(2, 3, 4, 5, 6, 7, 8),
+        byweekday=rrule.TU,
+        cache=True,
+        dtstart=datetime(1972, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1981, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(pres_election_day)
+
+    veterans_day = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=11,
+        bymonthday=11,
+        cache=True,
+        dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(veterans_day)
+
+    veterans_day_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=11,
+        bymonthday=12,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(veterans_day_sunday)
+
+    veterans_day_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=11,
+        bymonthday=10,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=datetime(1934, 1, 1, tzinfo=pytz.utc),
+        until=datetime(1954, 1, 1, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(veterans_day_saturday)
+
+    thanksgiving = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=11,
+        byweekday=rrule.TH,
+        bysetpos=4,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(thanksgiving)
+
+    christmas = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=12,
+        bymonthday=25,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(christmas)
+
+    christmas_sunday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=12,
+        bymonthday=26,
+        byweekday=rrule.MO,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(christmas_sunday)
+
+    # If Christmas is a Saturday then 24th, a Friday is observed.
+    christmas_saturday = rrule.rrule(
+        rrule.MONTHLY,
+        bymonth=12,
+        bymonthday=24,
+        byweekday=rrule.FR,
+        cache=True,
+        dtstart=start,
+        until=end
+    )
+    non_trading_rules.append(christmas_saturday)
+
+    paper_crisis = rrule.rrule(
+        rrule.WEEKLY,
+        count=29,
+        cache=True,
+        dtstart=datetime(1968, 6, 12, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(paper_crisis)
+
+    world_war_one = rrule.rrule(
+        rrule.DAILY,
+        count=96,
+        byweekday=(rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR),
+        cache=True,
+        dtstart=datetime(1914, 7, 31, tzinfo=pytz.utc)
+    )
+    non_trading_rules.append(world_war_one)
+
+    non_trading_ruleset = rrule.rruleset()
+    for rule in non_trading_rules:
+        non_trading_ruleset.rrule(rule)
+
+    non_trading_days = non_trading_ruleset.between(start, end, inc=True)
+    hols = []
+    for non_trading_day in non_trading_days:
+        if non_trading_day.weekday() < 5:
+            hols.append(str(non_trading_day.date()))
+
+    hols.append('1901-09-19')  # PresidentialFuneral-WilliamMcKinley
+    hols.append('1901-07-05')  # DayAfterIndependenceDay
+    hols.append('1903-04-22')  # NewNYSEBuildingOpened
+    hols.append('1917-06-05')  # DraftRegistrationDay
+    hols.append('1918-01-28')  # HeatlessDay
+    hols.append('1918-02-04')  # HeatlessDay
+    hols.append('1918-02-11')  # HeatlessDay
+    hols.append('1918-09-12')  # DraftRegistrationDay
+    hols.append('1918-11-11')  # VeteransDay
+    hols.append('1919-03-25')  # HomecomingOf27thDivision
+    hols.append('1919-05-06')  # Parade-77thDivision
+    hols.append('1919-09-10')  # ReturnOfGeneralJohnPershing
+    hols.append('1921-11-11')  # VeteransDay
+    hols.append('1923-08-03')  # PresidentialDeath-WarrenHarding
+    hols.append('1923-08-10')  # PresidentialFuneral-WarrenHarding
+    hols.append('1927-06-13')  # Parade-CharlesLindbergh
+    hols.append('1929-11-01')  # ClericalBacklogRelief
+    hols.append('1945-08-15')  # VictoryOverJapanDay
+    hols.append('1945-08-16')  # VictoryOverJapanDay
+    hols.append('1945-12-24')  # Christmas Eve
+    hols.append('1950-12-12')  # Saturdayurday-Before-ChristmasEve
+    hols.append('1956-12-24')  # Christmas Eve
+    hols.append('1961-05-29')  # DayBeforeDecorationDay
+    hols.append('1963-11-25')  # PresidentialFuneral-JohnKennedy
+    hols.append('1968-02-12')  # LincolnsBirthday
+    hols.append('1968-04-09')  # DayOfMourning-MartinLutherKing
+    hols.append('1968-07-05')  # DayAfterIndependenceDay
+    hols.append('1969-02-10')  # Weather-Snow
+    hols.append('1969-03-31')  # PresidentialFuneral-DwightEisenhower
+    hols.append('1969-07-21')  # FirstLunarLanding
+    hols.append('1972-12-28')  # PresidentialFuneral-HarryTruman
+    hols.append('1973-01-25')  # PresidentialFuneral-LyndonJohnson
+    hols.append('1977-07-14')  # NewYorkCityBlackout
+    hols.append('1985-09-27')  # Weather-HurricaneGloria
+    hols.append('1994-04-27')  # PresidentialFuneral-RichardNixon
+    hols.append('2001-09-11')  # September 11, 2001
+    hols.append('2001-09-12')  # September 11, 2001
+    hols.append('2001-09-13')  # September 11, 2001
+    hols.append('2001-09-14')  # September 11, 2001
+    hols.append('2004-06-11')  # Reagan's funeral
+    hols.append('2007-01-02')  # Ford's funeral
+    hols.append('2012-10-29')  # Frankenstorm
+    hols.append('2012-10-30')  # Frankenstorm
+    hols.append('2018-12-05')  # George H.W. Bush funeral
+    hols.append('2025-01-09')  # Carter's funeral
+    hols.sort()
+    return hols
+
+
+# Precompute, for every day between bd_start and bd_end, the number of
+# business days before it (same encoding as the calendar table written
+# by gen_cal).  Business day arithmetic then becomes an array lookup:
+# num_busdays(d1, d2) = bd_cum[d2] - bd_cum[d1], and the business day
+# k days after d is bd_days[ordinal(d) + k].
+def get_busday_index():
+    if this.bd_cum is None:
+        days = np.arange(this.bd_start, this.bd_end + np.timedelta64(1, 'D'),
+                         dtype='datetime64[D]')
+        isb = np.is_busday(days, busdaycal=get_cal())
+        this.bd_isb = isb
+        this.bd_cum = np.concatenate([[0], np.cumsum(isb)]).astype(np.int64)
+        this.bd_days = days[isb]
+    return this.bd_cum
+
+
+def _day_ix(dts):
+    get_busday_index()
+    ixs = (np.asarray(dts, dtype='datetime64[D]') - this.bd_start).astype(
+        np.int64)
+    in_range = np.all((ixs >= 0) & (ixs < len(this.bd_isb)))
+    return ixs, in_range
+
+
+# Map dates (array-like) to business day ordinals.  A date that is not
+# a business day is first rolled to the previous (roll='backward') or
+# to the next (roll='forward') business day.
+def busday_ordinal(dts, roll='backward'):
+    ixs, in_range = _day_ix(dts)
+    if not in_range:
+        raise ValueError('Dates outside the business day index range')
+    ords = this.bd_cum[ixs]
+    if roll == 'backward':
+        ords = np.where(this.bd_isb[ixs], ords, ords - 1)
+    return ords
+
+
+# Map business day ordinals (array-like) back to dates
+def ordinal_busday(ords):
+    return this.bd_days[np.asarray(ords)]
+
+
+# Array version of num_busdays
+def num_busdays_arr(sdts, edts):
+    s_ixs, s_in_range = _day_ix(sdts)
+    e_ixs, e_in_range = _day_ix(edts)
+    if not (s_in_range and e_in_range):
+        return np.busday_count(np.asarray(sdts, dtype='datetime64[D]'),
+                               np.asarray(edts, dtype='datetime64[D]'),
+                               busdaycal=get_cal())
+    # like np.busday_count, count [edt + 1, sdt + 1) if edt < sdt
+    shift = (e_ixs < s_ixs).astype(np.int64)
+    return this.bd_cum[e_ixs + shift] - this.bd_cum[s_ixs + shift]
+
+
+# Array version of move_busdays; bdays can be a scalar or an array.
+# Returns an array of datetime64[D]
+def move_busdays_arr(dts, bdays):
+    ixs, in_range = _day_ix(dts)
+    bdays = np.asarray(bdays)
+    if in_range:
+        ords = this.bd_cum[ixs]
+        ords = np.where(this.bd_isb[ixs] | (bdays < 0), ords, ords - 1) + \
+            bdays
+        if np.all((ords >= 0) & (ords < len(this.bd_days))):
+            return this.bd_days[ords]
+    dts = np.asarray(dts, dtype='datetime64[D]')
+    bdays = np.broadcast_to(bdays, dts.shape)
+    res = np.empty(dts.shape, dtype='datetime64[D]')
+    neg = bdays < 0
+    res[neg] = np.busday_offset(dts[neg], bdays[neg], roll='forward',
+                                busdaycal=get_cal())
+    res[~neg] = np.busday_offset(dts[~neg], bdays[~neg], roll='backward',
+                                 busdaycal=get_cal())
+    return res
+
+
+def next_busday_arr(dts):
+    return move_busdays_arr(dts, 1)
+
+
+def prev_busday_arr(dts):
+    return move_busdays_arr(dts, -1)
+
+
+def is_busday_arr(dts):
+    ixs, in_range = _day_ix(dts)
+    if not in_range:
+        return np.is_busday(np.asarray(dts, dtype='datetime64[D]'),
+                            busdaycal=get_cal())
+    return this.bd_isb[ixs]
+
+
+# Scalar lookup in the business day index; returns None if dt is
+# outside the index range
+def _move_busday(dt, bdays):
+    get_busday_index()
+    ix = int((np.datetime64(dt, 'D') - this.bd_start).astype(np.int64))
+    if ix < 0 or ix >= len(this.bd_isb):
+        return None
+    k = int(this.bd_cum[ix])
+    if not this.bd_isb[ix] and bdays >= 0:
+        k -= 1
+    k += bdays
+    if k < 0 or k >= len(this.bd_days):
+        return None
+    return this.bd_days[k]
+
+
 def next_busday(dt):
-    return str(pd.to_datetime(np.busday_offset(dt, 1, roll='backward',
-                                               busdaycal=get_cal())).date())
+    res = _move_busday(dt, 1)
+    if res is None:
+        res = np.busday_offset(dt, 1, roll='backward', busdaycal=get_cal())
+    return str(res)
 
 
 def prev_busday(dt):
-    return str(pd.to_datetime(np.busday_offset(dt, -1, roll='forward',
-                                               busdaycal=get_cal())).date())
+    res = _move_busday(dt, -1)
+    if res is None:
+        res = np.busday_offset(dt, -1, roll='forward', busdaycal=get_cal())
+    return str(res)
 
 
 def is_busday(dt):
-    return np.is_busday(dt, busdaycal=get_cal())
+    get_busday_index()
+    ix = int((np.datetime64(dt, 'D') - this.bd_start).astype(np.int64))
+    if ix < 0 or ix >= len(this.bd_isb):
+        return np.is_busday(dt, busdaycal=get_cal())
+    return this.bd_isb[ix]
 
 
 # Move backwards (if bdays < 0) or forwards (if bdays > 0) bdays
@@ -535,10 +724,14 @@ def is_busday(dt):
 # expiry, which would fall on a Saturday before Feb 2015, and on a
 # Friday afterwards.
 def move_busdays(dt, bdays):
-    return str(np.busday_offset(dt, bdays, busdaycal=get_cal(),
-                                roll='forward' if bdays < 0 else 'backward'))
+    res = _move_busday(dt, bdays)
+    if res is None:
+        res = np.busday_offset(dt, bdays, busdaycal=get_cal(),
+                               roll='forward' if bdays < 0 else 'backward')
+    return str(res)
 
 
+# Scalar busday_count is already cheap, the index only pays off for arrays
 def num_busdays(sdt, edt):
     return np.busday_count(sdt, edt, busdaycal=get_cal())
 
@@ -559,6 +752,9 @@ def expiries(sdt, edt):
 
 
 def next_expiry(dt, min_days=1):
+    ixs = _next_expiry_ix(np.array([dt], dtype='datetime64[D]'), min_days)
+    if ixs is not None:
+        return expiry(this.exp_months[ixs[0]])
     ym = np.datetime64(str(dt)[:-3])
     last_exp = move_busdays(expiry(ym), 0)
     while num_busdays(dt, last_exp) < min_days:
@@ -568,6 +764,9 @@ def next_expiry(dt, min_days=1):
 
 
 def prev_expiry(dt, min_days=0):
+    ixs = _prev_expiry_ix(np.array([dt], dtype='datetime64[D]'), min_days)
+    if ixs is not None:
+        return expiry(this.exp_months[ixs[0]])
     ym = np.datetime64(str(dt)[:-3])
     last_exp = move_busdays(expiry(ym), 0)
     while num_busdays(last_exp, dt) <= min_days:
@@ -576,6 +775,84 @@ def prev_expiry(dt, min_days=0):
     return expiry(ym)
 
 
+# Precompute the expiry of every month covered by the business day
+# index, together with the business day ordinal of the last trading
+# day (move_busdays(expiry, 0)).  Since these ordinals are sorted,
+# next/prev expiry become a searchsorted on the ordinal of the date.
+def get_expiry_table():
+    if this.exp_months is None:
+        get_busday_index()
+        months = np.arange(this.bd_start, this.bd_end, dtype='datetime64[M]')
+        exps = np.busday_offset(months, 2, roll='forward', weekmask='Fri')
+        sat_exps = months < np.datetime64('2015-02')
+        exps[sat_exps] += np.timedelta64(1, 'D')
+        this.exp_ords = busday_ordinal(exps)
+        # starting Feb 2015, expiry is on the last trading day
+        exps[~sat_exps] = this.bd_days[this.exp_ords[~sat_exps]]
+        this.exp_dates = exps
+        this.exp_months = months
+    return this.exp_dates
+
+
+def _month_ix(dts):
+    return (dts.astype('datetime64[M]') - this.exp_months[0]).astype(
+        np.int64)
+
+
+# Index in the expiry table of the first expiry that is at least
+# min_days business days after each date.  Returns None if some of the
+# dates are not covered by the table (or min_days < 1).
+def _next_expiry_ix(dts, min_days):
+    get_expiry_table()
+    ixs, in_range = _day_ix(dts)
+    if not in_range or min_days < 1:
+        return None
+    # num_busdays(dt, last_exp) >= min_days <=> ord(last_exp) >= cum[dt]
+    # + min_days
+    res = np.searchsorted(this.exp_ords, this.bd_cum[ixs] + min_days)
+    res = np.maximum(res, _month_ix(dts))
+    if np.any(res >= len(this.exp_ords)):
+        return None
+    return res
+
+
+# Index in the expiry table of the last expiry that is more than
+# min_days business days before each date.  Returns None if some of the
+# dates are not covered by the table (or min_days < 0).
+def _prev_expiry_ix(dts, min_days):
+    get_expiry_table()
+    ixs, in_range = _day_ix(dts)
+    if not in_range or min_days < 0:
+        return None
+    # num_busdays(last_exp, dt) > min_days <=> ord(last_exp) < cum[dt] -
+    # min_days
+    res = np.searchsorted(this.exp_ords, this.bd_cum[ixs] - min_days,
+                          side='left') - 1
+    res = np.minimum(res, _month_ix(dts))
+    if np.any(res < 0):
+        return None
+    return res
+
+
+# Array versions of next_expiry and prev_expiry; return datetime64[D]
+def next_expiry_arr(dts, min_days=1):
+    dts = np.asarray(dts, dtype='datetime64[D]')
+    ixs = _next_expiry_ix(dts, min_days)
+    if ixs is None:
+        return np.array([next_expiry(dt, min_days) for dt in dts],
+                        dtype='datetime64[D]')
+    return this.exp_dates[ixs]
+
+
+def prev_expiry_arr(dts, min_days=0):
+    dts = np.asarray(dts, dtype='datetime64[D]')
+    ixs = _prev_expiry_ix(dts, min_days)
+    if ixs is None:
+        return np.array([prev_expiry(dt, min_days) for dt in dts],
+                        dtype='datetime64[D]')
+    return this.exp_dates[ixs]
+
+
 def long_expiries(starting_from=None):
     s_date = datetime.strftime(datetime.now(), '%Y-%m-%d')\
              if starting_from is None else starting_from
@@ -645,27 +922,145 @@ def current_date_and_time():
     return datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
 
 
-def gen_cal(start_date='1984-12-31', end_date='2026-12-31'):
-    busday_cal = get_cal(start_date, end_date)
-    s_date = np.datetime64(start_date)
-    e_date = np.datetime64(end_date)
-    day_num = -1
-    busday_num = -1
-    while s_date <= e_date:
-        day_num += 1
-        ibd = -1
-        if np.is_busday(s_date, busdaycal=busday_cal):
-            busday_num += 1
-            ibd = 1
-        res = ibd * ((busday_num << 16) | day_num)
-        sql_cmd = f"INSERT INTO calendar VALUES ('{str(s_date)}', {res}) ON CONFLICT DO NOTHING"
-        stxdb.db_write_cmd(sql_cmd)
-        if day_num % 1000 == 0:
-            print('Inserted {0:s}'.format(str(s_date)))
-        s_date += np.timedelta64(1, 'D')
+# Encode every day between start_date and end_date like this:
+# ibd * ((busday_num << 16) | day_num), where day_num and busday_num
+# count the days and the business days since start_date, and ibd is 1
+# for business days and -1 otherwise.  Returns the days and the codes.
+def cal_encoding(start_date, end_date):
+    days = np.arange(np.datetime64(start_date, 'D'),
+                     np.datetime64(end_date, 'D') + np.timedelta64(1, 'D'))
+    isb = is_busday_arr(days)
+    day_num = np.arange(len(days), dtype=np.int64)
+    busday_num = np.cumsum(isb, dtype=np.int64) - 1
+    codes = np.where(isb, 1, -1) * ((busday_num << 16) | day_num)
+    return days, codes
+
+
+# Last day of the calendar table, by default: December 31 of next year
+def default_cal_end():
+    return f'{datetime.now().year + 1}-12-31'
+
+
+# Populate the calendar table with one bulk upload.  In incremental
+# mode, only the days after the last date in the table are uploaded,
+# and the day numbering continues from the first date in the table.
+def gen_cal(start_date='1984-12-31', end_date=None, incremental=False):
+    if end_date is None:
+        end_date = default_cal_end()
+    get_cal(end=end_date)
+    last_date = None
+    if incremental:
+        res = stxdb.db_read_cmd('SELECT MIN(dt), MAX(dt) FROM calendar')
+        if res and res[0][0] is not None:
+            start_date, last_date = str(res[0][0]), str(res[0][1])
+    days, codes = cal_encoding(start_date, end_date)
+    if last_date is not None:
+        last_ix = int((np.datetime64(last_date, 'D') - days[0]).astype(
+            np.int64))
+        if last_ix >= len(days) - 1:
+            print(f'Calendar table already ends on {last_date}')
+            return
+        res = stxdb.db_read_cmd(
+            f"SELECT idx FROM calendar WHERE dt='{last_date}'")
+        if res[0][0] != codes[last_ix]:
+            raise RuntimeError(f'Calendar code for {last_date} is '
+                               f'{res[0][0]}, expected {codes[last_ix]}; '
+                               'regenerate the calendar')
+        days, codes = days[last_ix + 1:], codes[last_ix + 1:]
+    stxdb.db_bulk_upsert('calendar', zip(days.astype(str), codes.tolist()),
+                         ['dt'], update_cols=[], cols=['dt', 'idx'])
+    print(f'Uploaded {len(days)} calendar days between {days[0]} and '
+          f'{days[-1]}')
+
+
+# Intraday bar grid: every business day has the same sequence of bars,
+# that start at 'first', end at 'last' and are 'freq' minutes apart.
+# Bar k of the business day with ordinal b has the ordinal
+# b * bars_per_session + k, so stepping N bars, or counting the bars
+# between two datetimes are integer operations.  Datetimes that are not
+# on the grid are rolled back to the previous bar.
+@functools.lru_cache(maxsize=None)
+def _grid(first, last, freq):
+    first_min = 60 * int(first[:2]) + int(first[3:5])
+    last_min = 60 * int(last[:2]) + int(last[3:5])
+    return first_min, (last_min - first_min) // freq + 1
+
+
+def bars_per_session(first='09:30', last='15:55', freq=5):
+    return _grid(first, last, freq)[1]
+
+
+def intraday_ordinal(dts, first='09:30', last='15:55', freq=5):
+    first_min, num_bars = _grid(first, last, freq)
+    dts = np.asarray(dts, dtype='datetime64[m]')
+    days = dts.astype('datetime64[D]')
+    ixs, in_range = _day_ix(days)
+    if not in_range:
+        raise ValueError('Dates outside the business day index range')
+    ords = busday_ordinal(days)
+    mins = (dts - days).astype(np.int64) - first_min
+    slots = np.clip(np.floor_divide(mins, freq), -1, num_bars - 1)
+    slots = np.where(this.bd_isb[ixs], slots, num_bars - 1)
+    return ords * num_bars + slots
+
+
+def ordinal_intraday(ords, first='09:30', last='15:55', freq=5):
+    first_min, num_bars = _grid(first, last, freq)
+    ords = np.asarray(ords)
+    days = this.bd_days[ords // num_bars]
+    mins = first_min + (ords % num_bars) * freq
+    return days.astype('datetime64[m]') + mins.astype('timedelta64[m]')
+
+
+# Move bars intraday bars forward (bars > 0) or backward (bars < 0)
+def move_intraday_arr(dts, bars, first='09:30', last='15:55', freq=5):
+    ords = intraday_ordinal(dts, first, last, freq)
+    return ordinal_intraday(ords + np.asarray(bars), first, last, freq)
+
+
+def num_bars_arr(sdts, edts, first='09:30', last='15:55', freq=5):
+    return intraday_ordinal(edts, first, last, freq) - \
+        intraday_ordinal(sdts, first, last, freq)
+
+
+# All the intraday bars between sdt and edt (inclusive)
+def intraday_range(sdt, edt, first='09:30', last='15:55', freq=5):
+    s_ord = int(intraday_ordinal(sdt, first, last, freq))
+    if ordinal_intraday(s_ord, first, last, freq) < np.datetime64(sdt, 'm'):
+        s_ord += 1
+    e_ord = int(intraday_ordinal(edt, first, last, freq))
+    return ordinal_intraday(np.arange(s_ord, e_ord + 1), first, last, freq)
+
+
+# Scalar version of move_intraday_arr, using integer arithmetic.
+# Returns the new date and time strings, or None if dt is not on the
+# grid, or if it is outside the business day index range.
+def _move_intraday(dt, bars, first, last, freq):
+    first_min, num_bars = _grid(first, last, freq)
+    get_busday_index()
+    npdt = np.datetime64(dt)
+    npdt_min = npdt.astype('datetime64[m]')
+    if npdt != npdt_min:
+        return None
+    mins = int(npdt_min.astype(np.int64))
+    day_min = mins % 1440
+    ix = mins // 1440 - this.bd_start_ix
+    if ix < 0 or ix >= len(this.bd_isb) or not this.bd_isb[ix]:
+        return None
+    slot, rem = divmod(day_min - first_min, freq)
+    if rem != 0 or slot < 0 or slot >= num_bars:
+        return None
+    b, slot = divmod(int(this.bd_cum[ix]) * num_bars + slot + bars, num_bars)
+    if b < 0 or b >= len(this.bd_days):
+        return None
+    day_min = first_min + slot * freq
+    return str(this.bd_days[b]), f'{day_min // 60:02d}:{day_min % 60:02d}'
 
 
 def next_intraday(dt):
+    res = _move_intraday(dt, 1, '09:30', '15:55', 5)
+    if res is not None:
+        return res
     next_date, next_time = None, None
     npdt = np.datetime64(dt)
     npdt += np.timedelta64(5, 'm')
@@ -686,6 +1081,9 @@ def next_intraday_dt(dt: str) -> str:
     return f"{dt_date} {dt_time}"
 
 def next_market_datetime(market_datetime):
+    res = _move_intraday(market_datetime, 1, '09:25', '16:00', 5)
+    if res is not None:
+        return res[0], f'{res[0]} {res[1]}:00'
     next_date, next_time = None, None
     npdt = np.datetime64(market_datetime)
     pddt = pd.Timestamp(npdt)
@@ -704,5 +1102,40 @@ def next_market_datetime(market_datetime):
     return next_date, f"{next_date} {next_time}"
 
 
+# Compare the time it takes to generate the calendar from the rrules
+# with the time it takes to load it from the cache file
+def benchmark_cal(num_runs=5):
+    start = pd.Timestamp('1901-01-01', tz='UTC')
+    end = datetime.now().date() + timedelta(weeks=52)
+    end = pd.Timestamp(end.replace(month=12, day=31), tz='UTC')
+    t0 = time.perf_counter()
+    for _ in range(num_runs):
+        hols = gen_holidays(start, end)
+        np.busdaycalendar(holidays=hols)
+    gen_ms = 1000 * (time.perf_counter() - t0) / num_runs
+    _save_cal_cache(start, end, hols)
+    t0 = time.perf_counter()
+    for _ in range(num_runs):
+        np.busdaycalendar(holidays=_load_cal_cache(start, end))
+    load_ms = 1000 * (time.perf_counter() - t0) / num_runs
+    print(f'Calendar: generate {gen_ms:.1f} ms, load from '
+          f'{this.cal_cache_file} {load_ms:.1f} ms ({num_runs} runs)')
+    return {'gen_ms': gen_ms, 'load_ms': load_ms}
+
+
 if __name__ == '__main__':
-    gen_cal()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--benchmark', action='store_true',
+                        help='Benchmark calendar startup time')
+    parser.add_argument('-s', '--start_date', type=str, default='1984-12-31',
+                        help='First day in the calendar table')
+    parser.add_argument('-e', '--end_date', type=str,
+                        help='Last day in the calendar table (default: '
+                        'December 31 of next year)')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only append the days missing from the table')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_cal()
+    else:
+        gen_cal(args.start_date, args.end_date, args.incremental)
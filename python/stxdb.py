@@ -1,23 +1,343 @@
-from contextlib import closing
+from collections import deque
+from contextlib import closing, contextmanager
+from functools import lru_cache
+import io
+import json
+import logging
+import numpy as np
 import os
+import pandas as pd
+import polars as pl
 import psycopg2
+from psycopg2 import extensions
+import psycopg2.pool
+import re
 import sys
+import threading
+import time
 
 this = sys.modules[__name__]
 this.cnx = None
 this.db_url = 'DB_TEST_URL' if os.getenv('TESTING') == 1 else 'DB_URL'
+# connection pool settings; each thread checks out its own connection
+this.pool = None
+this.pool_pid = None
+this.pool_min = int(os.getenv('DB_POOL_MIN', '1'))
+this.pool_max = int(os.getenv('DB_POOL_MAX', '8'))
+this.pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+this.pool_lock = threading.Lock()
+this.pool_cond = threading.Condition(this.pool_lock)
+this.pool_in_use = 0
+this.thread_cnx = {}  # thread ident -> connection pinned to that thread
+# name -> (sql, param types) for server-side prepared statements
+this.prepared_stmts = {}
+# table name -> cached schema metadata (see db_get_table_columns)
+this.schema_cache = {}
+this.schema_lock = threading.Lock()
+# polars dtypes for the postgres type OIDs found in the stx tables
+this.pg_dtypes = {16: pl.Boolean, 20: pl.Int64, 21: pl.Int16, 23: pl.Int32,
+                  700: pl.Float32, 701: pl.Float64, 1700: pl.Float64,
+                  1082: pl.Date, 1114: pl.Datetime}
+this.pool_stats = {'checkouts': 0, 'checkins': 0, 'waits': 0,
+                   'wait_time': 0.0, 'reconnects': 0, 'reclaimed': 0}
+# query profiling: per SQL fingerprint call count, rows and latencies
+this.profiling = os.getenv('STX_DB_PROFILE') == '1'
+this.slow_query_ms = float(os.getenv('STX_DB_SLOW_MS', '0'))
+this.query_stats = {}
+this.query_stats_lock = threading.Lock()
+this.max_latency_samples = 10000
 
 
+# Normalize a SQL statement so that queries differing only in their
+# literals (dates, tickers, IN lists) share the same fingerprint
+@lru_cache(maxsize=4096)
+def sql_fingerprint(sql):
+    fp = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    fp = re.sub(r'\b\d+(?:\.\d+)?\b', '?', fp)
+    fp = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', fp)
+    fp = re.sub(r'\s+', ' ', fp).strip()
+    return fp
+
+
+def _record_query(sql, elapsed, num_rows):
+    fp = sql_fingerprint(sql)
+    with this.query_stats_lock:
+        qs = this.query_stats.get(fp)
+        if qs is None:
+            qs = {'calls': 0, 'rows': 0, 'total': 0.0,
+                  'latencies': deque(maxlen=this.max_latency_samples)}
+            this.query_stats[fp] = qs
+        qs['calls'] += 1
+        qs['rows'] += max(num_rows, 0)
+        qs['total'] += elapsed
+        qs['latencies'].append(elapsed)
+    if this.slow_query_ms > 0 and 1000 * elapsed >= this.slow_query_ms:
+        logging.warning(f'Slow query ({1000 * elapsed:.1f} ms, {num_rows} '
+                        f'rows): {sql[:1000]}')
+
+
+# Connection class used by all the pooled connections; it remembers
+# which prepared statements were created on it
+class _StxConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Cursor used by all the pooled connections.  When profiling is on, it
+# times every execute (including those issued by pd.read_sql and
+# pl.read_database) and COPY
+class _TimedCursor(extensions.cursor):
+    def _sql_text(self, query):
+        if isinstance(query, bytes):
+            return query.decode('utf-8', 'replace')
+        if not isinstance(query, str):
+            return query.as_string(self.connection)
+        return query
+
+    def execute(self, query, vars=None):
+        if not this.profiling:
+            return super().execute(query, vars)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_query(self._sql_text(query), time.perf_counter() - t0,
+                          self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        if not this.profiling:
+            return super().copy_expert(sql, file, size)
+        t0 = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _record_query(self._sql_text(sql), time.perf_counter() - t0,
+                          self.rowcount)
+
+
+def db_enable_profiling(slow_query_ms=None):
+    this.profiling = True
+    if slow_query_ms is not None:
+        this.slow_query_ms = slow_query_ms
+
+
+def db_disable_profiling():
+    this.profiling = False
+
+
+# Return per-fingerprint statistics, sorted by total time spent
+def db_query_stats():
+    res = []
+    with this.query_stats_lock:
+        for fp, qs in this.query_stats.items():
+            lat = 1000 * np.array(qs['latencies'])
+            res.append({'sql': fp, 'calls': qs['calls'], 'rows': qs['rows'],
+                        'total_ms': 1000 * qs['total'],
+                        'p50_ms': float(np.percentile(lat, 50)),
+                        'p95_ms': float(np.percentile(lat, 95)),
+                        'max_ms': float(lat.max())})
+    res.sort(key=lambda x: x['total_ms'], reverse=True)
+    return res
+
+
+def db_dump_query_stats(top=25):
+    stats = db_query_stats()
+    lines = [f'DB query stats ({len(stats)} distinct queries):',
+             f"{'calls':>7s} {'rows':>9s} {'total_ms':>10s} {'p50_ms':>8s} "
+             f"{'p95_ms':>8s} {'max_ms':>8s}  sql"]
+    for qs in stats[:top]:
+        lines.append(f"{qs['calls']:7d} {qs['rows']:9d} "
+                     f"{qs['total_ms']:10.1f} {qs['p50_ms']:8.1f} {qs['p95_ms']:8.1f} "
+                     f"{qs['max_ms']:8.1f}  {qs['sql'][:200]}")
+    logging.info('\n'.join(lines))
+    return stats
+
+
+def db_reset_query_stats():
+    with this.query_stats_lock:
+        this.query_stats.clear()
+
+
+def db_init_pool(min_size=None, max_size=None, timeout=None):
+    with this.pool_lock:
+        if min_size is not None:
+            this.pool_min = min_size
+        if max_size is not None:
+            this.pool_max = max_size
+        if timeout is not None:
+            this.pool_timeout = timeout
+        if this.pool is not None and this.pool_pid != os.getpid():
+            # pool inherited from the parent process: closing its
+            # connections would terminate the sessions of the parent,
+            # so only the references to them are dropped
+            this.pool = None
+            this.pool_in_use = 0
+            this.thread_cnx.clear()
+            this.cnx = None
+        if this.pool is not None and not this.pool.closed:
+            this.pool.closeall()
+        this.pool = psycopg2.pool.ThreadedConnectionPool(
+            this.pool_min, this.pool_max, os.getenv(this.db_url),
+            connection_factory=_StxConnection, cursor_factory=_TimedCursor)
+        this.pool_pid = os.getpid()
+        this.pool_in_use = 0
+        this.thread_cnx.clear()
+    return this.pool
+
+
+def get_pool():
+    # a forked worker must not share the sockets of its parent process
+    # (see db_init_pool)
+    if this.pool is None or this.pool.closed or this.pool_pid != os.getpid():
+        db_init_pool()
+    return this.pool
+
+
+# Connections pinned to threads that have exited are returned to the
+# pool; called with pool_lock held
+def _reclaim_dead_threads():
+    alive = {t.ident for t in threading.enumerate()}
+    for ident in [x for x in this.thread_cnx if x not in alive]:
+        cnx = this.thread_cnx.pop(ident)
+        this.pool.putconn(cnx, close=bool(cnx.closed))
+        this.pool_in_use -= 1
+        this.pool_stats['reclaimed'] += 1
+
+
+# Health check of a connection taken out of the pool.  The pool rolls
+# back the open transactions of the connections returned to it, so a
+# connection in a transaction here is not usable either.
+def _healthy(cnx):
+    if cnx.closed:
+        return False
+    return cnx.get_transaction_status() == \
+        extensions.TRANSACTION_STATUS_IDLE
+
+
+# Check a connection out of the pool, waiting up to pool_timeout
+# seconds if all pool_max connections are in use
+def db_checkout():
+    p = get_pool()
+    with this.pool_cond:
+        if this.pool_in_use >= this.pool_max:
+            _reclaim_dead_threads()
+        if this.pool_in_use >= this.pool_max:
+            this.pool_stats['waits'] += 1
+            t0 = time.perf_counter()
+            ok = this.pool_cond.wait_for(
+                lambda: this.pool_in_use < this.pool_max, this.pool_timeout)
+            this.pool_stats['wait_time'] += time.perf_counter() - t0
+            if not ok:
+                raise psycopg2.pool.PoolError(
+                    f'No DB connection available after {this.pool_timeout} '
+                    'seconds')
+        cnx = p.getconn()
+        if not _healthy(cnx):
+            logging.warning('Discarding broken DB connection')
+            p.putconn(cnx, close=True)
+            cnx = p.getconn()
+            this.pool_stats['reconnects'] += 1
+        this.pool_in_use += 1
+        this.pool_stats['checkouts'] += 1
+    cnx.autocommit = True
+    return cnx
+
+
+def db_checkin(cnx):
+    with this.pool_cond:
+        if this.pool is not None and this.pool_pid == os.getpid():
+            this.pool.putconn(cnx, close=bool(cnx.closed))
+        this.pool_in_use -= 1
+        this.pool_stats['checkins'] += 1
+        this.pool_cond.notify()
+
+
+# Use a dedicated pooled connection for a block of work:
+#   with stxdb.db_cnx() as cnx:
+#       df = pd.read_sql(q, cnx)
+@contextmanager
+def db_cnx():
+    cnx = db_checkout()
+    try:
+        yield cnx
+    finally:
+        db_checkin(cnx)
+
+
+# Return the connection pinned to the calling thread, checking one out
+# of the pool the first time the thread asks for it.  The connection is
+# checked when it is taken out of the pool only: a transaction started
+# by the caller must not be rolled back here.
 def db_get_cnx():
-    if this.cnx is None:
-        this.cnx = psycopg2.connect(os.getenv(this.db_url))
-        this.cnx.autocommit = True
-    return this.cnx
+    ident = threading.get_ident()
+    cnx = this.thread_cnx.get(ident)
+    if cnx is not None and this.pool_pid == os.getpid() and \
+            not cnx.closed:
+        return cnx
+    if cnx is not None:
+        db_release_cnx()
+    cnx = db_checkout()
+    with this.pool_lock:
+        this.thread_cnx[ident] = cnx
+    this.cnx = cnx
+    return cnx
+
+
+# Run a block of work in one transaction, on the connection pinned to
+# the calling thread:
+#   with stxdb.db_transaction() as cnx:
+#       stxdb.db_upload_lines(lines, tbl)
+#       stxdb.db_bulk_upsert(tbl2, recs, keys, cnx=cnx)
+# The helpers that use db_get_cnx() without committing (db_read_cmd,
+# db_upload_lines) are part of the transaction; db_write_cmd is not, as
+# it commits.
+@contextmanager
+def db_transaction():
+    cnx = db_get_cnx()
+    cnx.autocommit = False
+    try:
+        yield cnx
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cnx.autocommit = True
+
+
+# Return the connection pinned to the calling thread to the pool
+# (e.g. at the end of a web request)
+def db_release_cnx():
+    with this.pool_lock:
+        cnx = this.thread_cnx.pop(threading.get_ident(), None)
+    if cnx is not None:
+        db_checkin(cnx)
+
+
+def db_pool_stats():
+    with this.pool_lock:
+        res = dict(this.pool_stats)
+        res.update({'in_use': this.pool_in_use, 'min_size': this.pool_min,
+                    'max_size': this.pool_max})
+    return res
+
+
+def db_pool_reset_stats():
+    with this.pool_lock:
+        for k in this.pool_stats:
+            this.pool_stats[k] = 0.0 if k == 'wait_time' else 0
 
 
-# TODO: this does not cleanup properly
 def disconnect():
-    this.cnx.close()
+    db_release_cnx()
+    with this.pool_lock:
+        if this.pool is not None and not this.pool.closed:
+            this.pool.closeall()
+        this.pool = None
+        this.pool_in_use = 0
+        this.thread_cnx.clear()
+        this.cnx = None
 
 
 # read commands perform read only operations: select, describe, show
@@ -30,10 +350,202 @@ def db_read_cmd(sql):
 
 # write commands perform operations that need commit
 def db_write_cmd(sql):
-    with closing(db_get_cnx().cursor()) as crs:
+    cnx = db_get_cnx()
+    with closing(cnx.cursor()) as crs:
         # print('sql = {0:s}'.format(sql))
         crs.execute(sql)
-        this.cnx.commit()
+        cnx.commit()
+
+
+# Notifications between processes (e.g. the datafeed telling the web
+# app to invalidate cached data).  db_listen opens a dedicated,
+# non-pooled connection that listens on a channel; db_notifications
+# returns the payloads received on it since the previous call.
+def db_notify(channel, payload=''):
+    with closing(db_get_cnx().cursor()) as crs:
+        crs.execute('SELECT pg_notify(%s, %s)', (channel, payload))
+
+
+def db_listen(channel):
+    cnx = psycopg2.connect(os.getenv(this.db_url))
+    cnx.autocommit = True
+    with closing(cnx.cursor()) as crs:
+        crs.execute(f'LISTEN {channel}')
+    return cnx
+
+
+def db_notifications(cnx):
+    cnx.poll()
+    res = [x.payload for x in cnx.notifies]
+    del cnx.notifies[:]
+    return res
+
+
+# Register a named prepared statement for a query that runs very often
+# (e.g. on every web page refresh).  The sql uses $1, $2, ... for its
+# parameters; param_types (e.g. ['varchar', 'date']) is optional, if
+# omitted postgres infers the types.  The statement is prepared lazily
+# on each connection, the first time it is executed there.
+def db_register_prepared(name, sql, param_types=None):
+    this.prepared_stmts[name] = (sql, param_types)
+
+
+def _prepare(cnx, crs, name):
+    if name in cnx.prepared:
+        return
+    sql, param_types = this.prepared_stmts[name]
+    types = '' if not param_types else '({0:s})'.format(
+        ', '.join(param_types))
+    crs.execute(f'PREPARE {name}{types} AS {sql}')
+    cnx.prepared.add(name)
+
+
+# Execute a registered prepared statement; return the result rows
+def db_exec_prepared(name, params=()):
+    cnx = db_get_cnx()
+    with closing(cnx.cursor()) as crs:
+        _prepare(cnx, crs, name)
+        if params:
+            crs.execute('EXECUTE {0:s} ({1:s})'.format(
+                name, ', '.join(len(params) * ['%s'])), params)
+        else:
+            crs.execute(f'EXECUTE {name}')
+        res = crs.fetchall() if crs.description is not None else []
+    return res
+
+
+# Compare the average latency (milliseconds) of a registered prepared
+# statement with that of the same query sent as plain text
+def db_benchmark_prepared(name, params=(), num_runs=200):
+    sql, _ = this.prepared_stmts[name]
+    # escape the literal % signs (e.g. LIKE 'A%') before adding the
+    # psycopg2 placeholders
+    text_sql = re.sub(r'\$(\d+)', lambda m: f'%(p{m.group(1)})s',
+                      sql.replace('%', '%%'))
+    text_params = {f'p{i + 1}': x for i, x in enumerate(params)}
+    cnx = db_get_cnx()
+    db_exec_prepared(name, params)
+    t0 = time.perf_counter()
+    for _ in range(num_runs):
+        db_exec_prepared(name, params)
+    prepared_ms = 1000 * (time.perf_counter() - t0) / num_runs
+    with closing(cnx.cursor()) as crs:
+        t0 = time.perf_counter()
+        for _ in range(num_runs):
+            crs.execute(text_sql, text_params)
+            crs.fetchall()
+        text_ms = 1000 * (time.perf_counter() - t0) / num_runs
+    logging.info(f'{name}: prepared {prepared_ms:.3f} ms, plain text '
+                 f'{text_ms:.3f} ms per request ({num_runs} runs)')
+    return {'name': name, 'prepared_ms': prepared_ms, 'text_ms': text_ms}
+
+
+# Stream the results of a (large) select through a server-side cursor,
+# yielding batch_size rows at a time, so that a scan over the whole
+# eods/intraday/options tables runs in constant memory.  fmt selects the
+# batch type: 'rows' (list of tuples), 'numpy' (record array), or
+# 'polars' (DataFrame).  The cursor uses a dedicated pooled connection
+# inside its own transaction, as named cursors do not work in autocommit.
+def db_stream_cmd(sql, batch_size=10000, fmt='rows'):
+    if fmt not in ['rows', 'numpy', 'polars']:
+        raise ValueError(f'Unknown stream format {fmt}')
+    with db_cnx() as cnx:
+        cnx.autocommit = False
+        try:
+            crs_name = f'stx_stream_{threading.get_ident()}_{id(cnx)}'
+            with cnx.cursor(name=crs_name) as crs:
+                crs.itersize = batch_size
+                crs.execute(sql)
+                cols = None
+                while True:
+                    rows = crs.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    if cols is None:
+                        cols = [d[0] for d in crs.description]
+                    if fmt == 'numpy':
+                        yield np.rec.fromrecords(rows, names=cols)
+                    elif fmt == 'polars':
+                        yield pl.DataFrame(rows, schema=cols, orient='row')
+                    else:
+                        yield rows
+        finally:
+            if not cnx.closed:
+                cnx.rollback()
+                cnx.autocommit = True
+
+
+# Fast columnar read: run COPY (query) TO STDOUT and decode the CSV
+# stream directly into typed columns (int32 prices, dates, timestamps),
+# instead of building Python objects row by row like pd.read_sql or
+# pl.read_database.  engine can be 'polars' (DataFrame), 'pandas'
+# (DataFrame, optionally indexed by index_col) or 'numpy' (dictionary
+# of column arrays).
+def db_read_frame(query, engine='polars', index_col=None):
+    if engine not in ['polars', 'pandas', 'numpy']:
+        raise ValueError(f'Unknown engine {engine}')
+    cnx = db_get_cnx()
+    if not isinstance(query, str):
+        query = query.as_string(cnx)
+    query = query.strip().rstrip(';')
+    buf = io.BytesIO()
+    with closing(cnx.cursor()) as crs:
+        crs.execute(f'SELECT * FROM ({query}) q LIMIT 0')
+        schema = {d[0]: this.pg_dtypes.get(d[1], pl.Utf8)
+                  for d in crs.description}
+        crs.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER)',
+                        buf)
+    buf.seek(0)
+    df = pl.read_csv(buf, schema=schema)
+    if engine == 'polars':
+        return df
+    # integers are returned as int64, like pd.read_sql did, so that
+    # callers can scale them (e.g. volumes) without overflows
+    cols = {c: df[c].to_numpy() for c in df.columns}
+    for c, x in cols.items():
+        if x.dtype.kind in 'iu' and x.dtype.itemsize < 8:
+            cols[c] = x.astype(np.int64)
+    if engine == 'numpy':
+        return cols
+    pdf = pd.DataFrame(cols)
+    for c, dtype in schema.items():
+        if dtype in [pl.Date, pl.Datetime]:
+            pdf[c] = pd.to_datetime(pdf[c])
+    if index_col is not None:
+        pdf.set_index(index_col, inplace=True)
+    return pdf
+
+
+# Schema metadata (columns, primary key, existence) is cached per
+# table, since it only changes when tables are created or altered.
+# Call db_invalidate_schema_cache after DDL that was not issued
+# through the helpers below.
+def db_invalidate_schema_cache(tbl_name=None):
+    with this.schema_lock:
+        if tbl_name is None:
+            this.schema_cache.clear()
+        else:
+            this.schema_cache.pop(tbl_name, None)
+
+
+# Only positive results are cached: a missing table (or a table without
+# columns) may be created later, by another process or by raw DDL
+def _schema_info(tbl_name, key, fetch):
+    with this.schema_lock:
+        res = this.schema_cache.get(tbl_name, {}).get(key)
+    if res is None:
+        res = fetch()
+        if res:
+            with this.schema_lock:
+                this.schema_cache.setdefault(tbl_name, {})[key] = res
+    return res
+
+
+def db_table_exists(tbl_name):
+    return _schema_info(tbl_name, 'exists', lambda: len(db_read_cmd(
+        "SELECT table_name FROM information_schema.tables "
+        "WHERE table_schema='public' AND table_name='{0:s}'".
+        format(tbl_name))) > 0)
 
 
 # Create a database table if it doesn't exist
@@ -41,11 +553,9 @@ def db_create_missing_table(tbl_name, sql_create_tbl_cmd):
     if tbl_name is None or tbl_name == '':
         print('No table name specified for create request')
         return
-    res = db_read_cmd("SELECT table_name FROM information_schema.tables "
-                      "WHERE table_schema='public' AND table_name='{0:s}'".
-                      format(tbl_name))
-    if not res:
+    if not db_table_exists(tbl_name):
         db_write_cmd(sql_create_tbl_cmd.format(tbl_name))
+        db_invalidate_schema_cache(tbl_name)
 
 
 # Create a database table if it doesn't exist
@@ -56,42 +566,44 @@ def db_create_table_like(tbl_name, new_tbl_name):
     if new_tbl_name is None or new_tbl_name == '':
         print('Empty new_tbl_name parameter for db_create_table_like request')
         return
-    res = db_read_cmd("SELECT table_name FROM information_schema.tables "
-                      "WHERE table_schema='public' AND table_name='{0:s}'".
-                      format(tbl_name))
     if tbl_name == new_tbl_name:
         print('Cannot create a table like itself')
         return
-    if not res:
+    if not db_table_exists(tbl_name):
         print("Table {0:s} does not exist".format(tbl_name))
         return
-    res = db_read_cmd("SELECT table_name FROM information_schema.tables "
-                      "WHERE table_schema='public' AND table_name='{0:s}'".
-                      format(new_tbl_name))
-    if not not res:
+    if db_table_exists(new_tbl_name):
         print("Table {0:s} already exists".format(new_tbl_name))
         return
     res = db_write_cmd("SELECT create_table_like('{0:s}', '{1:s}')".
                        format(tbl_name, new_tbl_name))
+    db_invalidate_schema_cache(new_tbl_name)
 
 
+# Return (name, type, max length, precision, scale) for each column
 def db_get_table_columns(tbl_name):
-    res = db_read_cmd("select column_name,udt_name,character_maximum_length,"
-                      "numeric_precision,numeric_scale from "
-                      "INFORMATION_SCHEMA.COLUMNS where table_name='{0:s}'".
-                      format(tbl_name))
-    return res
+    return _schema_info(tbl_name, 'columns', lambda: db_read_cmd(
+        "select column_name,udt_name,character_maximum_length,"
+        "numeric_precision,numeric_scale from "
+        "INFORMATION_SCHEMA.COLUMNS where table_name='{0:s}' "
+        "order by ordinal_position".format(tbl_name)))
 
 
-def db_get_key_len(tbl_name):
-    res = db_read_cmd(
+# Return (name, type) for each primary key column, in key order
+def db_get_key_cols(tbl_name):
+    return _schema_info(tbl_name, 'key', lambda: db_read_cmd(
         "SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS data_type "
         "FROM   pg_index i "
         "JOIN   pg_attribute a ON a.attrelid = i.indrelid "
         "AND a.attnum = ANY(i.indkey) "
         "WHERE  i.indrelid = '{0:s}'::regclass "
-        "AND    i.indisprimary".format(tbl_name))
-    return len(res)
+        "AND    i.indisprimary "
+        "ORDER BY array_position(i.indkey::int2[], a.attnum)".
+        format(tbl_name)))
+
+
+def db_get_key_len(tbl_name):
+    return len(db_get_key_cols(tbl_name))
 
 
 # Upload data from a file.  Prior to updating, verify that there
@@ -121,6 +633,38 @@ def db_upload_file(file_name, tbl_name, sep='\t'):
         db_write_cmd("COPY {0:s} FROM '{1:s}'".format(tbl_name, file_name))
 
 
+# Upload an iterable of sep-separated lines in a table, streaming them
+# with COPY FROM STDIN, without a temporary file on the DB server.
+# Duplicate primary keys are removed in one pass: only the first
+# occurrence of each key is uploaded (only the keys are kept in
+# memory, not the lines).  Returns the number of lines uploaded.
+def db_upload_lines(lines, tbl_name, sep='\t'):
+    key_len = db_get_key_len(tbl_name)
+    keys = set()
+
+    def clean_lines():
+        for line in lines:
+            tokens = [x.strip() for x in line.strip().split(sep)]
+            if tokens == ['']:
+                continue
+            key = '\t'.join(tokens[:key_len])
+            if key in keys:
+                continue
+            keys.add(key)
+            yield '\t'.join(tokens) + '\n'
+    copy_stream = _CopyStream(clean_lines())
+    with closing(db_get_cnx().cursor()) as crs:
+        crs.copy_expert(f'COPY {tbl_name} FROM STDIN', copy_stream)
+    return copy_stream.num_lines
+
+
+# Streaming version of db_upload_file: the file is read line by line
+# and is not modified
+def db_stream_upload_file(file_name, tbl_name, sep='\t'):
+    with open(file_name, 'r') as f:
+        return db_upload_lines(f, tbl_name, sep)
+
+
 # Return sql string for specific timeframe between start date (sd) and
 # end date (ed).  If either start or end date is None this will return
 # everything before end date (if sd is None),or everything after start
@@ -137,15 +681,10 @@ def db_sql_timeframe(sd, ed, include_and):
     return res
 
 
-def db_insert_eods(record_list):                    
-    with db_get_cnx().cursor() as crs:
-        for rec in record_list:
-            crs.execute(
-                'insert into eods values ' +
-                crs.mogrify('(%s,%s,%s,%s,%s,%s,%s,%s)', rec) +
-                'on conflict on constraint eods_pkey do update set '
-                'o=excluded.o, hi=excluded.hi, lo=excluded.lo, c=excluded.c, '
-                'v=excluded.v, oi=excluded.oi')
+def db_insert_eods(record_list):
+    db_bulk_upsert('eods', record_list, ['stk', 'dt'],
+                   ['o', 'hi', 'lo', 'c', 'v', 'oi'])
+
 
 # if the upsert_columns parameter is [] (default) then the data should
 # contain values for all the table columns; the case when
@@ -165,3 +704,112 @@ def db_upsert_multiple_records(table_name, record_list, conflict_resolution,
         args_str = ', '.join(args)
         crs.execute(f"INSERT INTO {table_name} VALUES {args_str} "
                     f"{conflict_resolution}")
+
+
+# Format a value for a text-format COPY stream
+def _copy_value(x):
+    if x is None:
+        return '\\N'
+    if isinstance(x, bool):
+        return 't' if x else 'f'
+    if isinstance(x, (dict, list)):
+        x = json.dumps(x)
+    return str(x).replace('\\', '\\\\').replace('\t', '\\t').\
+        replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Read-only file-like object that feeds an iterator of text lines to
+# copy_expert() without building the whole payload in memory
+class _CopyStream(io.RawIOBase):
+    def __init__(self, lines):
+        self.lines = lines
+        self.buf = b''
+        self.num_lines = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines).encode('utf-8')
+                self.num_lines += 1
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        res, self.buf = self.buf[:size], self.buf[size:]
+        return res
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+# Upsert a (possibly very large) list of records in a table.  The
+# records are streamed with COPY FROM STDIN into a temporary table
+# that is merged into tbl_name with a single INSERT ... ON CONFLICT.
+# Records contain values for all the columns in cols (by default all
+# the table columns, in table order).  Rows with a key already in the
+# table update update_cols (by default, all the non-key columns); if
+# update_cols is [], those rows are left unchanged.  The upsert runs in
+# its own transaction, or in the transaction of cnx, if specified (see
+# db_transaction).  Returns the number of records uploaded and the
+# throughput, in rows/sec.
+def db_bulk_upsert(tbl_name, record_list, key_cols, update_cols=None,
+                   cols=None, cnx=None):
+    t0 = time.perf_counter()
+    if cols is None:
+        cols = [x[0] for x in db_get_table_columns(tbl_name)]
+    if update_cols is None:
+        update_cols = [x for x in cols if x not in key_cols]
+    tmp_tbl = f'tmp_{tbl_name}_{os.getpid()}_{threading.get_ident()}'
+    col_list = ', '.join(cols)
+    lines = ('\t'.join([_copy_value(x) for x in rec]) + '\n'
+             for rec in record_list)
+    copy_stream = _CopyStream(lines)
+    if update_cols:
+        conflict_resolution = 'DO UPDATE SET {0:s}'.format(', '.join(
+            [f'{x}=EXCLUDED.{x}' for x in update_cols]))
+    else:
+        conflict_resolution = 'DO NOTHING'
+
+    def upsert(cnx):
+        with closing(cnx.cursor()) as crs:
+            # only the uploaded columns, without the NOT NULL
+            # constraints of the columns that are not uploaded;
+            # copy_ix numbers the records in COPY order
+            crs.execute(f'CREATE TEMP TABLE {tmp_tbl} ON COMMIT DROP '
+                        f'AS SELECT {col_list} FROM {tbl_name} '
+                        'WITH NO DATA')
+            crs.execute(f'ALTER TABLE {tmp_tbl} '
+                        'ADD COLUMN copy_ix BIGSERIAL')
+            crs.copy_expert(f'COPY {tmp_tbl} ({col_list}) FROM STDIN',
+                            copy_stream)
+            # a record list may contain the same key more than once;
+            # keep only the last occurrence of each key
+            crs.execute(
+                f'INSERT INTO {tbl_name} ({col_list}) '
+                f'SELECT DISTINCT ON ({", ".join(key_cols)}) {col_list} '
+                f'FROM {tmp_tbl} ORDER BY {", ".join(key_cols)}, '
+                f'copy_ix DESC ON CONFLICT ({", ".join(key_cols)}) '
+                f'{conflict_resolution}')
+            crs.execute(f'DROP TABLE {tmp_tbl}')
+    if cnx is not None:
+        upsert(cnx)
+    else:
+        with db_cnx() as cnx:
+            cnx.autocommit = False
+            try:
+                upsert(cnx)
+                cnx.commit()
+            except Exception:
+                cnx.rollback()
+                raise
+            finally:
+                cnx.autocommit = True
+    num_recs = copy_stream.num_lines
+    elapsed = time.perf_counter() - t0
+    rows_per_sec = num_recs / elapsed if elapsed > 0 else 0
+    logging.info(f'Upserted {num_recs} records in {tbl_name} in '
+                 f'{elapsed:.3f} seconds ({rows_per_sec:.0f} rows/sec)')
+    return num_recs, rows_per_sec
@@ -0,0 +1,115 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from psycopg2 import extensions
+import stxdb
+import sys
+import threading
+
+# asyncio front end for stxdb.  Each call runs on a worker thread that
+# checks its own connection out of the stxdb pool and returns it when
+# the call is done, so independent queries (or whole functions issuing
+# queries) can run concurrently, and a page waits only for the slowest
+# of them instead of for their sum.
+#
+#   portfolio, watchlist = stxdbasync.run_all(
+#       stxdbasync.run_db(get_portfolio, mkt_name, '*', mkt_dt),
+#       stxdbasync.read_cmd(watchlist_sql))
+
+this = sys.modules[__name__]
+this.executor = None
+# one event loop, running on a background thread, for all the run_all
+# calls
+this.loop = None
+this.loop_lock = threading.Lock()
+
+
+# The worker threads use at most pool_max - 1 connections.  The threads
+# calling run_all return their pinned connections to the pool while
+# they wait (see run_all), so that the workers can use them; the spare
+# connection is left for a caller that is in a transaction.
+def get_executor():
+    with this.loop_lock:
+        if this.executor is None:
+            this.executor = ThreadPoolExecutor(
+                max_workers=max(1, stxdb.pool_max - 1),
+                thread_name_prefix='stxdb')
+    return this.executor
+
+
+def get_loop():
+    with this.loop_lock:
+        if this.loop is None or this.loop.is_closed():
+            this.loop = asyncio.new_event_loop()
+            threading.Thread(target=this.loop.run_forever,
+                             name='stxdb-loop', daemon=True).start()
+    return this.loop
+
+
+def _call(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        stxdb.db_release_cnx()
+
+
+# Run any function that uses stxdb on a worker thread with its own
+# pooled connection
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(_call, fn, args, kwargs))
+
+
+async def read_cmd(sql):
+    return await run_db(stxdb.db_read_cmd, sql)
+
+
+async def write_cmd(sql):
+    return await run_db(stxdb.db_write_cmd, sql)
+
+
+async def read_frame(query, engine='polars', index_col=None):
+    return await run_db(stxdb.db_read_frame, query, engine, index_col)
+
+
+async def exec_prepared(name, params=()):
+    return await run_db(stxdb.db_exec_prepared, name, params)
+
+
+async def _gather(aws):
+    return await asyncio.gather(*aws)
+
+
+# Return the connection pinned to the calling thread to the pool,
+# unless the caller has a transaction in progress on it
+def _release_caller_cnx():
+    cnx = stxdb.thread_cnx.get(threading.get_ident())
+    if cnx is not None and (cnx.closed or cnx.get_transaction_status() ==
+                            extensions.TRANSACTION_STATUS_IDLE):
+        stxdb.db_release_cnx()
+
+
+# Entry point for synchronous code (e.g. a Flask view): run the
+# awaitables concurrently, on the shared event loop, and return their
+# results, in order.  The caller does not hold a pooled connection while
+# it waits; it gets a new one the next time it calls db_get_cnx().
+def run_all(*aws):
+    _release_caller_cnx()
+    return asyncio.run_coroutine_threadsafe(_gather(aws),
+                                            get_loop()).result()
+
+
+# Call fn(x) for each x in xs concurrently; return the results in order
+def map_db(fn, xs):
+    return run_all(*[run_db(fn, x) for x in xs])
+
+
+def shutdown():
+    with this.loop_lock:
+        if this.loop is not None:
+            this.loop.call_soon_threadsafe(this.loop.stop)
+            this.loop = None
+        if this.executor is not None:
+            this.executor.shutdown()
+            this.executor = None
@@ -19,9 +19,11 @@ import shutil
 import stxcal
 import stxdb
 import stxgrps
+import stxstore
 from stxidx import StxIndex
+from stxjl import invalidate_jl_checkpoints
 from stxsplits import StxGetSplits
-from stxts import StxTS
+from stxts import StxTS, invalidate_ts_cache
 import subprocess
 import sys
 import traceback as tb
@@ -99,7 +101,7 @@ class StxDatafeed:
     # some quality checks on the data: do not upload days where volume
     # is 0, or where the open/close are outside the [low, high] range.
     def load_eoddata_file(self, ifname, dt, dtc, stks='', batch=False):
-        upload_lines = []
+        upload_lines, upload_stks = [], set()
         stk_list = [] if stks == '' else stks.split(',')
         # db_stx, _ = self.create_exchange()
         with open(ifname, 'r') as ifile:
@@ -126,6 +128,7 @@ class StxDatafeed:
             v = v // 1000
             if v == 0:
                 v = 1
+            upload_stks.add(stk)
             if batch:
                 upload_lines.append(
                     '{0:s}\t{1:s}\t{2:d}\t{3:d}\t{4:d}\t{5:d}\t{6:d}\t0\n'.
@@ -133,12 +136,10 @@ class StxDatafeed:
             else:
                 upload_lines.append([stk, dt, o, hi, lo, c, v, 0])
         if batch:
-            with open(self.eod_name, 'w') as f:
-                for line in upload_lines:
-                    f.write(line)
-            stxdb.db_upload_file(self.eod_name, self.eod_tbl, '\t')
+            stxdb.db_upload_lines(upload_lines, self.eod_tbl, '\t')
         else:
             stxdb.db_insert_eods(upload_lines)
+        invalidate_ts_cache(self.eod_tbl, upload_stks)
 
     def handle_splits(self, start_date):
         # Get the most recent splits file
@@ -198,7 +199,7 @@ class StxDatafeed:
         print(f'Uploading stocks from file {splits_file}')
         with open(splits_file, 'r') as f:
             lines = f.readlines()
-        num = 0
+        num, split_stks = 0, set()
         for line in lines:
             tokens = line.split()
             if len(tokens) < 3:
@@ -213,9 +214,12 @@ class StxDatafeed:
             try:
                 stxdb.db_write_cmd(db_cmd)
                 num += 1
+                split_stks.add(stk)
             except Exception as ex:
                 print(f'Failed to upload split {stk}, {dt}, error {str(ex)}')
         print(f'Uploaded {num} out of {len(lines)} stock splits')
+        invalidate_ts_cache(self.divi_tbl, split_stks)
+        invalidate_jl_checkpoints(split_stks)
         q = sql.Composed([
             sql.SQL("UPDATE analyses SET dt="),
             sql.Literal(splits_date),
@@ -535,6 +539,7 @@ class StxDatafeed:
                 'lo = EXCLUDED.lo, c = EXCLUDED.c, v = EXCLUDED.v, '
                 'oi = EXCLUDED.oi')
             logging.info('Uploaded data into eods table')
+        invalidate_ts_cache('eods', valid_stx_df['stk'].unique().tolist())
         last_upload_date = valid_stx_df['dt'].max()
         stxdb.db_write_cmd("UPDATE analyses SET dt='{0:s}' WHERE "
                            "analysis='eod_datafeed'".format(last_upload_date))
@@ -697,6 +702,19 @@ class StxDatafeed:
             os.rename(stooq_file, archive_file)
             logging.info(f'Moved {stooq_file} into {archive_file}')
 
+    # Append the new eod and intraday data to the local store, for the
+    # tables that were already copied there (see stxstore)
+    def sync_store(self, tables=('eods', 'intraday')):
+        for tbl in tables:
+            if not stxstore.has_table(tbl):
+                continue
+            try:
+                num_rows = stxstore.sync(tbl)
+                logging.info(f'Synced {num_rows} {tbl} rows in the store')
+            except:
+                logging.error(f'Failed to sync the {tbl} store')
+                tb.print_exc()
+
     def get_profile_count(self, dt):
         profile_count = 0
         logging.info(f'Checking if sectors, industries and stock profiles '
@@ -733,6 +751,11 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--intraday_date',
                         help='Particular date to parse from intraday file',
                         type=str)
+    parser.add_argument('-g', '--gap_audit', action='store_true',
+                        help='Report the EOD data gaps for all the tickers')
+    parser.add_argument('-m', '--max_gap',
+                        help='Minimum business days missing in a gap',
+                        type=int, default=20)
     args = parser.parse_args()
     logging.basicConfig(
         format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] - '
@@ -746,6 +769,15 @@ if __name__ == '__main__':
             logging.info(f' for this date: {args.intraday_date}')
         sdf = StxDatafeed()
         sdf.parse_stooq_intraday(args.intraday_file, args.intraday_date)
+        sdf.sync_store(['intraday'])
+        sys.exit(0)
+    if args.gap_audit:
+        gaps_df = StxTS.gap_audit(max_gap=args.max_gap)
+        gaps_file = os.path.join(args.data_dir, 'eod_gaps.csv')
+        gaps_df.to_csv(gaps_file, index=False)
+        logging.info(f'Found {len(gaps_df)} gaps longer than {args.max_gap} '
+                     f'business days for {gaps_df["stk"].nunique()} '
+                     f'tickers, saved them in {gaps_file}')
         sys.exit(0)
     logging.info('Getting index (S&P500, Nasdaq, Dow Jones) quotes')
     si = StxIndex()
@@ -766,6 +798,7 @@ if __name__ == '__main__':
     splits_start_date = str(res[0][0]) if res else '2000-01-01'
     sdf.parse_stooq_eod(start_date)
     sdf.parse_stooq_intraday()
+    sdf.sync_store()
     last_expiry = stxcal.prev_expiry(str(datetime.datetime.now().date()))
     profile_count = sdf.get_profile_count(last_expiry)
     if profile_count < 5000:
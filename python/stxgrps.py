@@ -399,11 +399,8 @@ def insert_data_in_db(df, indicator_name, as_of_date):
          x.get('rank'), x.get('bucket_rank'), json.dumps(info))
         for x, info in zip(recs, infos)
     ]
-    conflict_resolution = 'on conflict on constraint indicators_1_pkey do ' \
-        'update set value=excluded.value, rank=excluded.rank, ' \
-        'bucket_rank=excluded.bucket_rank, info=excluded.info'
-    stxdb.db_upsert_multiple_records('indicators_1', data_to_insert,
-                                     conflict_resolution)  
+    stxdb.db_bulk_upsert('indicators_1', data_to_insert,
+                         ['ticker', 'dt', 'name'])
 
 def get_value_dataframe(df, sector_or_industry):
     # groupby to calc mean, median, std for each sector/industry
@@ -5,6 +5,7 @@ import logging
 import requests
 import stxcal
 import stxdb
+from stxts import invalidate_ts_cache
 
 
 class StxIndex:
@@ -89,6 +90,8 @@ class StxIndex:
                 f"o={o}, hi={hi}, lo={lo}, c={c}, v={v}, oi=0"
             ])
             stxdb.db_write_cmd(db_cmd)
+        if date_list:
+            invalidate_ts_cache('eods', [idx])
         logging.info(f'Updated {len(date_list)} records for {idx}')
 
 
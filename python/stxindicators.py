@@ -62,7 +62,7 @@ def filter(
         sql.SQL(" ORDER BY rg_pct DESC"),
     ])
     logging.info(f"leader SQL = {q.as_string(stxdb.db_get_cnx())}")
-    df = pl.read_database(q, stxdb.db_get_cnx())
+    df = stxdb.db_read_frame(q)
     stk_list = df["stk"].unique().to_list()
     for i_name, i_value in filter_criteria[1:]:
         q = sql.Composed([
@@ -78,7 +78,7 @@ def filter(
             sql.SQL(" AND bucket_rank>=" if i_value >= 0 else " AND bucket_rank<="),
             sql.Literal(abs(i_value)),
         ])
-        dfi = pl.read_database(q, stxdb.db_get_cnx())
+        dfi = stxdb.db_read_frame(q)
         if len(dfi) == 0:
             df = dfi
             break
@@ -1,10 +1,25 @@
+import copy
+import logging
 import numpy as np
 import pandas as pd
+from psycopg2 import sql
 from recordclass import recordclass
+import stxcal
+import stxdb
 from stxts import StxTS
 import sys
 
+this = sys.modules[__name__]
 JLPivot = recordclass('JLPivot', 'dt, state, price, rg')
+# JL checkpoints (see StxJL.get_state), one per ticker and factor; as in
+# jl_setups, the factors are stored as percentages
+this.jl_checkpoints_tbl = 'jl_checkpoints'
+this.sql_create_jl_checkpoints = 'CREATE TABLE {0:s}( '\
+    'stk VARCHAR(16) NOT NULL, '\
+    'factor INTEGER NOT NULL, '\
+    'dt DATE NOT NULL, '\
+    'state JSONB NOT NULL, '\
+    'PRIMARY KEY(stk, factor))'
 
 
 class StxJL:
@@ -22,259 +37,480 @@ class StxJL:
     DT_fmt = '\x1b[1;31;40m'
     UP_piv_fmt = '\x1b[4;32;40m'  # '4;30;42'
     DN_piv_fmt = '\x1b[4;31;40m'  # '4;37;41'
+    px_cols = ['rg', 'price', 'price2', 'p1_px', 'lns_px']
+    no_row = -(1 << 62)  # p1_dt, lns_dt value when there is no date
     # UP_piv_fmt = '\x1b[0;30;42m' # '4;30;42'
     # DN_piv_fmt = '\x1b[0;37;41m' # '4;37;41'
 
-    def __init__(self, ts, f, w=20):
+    # f is a factor, or a list of factors that jl() calculates together,
+    # in one pass over the prices; the results for each factor are in
+    # view(f), and this object is the view of the first factor.
+    # checkpoint is a state returned by get_state ({factor: state} for a
+    # list of factors), from which jl() resumes if it is still valid.
+    def __init__(self, ts, f, w=20, checkpoint=None):
+        if isinstance(f, (list, tuple)):
+            factors = list(dict.fromkeys(f))
+        else:
+            factors, checkpoint = [f], {f: checkpoint}
         self.ts = ts
-        self.f = f
         self.w = w
         self.cols = ['dt', 'rg', 'state', 'price', 'pivot', 'state2',
                      'price2', 'pivot2', 'p1_dt', 'p1_px', 'p1_s',
                      'lns_dt', 'lns_px', 'lns_s', 'lns', 'ls_s', 'ls']
         self.col_ix = dict(zip(self.cols, range(0, len(self.cols))))
-        self.jl_recs = []
-        self.jl_recs.append(self.cols)
-        self.jlix = {}  # map dates to indices in JL records list (jl_rec)
-        self.jl_ix = 0  # current index in the jlix table
-        self.last = {'prim_px': 0, 'prim_state': StxJL.Nil, 'px': 0,
-                     'state': StxJL.Nil}
-        self.ts.df['hb4l'] = self.ts.df.apply(
-            lambda r: 1 if 2*r['c'] < r['hi']+r['lo'] else 0, axis=1)
-
+        self.ts.df['hb4l'] = (2 * self.ts.df['c'] <
+                              self.ts.df['hi'] + self.ts.df['lo']).astype(int)
+        self.hb4l = self.ts.df['hb4l'].values.tolist()
+        self.views = {}
+        for fctr in factors:
+            view = copy.copy(self) if self.views else self
+            view.f = fctr
+            view.checkpoint = (checkpoint or {}).get(fctr)
+            view.resumed = False
+            view.last = {'prim_px': 0, 'prim_state': StxJL.Nil, 'px': 0,
+                         'state': StxJL.Nil}
+            view.init_recs(0)
+            self.views[fctr] = view
+            if view is not self:
+                view.views = {fctr: view}
+
+    # The JL calculation for factor f
+    def view(self, f):
+        return self.views[f]
+
+    # The JL records are stored in preallocated NumPy columns, one row
+    # per day starting with self.jl_start; the p1_dt and lns_dt columns
+    # hold row numbers (these can be negative, for records resumed from
+    # a checkpoint, or no_row for no date).  The fields that are carried
+    # over from one record to the next are also kept as attributes.
+    # The prices in px_cols are not adjusted when a split is reached:
+    # each record keeps the number of splits before it (its epoch), and
+    # the prices are adjusted when they are read (see px_factors).
+    def init_recs(self, num_recs):
+        self.recs = {}
+        for col in self.cols[1:]:
+            dtype = np.float64 if col in StxJL.px_cols else np.int64
+            self.recs[col] = np.zeros(num_recs, dtype=dtype)
+        self.epochs = np.zeros(num_recs, dtype=np.int64)
+        self.split_fs = []
+        self.num_recs = 0
+        self.jl_start = self.ts.start
+        self.p1_dt, self.p1_px, self.p1_s = StxJL.no_row, 0, StxJL.Nil
+        self.lns_dt, self.lns_px, self.lns_s = StxJL.no_row, 0, StxJL.Nil
+        self.lns, self.ls_s, self.ls = StxJL.Nil, StxJL.Nil, StxJL.Nil
+
+    # The JL records in the original list of lists format: a header row
+    # with the column names, followed by one list per day
+    @property
+    def jl_recs(self):
+        n = self.num_recs
+        dts = self.rec_dates()
+        cols = {col: x.tolist() for col, x in self.rec_cols(0, n).items()}
+        cols['dt'] = dts
+        for col in ['p1_dt', 'lns_dt']:
+            cols[col] = [dts[x] if 0 <= x < n else self.row_date(x)
+                         for x in cols[col]]
+        return [self.cols] + [list(x) for x in
+                              zip(*[cols[col] for col in self.cols])]
+
+    # Split adjustment factors of the prices in the records between rows
+    # lo and hi: the prices of a record written after e splits are
+    # multiplied by the ratios of the splits starting with split e
+    def px_factors(self, lo=0, hi=None):
+        hi = self.num_recs if hi is None else hi
+        scale = np.ones(len(self.split_fs) + 1)
+        if self.split_fs:
+            scale[:-1] = np.cumprod(self.split_fs[::-1])[::-1]
+        return scale[self.epochs[lo: hi]]
+
+    # The record columns between rows lo and hi, with split adjusted
+    # prices
+    def rec_cols(self, lo=0, hi=None):
+        hi = self.num_recs if hi is None else hi
+        fs = self.px_factors(lo, hi)
+        return {col: x[lo: hi] * fs if col in StxJL.px_cols else x[lo: hi]
+                for col, x in self.recs.items()}
+
+    def rec_dates(self, lo=0, hi=None):
+        hi = self.num_recs if hi is None else hi
+        ixs = self.ts.df.index.values[self.jl_start + lo: self.jl_start + hi]
+        return np.datetime_as_string(ixs, unit='D').tolist()
+
+    def row_date(self, row):
+        if row == StxJL.no_row:
+            return ''
+        pos = self.jl_start + row
+        if 0 <= pos < self.ts.l:
+            return str(self.ts.df.index[pos].date())
+        return stxcal.move_busdays(self.ts.sd_str, pos)
+
+    def date_row(self, dt):
+        if dt == '':
+            return StxJL.no_row
+        return int(stxcal.num_busdays(self.ts.sd_str, dt)) - self.jl_start
+
+    # The prices after the initial window are read from the unadjusted
+    # data, since the adjusted price on the current day is always equal
+    # to the unadjusted one; instead of moving the time series one day
+    # at a time, only the JL records are adjusted, on split days.
+    # Calculate the JL records up to dt for all the factors.  The prices,
+    # the splits and the average true range are shared by all the
+    # factors, and calculated only once.
     def jl(self, dt):
         self.ts.set_day(dt, -1)
         end = self.ts.pos
-        start_w = self.initjl()
-        # print('jl(): start_w={0:d}'.format(start_w))
+        start_w = self.resume(end)
+        if start_w is None:
+            start_w = self.initjl()
         for ixx in range(start_w, end + 1):
-            self.ts.next_day()
+            self.pos = ixx
             self.nextjl()
+        for view in self.views.values():
+            view.share_data(self)
+        if self.ts.pos != end:
+            self.ts.set_day(str(self.ts.df.index[end].date()))
         return self.jl_recs
 
     def initjl(self):
-        ss = self.ts.start
-        w1 = self.ts.pos - ss + 1
+        ss, end = self.ts.start, self.ts.pos
+        w1 = end - ss + 1
         win = self.w if w1 >= self.w else w1
-        self.ts.set_day(str(self.ts.df.index[ss+win-1].date()))
-        # print('initjl: ss={0:d} w1={1:d} win={2:d} set_day:{3:s}'.
-        #       format(ss, w1, win, str(self.ts.df.index[ss+win-1].date())))
-        df_0 = self.ts.df[ss: ss + win]
-        max_dt = df_0['hi'].idxmax()
-        min_dt = df_0['lo'].idxmin()
-        hi = df_0.loc[max_dt].hi
-        lo = df_0.loc[min_dt].lo
-        self.trs = []
-        self.trs.append(df_0.iloc[0].hi - df_0.iloc[0].lo)
-        for h, l, c_1 in zip(df_0['hi'].values[1:], df_0['lo'].values[1:],
-                             df_0['c'].values[:-1]):
-            self.trs.append(max(h, c_1) - min(l, c_1))
+        self.load_prices(ss + win - 1)
+        hi_0 = np.array(self.hi[ss: ss + win])
+        lo_0 = np.array(self.lo[ss: ss + win])
+        c_1 = np.array(self.c[ss: ss + win - 1])
+        max_ix = int(np.argmax(hi_0))
+        min_ix = int(np.argmin(lo_0))
+        hi = self.hi[ss + max_ix]
+        lo = self.lo[ss + min_ix]
+        # circular buffer of the true ranges, and their running sum
+        self.trs = [hi_0[0] - lo_0[0]] + (np.maximum(hi_0[1:], c_1) -
+                                          np.minimum(lo_0[1:], c_1)).tolist()
+        self.trs = [float(x) for x in self.trs]
+        self.tr_ix = 0
+        self.tr_sum = sum(self.trs)
         self.avg_rg = np.mean(self.trs)
-        # assign hi to SRa, NRa, UT, m_NRa, and lo to SRe, NRe, DT, m_NRe
-        self.lp = [hi, hi, hi, lo, lo, lo, hi, lo]
-        for ixx in range(0, len(df_0)):
-            dtc = df_0.index[ixx]
-            dtcs = str(dtc.date())
-            self.jlix[dtcs] = ixx + 1
-            if dtc == max_dt and dtc == min_dt:
-                self.rec_day(StxJL.NRa, StxJL.NRe, self.ts.start + ixx)
-            elif dtc == max_dt:
-                self.rec_day(StxJL.NRa, StxJL.Nil, self.ts.start + ixx)
-            elif dtc == min_dt:
-                self.rec_day(StxJL.Nil, StxJL.NRe, self.ts.start + ixx)
-            else:
-                self.rec_day(StxJL.Nil, StxJL.Nil, self.ts.start + ixx)
+        for view in self.views.values():
+            view.share_data(self)
+            view.init_recs(end - ss + 1)
+            # assign hi to SRa, NRa, UT, m_NRa, and lo to SRe, NRe, DT,
+            # m_NRe
+            view.lp = [hi, hi, hi, lo, lo, lo, hi, lo]
+            for ixx in range(0, win):
+                view.pos = ss + ixx
+                if ixx == max_ix and ixx == min_ix:
+                    view.rec_day(StxJL.NRa, StxJL.NRe)
+                elif ixx == max_ix:
+                    view.rec_day(StxJL.NRa, StxJL.Nil)
+                elif ixx == min_ix:
+                    view.rec_day(StxJL.Nil, StxJL.NRe)
+                else:
+                    view.rec_day(StxJL.Nil, StxJL.Nil)
         return self.ts.start + win
 
-    def init_first_rec(self, dt):
-        return {'dt': dt, 'rg': self.avg_rg, 'state': StxJL.Nil, 'price': 0,
-                'pivot': 0, 'state2': StxJL.Nil, 'price2': 0, 'pivot2': 0,
-                'p1_dt': '', 'p1_px': 0, 'p1_s': StxJL.Nil, 'lns_dt': '',
-                'lns_px': 0, 'lns_s': StxJL.Nil, 'lns': StxJL.Nil,
-                'ls_s': StxJL.Nil, 'ls': StxJL.Nil}
-
-    def init_rec(self, dt, list_ix):
-        # print("init_rec: list_ix = {0:d}, dt = {1:s}".format(list_ix, dt))
-        prev = self.jl_recs[list_ix]
-        return {'dt': dt, 'rg': self.avg_rg, 'state': StxJL.Nil, 'price': 0,
-                'pivot': 0, 'state2': StxJL.Nil, 'price2': 0, 'pivot2': 0,
-                'p1_dt': prev[self.col_ix['p1_dt']],
-                'p1_px': prev[self.col_ix['p1_px']],
-                'p1_s': prev[self.col_ix['p1_s']],
-                'lns_dt': prev[self.col_ix['lns_dt']],
-                'lns_px': prev[self.col_ix['lns_px']],
-                'lns': prev[self.col_ix['lns']],
-                'lns_s': prev[self.col_ix['lns_s']],
-                'ls': prev[self.col_ix['ls']],
-                'ls_s': prev[self.col_ix['ls_s']]}
-
-    def rec_day(self, sh, sl, ixx=-1):
-        if ixx == -1:
-            ixx = self.ts.pos
-        sr = self.ts.df.iloc[ixx]
-        dtc = str(self.ts.df.index[ixx].date())
-        lix = ixx - self.ts.start
-        # print("lix = %d" % lix)
-        dd = self.init_first_rec(dtc) if lix == 0 else self.init_rec(dtc, lix)
+    # Use the prices, the splits and the true ranges of view src
+    def share_data(self, src):
+        self.hi, self.lo, self.c = src.hi, src.lo, src.c
+        self.split_ratios = src.split_ratios
+        self.trs, self.tr_ix, self.tr_sum = src.trs, src.tr_ix, src.tr_sum
+        self.avg_rg = src.avg_rg
+
+    # Prices as of position pos; the splits after pos are applied as
+    # they are reached (see nextjl)
+    def load_prices(self, pos):
+        self.ts.set_day(str(self.ts.df.index[pos].date()))
+        self.hi = self.ts.df['hi'].values.tolist()
+        self.lo = self.ts.df['lo'].values.tolist()
+        self.c = self.ts.df['c'].values.tolist()
+        self.split_ratios = {}
+        for k, v in self.ts.splits.items():
+            ixx = self.ts.find(str(k.date()))
+            if ixx > pos:
+                self.split_ratios[ixx] = v[0]
+
+    # The splits up to dt, used to check that the prices did not change
+    # since a checkpoint was taken
+    def split_list(self, dt):
+        return [[str(k.date()), float(v[0])]
+                for k, v in sorted(self.ts.splits.items())
+                if str(k.date()) <= dt]
+
+    # Serializable JL state as of the last record: everything needed to
+    # resume the calculation on the next day.  The records that are
+    # kept start with the oldest of the last lns record and of the
+    # records with the last num_pivs pivots.  Prices are split adjusted
+    # as of the last record date.
+    def get_state(self, num_pivs=10):
+        n, r = self.num_recs, self.recs
+        lo = n - 1
+        rows = np.nonzero((r['pivot'][:n] == 1) | (r['pivot2'][:n] == 1))[0]
+        if len(rows) > 0:
+            lo = min(lo, int(rows[max(len(rows) - num_pivs, 0)]))
+        if 0 <= self.lns_dt < lo:
+            lo = self.lns_dt
+        recs = {col: x.tolist() for col, x in self.rec_cols(lo, n).items()}
+        recs['dt'] = self.rec_dates(lo, n)
+        for col in ['p1_dt', 'lns_dt']:
+            recs[col] = [self.row_date(x) for x in recs[col]]
+        return {
+            'dt': recs['dt'][-1], 'f': self.f, 'w': self.w,
+            'last': {k: float(v) if k.endswith('px') else int(v)
+                     for k, v in self.last.items()},
+            'lp': [float(x) for x in self.lp],
+            'trs': [float(x) for x in self.trs],
+            'tr_ix': int(self.tr_ix), 'tr_sum': float(self.tr_sum),
+            'avg_rg': float(self.avg_rg),
+            'p1_dt': self.row_date(self.p1_dt), 'p1_px': float(self.p1_px),
+            'p1_s': int(self.p1_s), 'lns_dt': self.row_date(self.lns_dt),
+            'lns_px': float(self.lns_px), 'lns_s': int(self.lns_s),
+            'lns': int(self.lns), 'ls_s': int(self.ls_s), 'ls': int(self.ls),
+            'splits': self.split_list(recs['dt'][-1]), 'recs': recs}
+
+    # Restore the states of all the factors from their checkpoints.  The
+    # checkpoints are used only if all of them are valid, and were taken
+    # on the same date.  Returns the next position to calculate, or None.
+    def resume(self, end):
+        views = list(self.views.values())
+        states = [view.checkpoint for view in views]
+        for view in views:
+            view.checkpoint = None
+            view.resumed = False
+        if None in states:
+            return None
+        cp_pos = self.ts.find(states[0]['dt'])
+        if not all(view.valid_state(state, cp_pos, end)
+                   for view, state in zip(views, states)):
+            return None
+        self.load_prices(cp_pos)
+        for view, state in zip(views, states):
+            view.restore(state, cp_pos, end)
+            view.resumed = True
+        for view in views:
+            view.share_data(self)
+        return cp_pos + 1
+
+    # A state saved by get_state is valid for the time series if its date
+    # is at position cp_pos, in the same date range as the end position,
+    # and the splits up to that date did not change
+    def valid_state(self, state, cp_pos, end):
+        recs = state['recs']
+        jl_start = cp_pos - len(recs['dt']) + 1
+        return state['w'] == self.w and state['f'] == self.f and \
+            self.ts.find(state['dt']) == cp_pos and \
+            self.ts.start <= cp_pos <= end and jl_start >= 0 and \
+            str(self.ts.df.index[jl_start].date()) == recs['dt'][0] and \
+            state['splits'] == self.split_list(state['dt'])
+
+    def restore(self, state, cp_pos, end):
+        recs = state['recs']
+        jl_start = cp_pos - len(recs['dt']) + 1
+        self.init_recs(end - jl_start + 1)
+        self.jl_start = jl_start
+        for col, x in self.recs.items():
+            if col in ['p1_dt', 'lns_dt']:
+                x[: len(recs[col])] = [self.date_row(y) for y in recs[col]]
+            else:
+                x[: len(recs[col])] = recs[col]
+        self.num_recs = len(recs['dt'])
+        self.last = dict(state['last'])
+        self.lp = list(state['lp'])
+        self.trs = list(state['trs'])
+        self.tr_ix, self.tr_sum = state['tr_ix'], state['tr_sum']
+        self.avg_rg = state['avg_rg']
+        self.p1_dt, self.p1_px, self.p1_s = self.date_row(state['p1_dt']), \
+            state['p1_px'], state['p1_s']
+        self.lns_dt, self.lns_px, self.lns_s = \
+            self.date_row(state['lns_dt']), state['lns_px'], state['lns_s']
+        self.lns, self.ls_s, self.ls = state['lns'], state['ls_s'], \
+            state['ls']
+
+    def rec_day(self, sh, sl):
+        ixx = self.pos
+        lix = ixx - self.jl_start
+        state, price, state2, price2 = StxJL.Nil, 0, StxJL.Nil, 0
         if sh != StxJL.Nil and sl != StxJL.Nil:
-            if sr.hb4l == 1:
-                dd.update({'state': sh, 'price': sr['hi'], 'state2': sl,
-                           'price2': sr['lo']})
+            if self.hb4l[ixx] == 1:
+                state, price, state2, price2 = sh, self.hi[ixx], sl, \
+                    self.lo[ixx]
             else:
-                dd.update({'state': sl, 'price': sr['lo'], 'state2': sh,
-                           'price2': sr['hi']})
+                state, price, state2, price2 = sl, self.lo[ixx], sh, \
+                    self.hi[ixx]
         elif sh != StxJL.Nil:
-            dd.update({'state': sh, 'price': sr['hi']})
+            state, price = sh, self.hi[ixx]
         elif sl != StxJL.Nil:
-            dd.update({'state': sl, 'price': sr['lo']})
+            state, price = sl, self.lo[ixx]
+        pivot = 0
+        if state != StxJL.Nil:
+            self.update_last(state, price, state2, price2)
+            pivot = self.update_lns_pivots(lix, state, price, state2,
+                                           price2)
+        r = self.recs
+        r['rg'][lix] = self.avg_rg
+        r['state'][lix], r['price'][lix], r['pivot'][lix] = \
+            state, price, pivot
+        r['state2'][lix], r['price2'][lix] = state2, price2
+        r['p1_dt'][lix], r['p1_px'][lix], r['p1_s'][lix] = \
+            self.p1_dt, self.p1_px, self.p1_s
+        r['lns_dt'][lix], r['lns_px'][lix], r['lns_s'][lix] = \
+            self.lns_dt, self.lns_px, self.lns_s
+        r['lns'][lix], r['ls_s'][lix], r['ls'][lix] = \
+            self.lns, self.ls_s, self.ls
+        self.epochs[lix] = len(self.split_fs)
+        self.num_recs = lix + 1
+
+    def update_last(self, state, price, state2, price2):
+        if state2 == StxJL.Nil:
+            self.last['px'] = price
+            self.last['state'] = state
+            if self.primary(state):
+                self.last['prim_px'] = price
+                self.last['prim_state'] = state
+            self.lp[state] = price
         else:
-            pass  # nothing to do, the record is already initialized
-        if dd['state'] != StxJL.Nil:
-            self.update_last(dd)
-            self.update_lns_pivots(dd, lix)
-        lst = [dd[col] for col in self.cols]
-        self.jl_recs.append(lst)
-        self.jlix[dtc] = lix + 1
-
-    def update_last(self, dd):
-        if dd['state2'] == StxJL.Nil:
-            if dd['state'] != StxJL.Nil:
-                self.last['px'] = dd['price']
-                self.last['state'] = dd['state']
-                if self.primary(dd['state']):
-                    self.last['prim_px'] = dd['price']
-                    self.last['prim_state'] = dd['state']
-                self.lp[dd['state']] = dd['price']
-        else:
-            self.last['px'] = dd['price2']
-            self.last['state'] = dd['state2']
-            self.lp[dd['state2']] = dd['price2']
-            self.lp[dd['state']] = dd['price']
-            if self.primary(dd['state2']):
-                self.last['prim_px'] = dd['price2']
-                self.last['prim_state'] = dd['state2']
-            elif self.primary(dd['state']):
-                self.last['prim_px'] = dd['price']
-                self.last['prim_state'] = dd['state']
-
-    def update_lns_pivots(self, dd, list_ix):
-        if (self.up(dd['state']) and self.dn(dd['lns'])) or \
-           (self.dn(dd['state']) and self.up(dd['lns'])):
-            self.update_pivot_diff_day(dd)
-        if dd['state'] != StxJL.Nil:
-            dd['ls_s'] = dd['ls']
-            dd['ls'] = dd['state']
-        if self.primary(dd['state']):
-            dd['lns_dt'] = dd['dt']
-            dd['lns_px'] = dd['price']
-            dd['lns_s'] = dd['lns']
-            dd['lns'] = dd['state']
-        if (self.up(dd['state2']) and self.dn(dd['lns'])) or \
-           (self.dn(dd['state2']) and self.up(dd['lns'])):
-            if dd['lns_dt'] == dd['dt']:
-                dd['pivot'] = 1
-                dd['p1_dt'] = dd['dt']
-                dd['p1_px'] = dd['price']
-                dd['p1_s'] = dd['state']
+            self.last['px'] = price2
+            self.last['state'] = state2
+            self.lp[state2] = price2
+            self.lp[state] = price
+            if self.primary(state2):
+                self.last['prim_px'] = price2
+                self.last['prim_state'] = state2
+            elif self.primary(state):
+                self.last['prim_px'] = price
+                self.last['prim_state'] = state
+
+    # Returns the pivot flag of the current record
+    def update_lns_pivots(self, lix, state, price, state2, price2):
+        pivot = 0
+        if (self.up(state) and self.dn(self.lns)) or \
+           (self.dn(state) and self.up(self.lns)):
+            self.update_pivot_diff_day()
+        if state != StxJL.Nil:
+            self.ls_s = self.ls
+            self.ls = state
+        if self.primary(state):
+            self.lns_dt = lix
+            self.lns_px = price
+            self.lns_s = self.lns
+            self.lns = state
+        if (self.up(state2) and self.dn(self.lns)) or \
+           (self.dn(state2) and self.up(self.lns)):
+            if self.lns_dt == lix:
+                pivot = 1
+                self.p1_dt = lix
+                self.p1_px = price
+                self.p1_s = state
             else:
-                self.update_pivot_diff_day(dd)
-        if dd['state2'] != StxJL.Nil:
-            dd['ls_s'] = dd['ls']
-            dd['ls'] = dd['state2']
-        if self.primary(dd['state2']):
-            dd['lns_dt'] = dd['dt']
-            dd['lns_px'] = dd['price2']
-            dd['lns_s'] = dd['lns']
-            dd['lns'] = dd['state2']
-
-    def update_pivot_diff_day(self, dd):
-        # print(self.jlix)
-        piv_rec = self.jl_recs[self.jlix[dd['lns_dt']]]
-        if self.primary(piv_rec[self.col_ix['state2']]):
-            piv_rec[self.col_ix['pivot2']] = 1
-            dd['p1_px'] = piv_rec[self.col_ix['price2']]
-            dd['p1_s'] = piv_rec[self.col_ix['state2']]
+                self.update_pivot_diff_day()
+        if state2 != StxJL.Nil:
+            self.ls_s = self.ls
+            self.ls = state2
+        if self.primary(state2):
+            self.lns_dt = lix
+            self.lns_px = price2
+            self.lns_s = self.lns
+            self.lns = state2
+        return pivot
+
+    def update_pivot_diff_day(self):
+        r, piv_ix = self.recs, self.lns_dt
+        px_f = self.px_factors(piv_ix, piv_ix + 1)[0]
+        if self.primary(r['state2'][piv_ix]):
+            r['pivot2'][piv_ix] = 1
+            self.p1_px = float(r['price2'][piv_ix] * px_f)
+            self.p1_s = int(r['state2'][piv_ix])
         else:
-            piv_rec[self.col_ix['pivot']] = 1
-            dd['p1_px'] = piv_rec[self.col_ix['price']]
-            dd['p1_s'] = piv_rec[self.col_ix['state']]
-        dd['p1_dt'] = dd['lns_dt']
+            r['pivot'][piv_ix] = 1
+            self.p1_px = float(r['price'][piv_ix] * px_f)
+            self.p1_s = int(r['state'][piv_ix])
+        self.p1_dt = self.lns_dt
 
+    # Advance the JL calculations of all the factors by one day, then
+    # update the average true range
     def nextjl(self):
-        dtc = self.ts.current_date()
-        split_info = self.ts.splits.get(pd.Timestamp(dtc))
-        if split_info is not None:
-            self.adjust_for_splits(split_info[0])
+        ratio = self.split_ratios.get(self.pos)
+        if ratio is not None:
+            self.trs[:] = [x * ratio for x in self.trs]
+            self.tr_sum = sum(self.trs)
+        for view in self.views.values():
+            view.pos = self.pos
+            view.avg_rg = self.avg_rg
+            if ratio is not None:
+                view.adjust_for_splits(ratio)
+            view.next_state()
+        hi, lo = self.hi[self.pos], self.lo[self.pos]
+        c_1 = self.c[self.pos - 1]
+        if ratio is not None:
+            c_1 = c_1 * ratio
+        tr = max(hi, c_1) - min(lo, c_1)
+        self.tr_sum += tr - self.trs[self.tr_ix]
+        self.trs[self.tr_ix] = tr
+        self.tr_ix = (self.tr_ix + 1) % len(self.trs)
+        if self.tr_ix == 0:  # limit the rounding errors of the running sum
+            self.tr_sum = sum(self.trs)
+        self.avg_rg = self.tr_sum / len(self.trs)
+
+    def next_state(self):
         fctr = self.f * self.avg_rg
+        hi, lo = self.hi[self.pos], self.lo[self.pos]
         if self.last['state'] == StxJL.SRa:
-            self.sRa(fctr)
+            self.sRa(fctr, hi, lo)
         elif self.last['state'] == StxJL.NRa:
-            self.nRa(fctr)
+            self.nRa(fctr, hi, lo)
         elif self.last['state'] == StxJL.UT:
-            self.uT(fctr)
+            self.uT(fctr, hi, lo)
         elif self.last['state'] == StxJL.DT:
-            self.dT(fctr)
+            self.dT(fctr, hi, lo)
         elif self.last['state'] == StxJL.NRe:
-            self.nRe(fctr)
+            self.nRe(fctr, hi, lo)
         elif self.last['state'] == StxJL.SRe:
-            self.sRe(fctr)
-        self.trs.pop(0)
-        sr = self.ts.df.iloc[self.ts.pos]
-        sr_1 = self.ts.df.iloc[self.ts.pos - 1]
-        self.trs.append(max(sr.hi, sr_1.c) - min(sr.lo, sr_1.c))
-        self.avg_rg = np.mean(self.trs)
+            self.sRe(fctr, hi, lo)
 
+    # The record prices are adjusted when read (see px_factors)
     def adjust_for_splits(self, ratio):
         for ixx in range(0, len(self.lp)):
             self.lp[ixx] = self.lp[ixx] * ratio
-        for jlr in self.jl_recs[1:]:
-            jlr[self.col_ix['rg']] = jlr[self.col_ix['rg']] * ratio
-            jlr[self.col_ix['price']] = jlr[self.col_ix['price']] * ratio
-            jlr[self.col_ix['price2']] = jlr[self.col_ix['price2']] * ratio
-            jlr[self.col_ix['p1_px']] = jlr[self.col_ix['p1_px']] * ratio
-            jlr[self.col_ix['lns_px']] = jlr[self.col_ix['lns_px']] * ratio
+        self.split_fs.append(ratio)
+        self.p1_px = self.p1_px * ratio
+        self.lns_px = self.lns_px * ratio
         self.last['prim_px'] = self.last['prim_px'] * ratio
         self.last['px'] = self.last['px'] * ratio
-        self.trs[:] = [x * ratio for x in self.trs]
 
-    def sRa(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def sRa(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.UT] < r.hi:
+        if self.lp[StxJL.UT] < hi:
             sh = StxJL.UT
-        elif self.lp[StxJL.m_NRa] + fctr < r.hi:
+        elif self.lp[StxJL.m_NRa] + fctr < hi:
             if self.last['prim_state'] in [StxJL.NRa, StxJL.UT]:
-                sh = StxJL.UT if r.hi > self.last['prim_px'] else StxJL.SRa
+                sh = StxJL.UT if hi > self.last['prim_px'] else StxJL.SRa
             else:
                 sh = StxJL.UT
-        elif self.lp[StxJL.NRa] < r.hi and self.last['prim_state'] != StxJL.UT:
+        elif self.lp[StxJL.NRa] < hi and self.last['prim_state'] != StxJL.UT:
             sh = StxJL.NRa
-        elif self.lp[StxJL.SRa] < r.hi:
+        elif self.lp[StxJL.SRa] < hi:
             sh = StxJL.SRa
         if self.up(sh) and self.dn(self.last['prim_state']):
             self.lp[StxJL.m_NRe] = self.last['prim_px']
-        if r.lo < self.lp[StxJL.SRa] - 2 * fctr:
-            if self.lp[StxJL.NRe] < r.lo:
+        if lo < self.lp[StxJL.SRa] - 2 * fctr:
+            if self.lp[StxJL.NRe] < lo:
                 sl = StxJL.SRe
             else:
-                sl = StxJL.DT if(r.lo < self.lp[StxJL.DT] or
-                                 r.lo < self.lp[StxJL.m_NRe] - fctr) \
+                sl = StxJL.DT if(lo < self.lp[StxJL.DT] or
+                                 lo < self.lp[StxJL.m_NRe] - fctr) \
                     else StxJL.NRe
                 if self.up(self.last['prim_state']):
                     self.lp[StxJL.m_NRa] = self.last['prim_px']
         self.rec_day(sh, sl)
 
-    def nRa(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def nRa(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.UT] < r.hi or self.lp[StxJL.m_NRa] + fctr < r.hi:
+        if self.lp[StxJL.UT] < hi or self.lp[StxJL.m_NRa] + fctr < hi:
             sh = StxJL.UT
-        elif self.lp[StxJL.NRa] < r.hi:
+        elif self.lp[StxJL.NRa] < hi:
             sh = StxJL.NRa
-        if r.lo < self.lp[StxJL.NRa] - 2 * fctr:
-            if self.lp[StxJL.NRe] < r.lo:
+        if lo < self.lp[StxJL.NRa] - 2 * fctr:
+            if self.lp[StxJL.NRe] < lo:
                 sl = StxJL.SRe
-            elif r.lo < self.lp[StxJL.DT] or r.lo < self.lp[StxJL.m_NRe] - fctr:
+            elif lo < self.lp[StxJL.DT] or lo < self.lp[StxJL.m_NRe] - fctr:
                 sl = StxJL.DT
             else:
                 sl = StxJL.NRe
@@ -282,68 +518,64 @@ class StxJL:
                 self.lp[StxJL.m_NRa] = self.lp[StxJL.NRa]
         self.rec_day(sh, sl)
 
-    def uT(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def uT(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.UT] < r.hi:
+        if self.lp[StxJL.UT] < hi:
             sh = StxJL.UT
-        if r.lo <= self.lp[StxJL.UT] - 2 * fctr:
-            sl = StxJL.DT if (r.lo < self.lp[StxJL.DT] or
-                              r.lo < self.lp[StxJL.m_NRe] - fctr) \
+        if lo <= self.lp[StxJL.UT] - 2 * fctr:
+            sl = StxJL.DT if (lo < self.lp[StxJL.DT] or
+                              lo < self.lp[StxJL.m_NRe] - fctr) \
                 else StxJL.NRe
             self.lp[StxJL.m_NRa] = self.lp[StxJL.UT]
         self.rec_day(sh, sl)
 
-    def sRe(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def sRe(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.DT] > r.lo:
+        if self.lp[StxJL.DT] > lo:
             sl = StxJL.DT
-        elif self.lp[StxJL.m_NRe] - fctr > r.lo:
+        elif self.lp[StxJL.m_NRe] - fctr > lo:
             if self.last['prim_state'] in [StxJL.NRe, StxJL.DT]:
-                sl = StxJL.DT if r.lo < self.last['prim_px'] else StxJL.SRe
+                sl = StxJL.DT if lo < self.last['prim_px'] else StxJL.SRe
             else:
                 sl = StxJL.DT
-        elif self.lp[StxJL.NRe] > r.lo and self.last['prim_state'] != StxJL.DT:
+        elif self.lp[StxJL.NRe] > lo and self.last['prim_state'] != StxJL.DT:
             sl = StxJL.NRe
-        elif self.lp[StxJL.SRe] > r.lo:
+        elif self.lp[StxJL.SRe] > lo:
             sl = StxJL.SRe
         if self.dn(sl) and self.up(self.last['prim_state']):
             self.lp[StxJL.m_NRa] = self.last['prim_px']
-        if r.hi > self.lp[StxJL.SRe] + 2 * fctr:
-            if self.lp[StxJL.NRa] > r.hi:
+        if hi > self.lp[StxJL.SRe] + 2 * fctr:
+            if self.lp[StxJL.NRa] > hi:
                 sh = StxJL.SRa
             else:
-                sh = StxJL.UT if(r.hi > self.lp[StxJL.UT] or
-                                 r.hi > self.lp[StxJL.m_NRa] + fctr) \
+                sh = StxJL.UT if(hi > self.lp[StxJL.UT] or
+                                 hi > self.lp[StxJL.m_NRa] + fctr) \
                                  else StxJL.NRa
                 if self.dn(self.last['prim_state']):
                     self.lp[StxJL.m_NRe] = self.last['prim_px']
         self.rec_day(sh, sl)
 
-    def dT(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def dT(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.DT] > r.lo:
+        if self.lp[StxJL.DT] > lo:
             sl = StxJL.DT
-        if r.hi >= self.lp[StxJL.DT] + 2 * fctr:
-            sh = StxJL.UT if (r.hi > self.lp[StxJL.UT] or
-                              r.hi > self.lp[StxJL.m_NRa] + fctr) \
+        if hi >= self.lp[StxJL.DT] + 2 * fctr:
+            sh = StxJL.UT if (hi > self.lp[StxJL.UT] or
+                              hi > self.lp[StxJL.m_NRa] + fctr) \
                 else StxJL.NRa
             self.lp[StxJL.m_NRe] = self.lp[StxJL.DT]
         self.rec_day(sh, sl)
 
-    def nRe(self, fctr):
-        r = self.ts.df.iloc[self.ts.pos]
+    def nRe(self, fctr, hi, lo):
         sh, sl = StxJL.Nil, StxJL.Nil
-        if self.lp[StxJL.DT] > r.lo or self.lp[StxJL.m_NRe] - fctr > r.lo:
+        if self.lp[StxJL.DT] > lo or self.lp[StxJL.m_NRe] - fctr > lo:
             sl = StxJL.DT
-        elif self.lp[StxJL.NRe] > r.lo:
+        elif self.lp[StxJL.NRe] > lo:
             sl = StxJL.NRe
-        if r.hi > self.lp[StxJL.NRe] + 2 * fctr:
-            if self.lp[StxJL.NRa] > r.hi:
+        if hi > self.lp[StxJL.NRe] + 2 * fctr:
+            if self.lp[StxJL.NRa] > hi:
                 sh = StxJL.SRa
-            elif r.hi > self.lp[StxJL.UT] or r.hi > self.lp[StxJL.m_NRa] + fctr:
+            elif hi > self.lp[StxJL.UT] or hi > self.lp[StxJL.m_NRa] + fctr:
                 sh = StxJL.UT
             else:
                 sh = StxJL.NRa
@@ -441,47 +673,35 @@ class StxJL:
                        '' if not print_dbg else self.jlr_print2(jlr))
         print(output)
 
-    def get_num_pivots(self, num_pivs):
-        ixx = -1
-        end = -len(self.jl_recs)
+    # Pivots in the records between rows lo and hi, in chronological
+    # order (the pivot of a record comes before its pivot2)
+    def get_pivots(self, lo, hi):
+        r = self.recs
+        rows = np.nonzero((r['pivot'][lo: hi] == 1) |
+                          (r['pivot2'][lo: hi] == 1))[0] + lo
+        dts = self.rec_dates()
+        fs = self.px_factors(lo, hi)
         pivs = []
-        while len(pivs) < num_pivs and ixx >= end:
-            jlr = self.jl_recs[ixx]
-            if jlr[self.col_ix['pivot2']] == 1:
-                pivs.append(JLPivot(jlr[self.col_ix['dt']],
-                                    jlr[self.col_ix['state2']],
-                                    jlr[self.col_ix['price2']],
-                                    jlr[self.col_ix['rg']]))
-            if len(pivs) < num_pivs and jlr[self.col_ix['pivot']] == 1:
-                pivs.append(JLPivot(jlr[self.col_ix['dt']],
-                                    jlr[self.col_ix['state']],
-                                    jlr[self.col_ix['price']],
-                                    jlr[self.col_ix['rg']]))
-            ixx -= 1
-        pivs.reverse()
+        for ixx in rows.tolist():
+            px_f = fs[ixx - lo]
+            for sfx in ['', '2']:
+                if r[f'pivot{sfx}'][ixx] == 1:
+                    pivs.append(JLPivot(dts[ixx], int(r[f'state{sfx}'][ixx]),
+                                        float(r[f'price{sfx}'][ixx] * px_f),
+                                        float(r['rg'][ixx] * px_f)))
         return pivs
 
+    def get_num_pivots(self, num_pivs):
+        n = self.num_recs
+        r = self.recs
+        rows = np.nonzero((r['pivot'][:n] == 1) | (r['pivot2'][:n] == 1))[0]
+        lo = rows[-num_pivs] if len(rows) >= num_pivs else 0
+        pivs = self.get_pivots(lo, n)
+        return pivs[max(len(pivs) - num_pivs, 0):] if num_pivs > 0 else []
+
     def get_pivots_in_days(self, num_days):
-        ixx = -1
-        end = -len(self.jl_recs)
-        pivs = []
-        if end < -num_days:
-            end = -num_days
-        while ixx > end:
-            jlr = self.jl_recs[ixx]
-            if jlr[self.col_ix['pivot2']] == 1:
-                pivs.append(JLPivot(jlr[self.col_ix['dt']],
-                                    jlr[self.col_ix['state2']],
-                                    jlr[self.col_ix['price2']],
-                                    jlr[self.col_ix['rg']]))
-            if jlr[self.col_ix['pivot']] == 1:
-                pivs.append(JLPivot(jlr[self.col_ix['dt']],
-                                    jlr[self.col_ix['state']],
-                                    jlr[self.col_ix['price']],
-                                    jlr[self.col_ix['rg']]))
-            ixx -= 1
-        pivs.reverse()
-        return pivs
+        n = self.num_recs
+        return self.get_pivots(n - min(n, max(num_days - 1, 0)), n)
 
     def print_pivs(self, pivs):
         output = ''
@@ -491,14 +711,20 @@ class StxJL:
         print(output)
 
     def last_rec(self, col_name, ixx=1):
-        if ixx > len(self.jl_recs):
-            ixx = len(self.jl_recs)
-        jlr = self.jl_recs[-ixx]
+        if ixx > self.num_recs:
+            ixx = self.num_recs
+        row = self.num_recs - ixx
         if col_name in ['state', 'price', 'pivot']:
-            col_name2 = '{0:s}2'.format(col_name)
-            if jlr[self.col_ix['state2']] != StxJL.Nil:
-                return jlr[self.col_ix[col_name2]]
-        return jlr[self.col_ix[col_name]]
+            if self.recs['state2'][row] != StxJL.Nil:
+                col_name = '{0:s}2'.format(col_name)
+        if col_name == 'dt':
+            return self.row_date(row)
+        res = self.recs[col_name][row].item()
+        if col_name in ['p1_dt', 'lns_dt']:
+            return self.row_date(res)
+        if col_name in StxJL.px_cols:
+            res *= self.px_factors(row, row + 1)[0].item()
+        return res
 
     def get_html_formatted_price(self, piv, pivot): # state, pivot, price):
         res = '<tr><td>{0:s}</td>'.format(piv.dt)
@@ -523,13 +749,87 @@ class StxJL:
         html_table += '</table>'
         return html_table
 
+    # Report for the first factor (if factor is a list) with a valid JL
+    # calculation.  All the factors are calculated in one pass; if that
+    # fails, the factors are calculated one at a time, until one works.
     @classmethod
     def jl_report(cls, stk, start_date, end_date, factor):
         ts = StxTS(stk, start_date, end_date)
-        jl = StxJL(ts, factor)
-        jlres = jl.jl(end_date)
-        pivs = jl.get_num_pivots(4)
-        return jl.html_report(pivs)
+        factors = list(factor) if isinstance(factor, (list, tuple)) \
+            else [factor]
+        jl = None
+        if len(factors) > 1:
+            try:
+                jl = StxJL(ts, factors)
+                jl.jl(end_date)
+            except Exception as ex:
+                logging.error(f'{stk} JL({factors}) calc failed: {ex}')
+                jl = None
+        for fctr in factors:
+            try:
+                if jl is not None:
+                    view = jl.view(fctr)
+                else:
+                    view = StxJL(ts, fctr)
+                    view.jl(end_date)
+                pivs = view.get_num_pivots(4)
+                return view.html_report(pivs)
+            except Exception:
+                if fctr == factors[-1]:
+                    raise
+                logging.error(f'{stk} JL({fctr}) calc failed')
+
+
+# The saved JL states of a list of tickers, for a list of factors, as a
+# dictionary {(stk, factor): state}
+def load_jl_checkpoints(stks, factors):
+    if not stks or not stxdb.db_table_exists(this.jl_checkpoints_tbl):
+        return {}
+    fctrs = {int(round(100 * x)): x for x in factors}
+    q = sql.Composed([
+        sql.SQL('SELECT stk, factor, state FROM '),
+        sql.Identifier(this.jl_checkpoints_tbl),
+        sql.SQL(' WHERE stk IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in stks]),
+        sql.SQL(') AND factor IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in fctrs]),
+        sql.SQL(')')
+    ])
+    res = stxdb.db_read_cmd(q.as_string(stxdb.db_get_cnx()))
+    return {(x[0], fctrs[x[1]]): x[2] for x in res}
+
+
+# Save the JL states in a list of (stk, factor, state) tuples.  If cnx
+# is specified, the states are saved in its transaction, and the table
+# must already exist (see create_jl_checkpoints_table).
+def save_jl_checkpoints(states, cnx=None):
+    if not states:
+        return
+    if cnx is None:
+        create_jl_checkpoints_table()
+    stxdb.db_bulk_upsert(
+        this.jl_checkpoints_tbl,
+        [(stk, int(round(100 * f)), state['dt'], state)
+         for stk, f, state in states],
+        ['stk', 'factor'], cols=['stk', 'factor', 'dt', 'state'], cnx=cnx)
+
+
+def create_jl_checkpoints_table():
+    stxdb.db_create_missing_table(this.jl_checkpoints_tbl,
+                                  this.sql_create_jl_checkpoints)
+
+
+# Remove the saved JL states of stks, when their price history changed
+def invalidate_jl_checkpoints(stks):
+    if not stks or not stxdb.db_table_exists(this.jl_checkpoints_tbl):
+        return
+    q = sql.Composed([
+        sql.SQL('DELETE FROM '), sql.Identifier(this.jl_checkpoints_tbl),
+        sql.SQL(' WHERE stk IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in stks]),
+        sql.SQL(')')
+    ])
+    stxdb.db_write_cmd(q.as_string(stxdb.db_get_cnx()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,210 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+import logging
+import os
+from psycopg2 import sql
+import stxcal
+import stxdb
+from stxjl import StxJL, create_jl_checkpoints_table, load_jl_checkpoints, \
+    save_jl_checkpoints
+from stxts import StxTS
+import sys
+import time
+
+this = sys.modules[__name__]
+# Universe-wide JL: the last pivots of every ticker, for each factor,
+# are saved in the jl_pivots table, so that reports and screens do not
+# need to recalculate them.  As in jl_setups, the factors are stored as
+# percentages (150 for 1.5).  Prices and ranges are in cents, split
+# adjusted as of the asof date.
+this.jl_pivots_tbl = 'jl_pivots'
+this.sql_create_jl_pivots = 'CREATE TABLE {0:s}( '\
+    'stk VARCHAR(16) NOT NULL, '\
+    'factor INTEGER NOT NULL, '\
+    'dt DATE NOT NULL, '\
+    'state SMALLINT NOT NULL, '\
+    'price INTEGER NOT NULL, '\
+    'rg INTEGER NOT NULL, '\
+    'asof DATE NOT NULL, '\
+    'PRIMARY KEY(stk, factor, dt, state))'
+
+
+# Tickers to analyze on date dt: all the tickers with prices in eods
+# on that date, or the leaders for the next expiry
+def get_universe(dt, universe='eods'):
+    if universe == 'leaders':
+        q = sql.Composed([
+            sql.SQL('SELECT stk FROM leaders WHERE expiry='),
+            sql.Literal(stxcal.next_expiry(dt, min_days=1))
+        ])
+    else:
+        q = sql.Composed([
+            sql.SQL('SELECT DISTINCT stk FROM eods WHERE dt='),
+            sql.Literal(dt)
+        ])
+    res = stxdb.db_read_cmd(q.as_string(stxdb.db_get_cnx()))
+    return sorted([x[0] for x in res])
+
+
+# Each worker process uses one DB connection of its own (db_init_pool
+# drops the connections inherited from the parent process)
+def init_worker():
+    stxdb.db_init_pool(1, 1)
+
+
+# Calculate the JL pivots for a chunk of tickers, and replace the
+# pivots of these tickers in the database.  The prices for the whole
+# chunk are loaded with one query, and all the factors of a ticker are
+# calculated in one pass.  The JL calculation resumes from the saved
+# checkpoints; if all the factors of a ticker have one, only the
+# prices starting with the oldest checkpoint record are loaded.  The
+# pivots and the checkpoints of the tickers that were analyzed are
+# replaced in one transaction.  Returns the number of tickers analyzed,
+# the number of pivots saved, and the tickers that failed.
+def jl_chunk(stks, dt, factors, num_days, num_pivs):
+    sd = stxcal.move_busdays(dt, -num_days)
+    checkpoints = load_jl_checkpoints(stks, factors)
+    sds = {}
+    for stk in stks:
+        states = [checkpoints.get((stk, f)) for f in factors]
+        sds[stk] = sd if None in states else \
+            max(sd, min(x['recs']['dt'][0] for x in states))
+    try:
+        ts_dict = StxTS.bulk_load(stks, sds, dt)
+    except Exception as ex:
+        logging.warning(f'Bulk load failed ({ex}), loading the tickers '
+                        'one by one')
+        ts_dict = {}
+        for stk in stks:
+            try:
+                ts_dict[stk] = StxTS(stk, sds[stk], dt)
+            except Exception:
+                pass
+    lines, failed = [], [x for x in stks if x not in ts_dict]
+    num_stks, states = 0, []
+    for stk, ts in ts_dict.items():
+        try:
+            jl = StxJL(ts, list(factors), checkpoint={
+                f: checkpoints.get((stk, f)) for f in factors})
+            jl.jl(dt)
+            if not jl.resumed and sds[stk] != sd:
+                # invalid checkpoints: recalculate the whole history
+                jl = StxJL(StxTS(stk, sd, dt), list(factors))
+                jl.jl(dt)
+            for factor in factors:
+                view = jl.view(factor)
+                states.append((stk, factor, view.get_state(num_pivs)))
+                for piv in view.get_num_pivots(num_pivs):
+                    lines.append(f'{stk}\t{int(round(100 * factor))}\t'
+                                 f'{piv.dt}\t{piv.state}\t'
+                                 f'{int(round(piv.price))}\t'
+                                 f'{int(round(piv.rg))}\t{dt}\n')
+            num_stks += 1
+        except Exception as ex:
+            logging.error(f'{stk}: JL calculation failed: {ex}')
+            failed.append(stk)
+    done_stks = [x for x in stks if x not in failed]
+    if not done_stks:
+        return 0, 0, failed
+    q = sql.Composed([
+        sql.SQL('DELETE FROM '), sql.Identifier(this.jl_pivots_tbl),
+        sql.SQL(' WHERE stk IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in done_stks]),
+        sql.SQL(') AND factor IN ('),
+        sql.SQL(', ').join([sql.Literal(int(round(100 * x)))
+                            for x in factors]),
+        sql.SQL(')')
+    ])
+    with stxdb.db_transaction() as cnx:
+        with closing(cnx.cursor()) as crs:
+            crs.execute(q.as_string(cnx))
+        num_pivs = stxdb.db_upload_lines(lines, this.jl_pivots_tbl)
+        save_jl_checkpoints(states, cnx)
+    return num_stks, num_pivs, failed
+
+
+# Calculate the JL pivots for all the tickers in the universe, over
+# num_days business days up to dt, and save the last num_pivs pivots
+# for each ticker and factor.  The tickers are distributed to
+# num_workers processes in chunks of chunk_size.
+def jl_pivots(dt, factors=(1.0, 1.5, 2.0, 3.0), universe='eods', stks=None,
+              num_days=500, num_pivs=10, chunk_size=100, num_workers=None):
+    t0 = time.perf_counter()
+    stxdb.db_create_missing_table(this.jl_pivots_tbl,
+                                  this.sql_create_jl_pivots)
+    create_jl_checkpoints_table()
+    if stks is None:
+        stks = get_universe(dt, universe)
+    chunks = [stks[i: i + chunk_size]
+              for i in range(0, len(stks), chunk_size)]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    logging.info(f'{dt}: calculating JL for {len(stks)} tickers, factors '
+                 f'{list(factors)}, in {len(chunks)} chunks, using '
+                 f'{num_workers} processes')
+    num_stks, num_pivots, failed = 0, 0, []
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=init_worker) as executor:
+        futures = [executor.submit(jl_chunk, chunk, dt, factors, num_days,
+                                   num_pivs) for chunk in chunks]
+        for ixx, future in enumerate(as_completed(futures)):
+            try:
+                res = future.result()
+                num_stks += res[0]
+                num_pivots += res[1]
+                failed.extend(res[2])
+            except Exception as ex:
+                logging.error(f'JL chunk failed: {ex}')
+            if (ixx + 1) % 10 == 0:
+                logging.info(f'Processed {ixx + 1}/{len(chunks)} chunks')
+    logging.info(f'{dt}: saved {num_pivots} pivots for {num_stks} tickers '
+                 f'in {time.perf_counter() - t0:.1f} seconds; '
+                 f'{len(failed)} tickers failed')
+    return num_stks, num_pivots, failed
+
+
+# The saved pivots of a list of tickers, for one factor, sorted by
+# ticker and date
+def read_pivots(stks, factor):
+    q = sql.Composed([
+        sql.SQL('SELECT * FROM '), sql.Identifier(this.jl_pivots_tbl),
+        sql.SQL(' WHERE stk IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in stks]),
+        sql.SQL(') AND factor='), sql.Literal(int(round(100 * factor))),
+        sql.SQL(' ORDER BY stk, dt, state')
+    ])
+    return stxdb.db_read_frame(q, engine='pandas')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--date', type=str,
+                        default=stxcal.current_busdate(hr=9),
+                        help='Date for which the JL pivots are calculated')
+    parser.add_argument('-f', '--factors', type=str,
+                        default='1.0,1.5,2.0,3.0',
+                        help='Comma-separated list of JL factors')
+    parser.add_argument('-u', '--universe', type=str, default='eods',
+                        choices=['eods', 'leaders'],
+                        help='All the tickers in eods, or the leaders')
+    parser.add_argument('-s', '--stocks', type=str, default='',
+                        help='Comma-separated list of tickers')
+    parser.add_argument('-n', '--num_days', type=int, default=500,
+                        help='Number of business days in the JL history')
+    parser.add_argument('-p', '--num_pivots', type=int, default=10,
+                        help='Number of pivots saved for each ticker')
+    parser.add_argument('-c', '--chunk_size', type=int, default=100,
+                        help='Number of tickers in each work unit')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of worker processes')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] - '
+        '%(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO
+    )
+    jl_pivots(args.date, [float(x) for x in args.factors.split(',')],
+              args.universe, args.stocks.split(',') if args.stocks else None,
+              args.num_days, args.num_pivots, args.chunk_size, args.workers)
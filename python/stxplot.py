@@ -25,7 +25,11 @@ class StxPlot:
     def loadts(self, stk, start_date, end_date):
         if stk is None:
             return None
-        ts = StxTS(stk, start_date, end_date)
+        return StxPlot.prepare_ts(StxTS(stk, start_date, end_date), end_date)
+
+    # Move ts to end_date, and convert its data frame to mplfinance format
+    @staticmethod
+    def prepare_ts(ts, end_date):
         day_ix = ts.set_day(end_date)
         if day_ix == -1:
             return None
@@ -21,8 +21,7 @@ class StxPlotID:
                 sql.Literal(end_dt),
                 sql.SQL(" ORDER BY dt")
             ])
-            idf = pd.read_sql(q, stxdb.db_get_cnx(), index_col='dt',
-                              parse_dates=['dt'])
+            idf = stxdb.db_read_frame(q, engine='pandas', index_col='dt')
             idf.index.name='Date'
             idf.drop('oi', inplace=True, axis=1)
             idf['o'] /= 100
@@ -0,0 +1,342 @@
+import argparse
+import logging
+import numpy as np
+import os
+import pandas as pd
+from psycopg2 import sql
+import shutil
+import stxcal
+import stxdb
+import sys
+import tempfile
+import threading
+
+this = sys.modules[__name__]
+# Local columnar copy of the eods and intraday tables, used to read the
+# price history without querying the database.  Each ticker has one
+# directory per table, with one raw binary file per column (dt.bin is
+# datetime64, the prices, volume and open interest are int32, with
+# null_val for NULL).  The files are memory-mapped on read, and
+# read_cols returns views of them.  The store is updated by appending
+# the new rows at the end of the files (see sync); dt.bin is written
+# last, so its length is always the number of complete rows.  The
+# ticker directory, <stk>, is a symbolic link to the current
+# generation of the files, <stk>.<suffix>: when the files must be
+# rewritten, a new generation is created, and the link is switched to
+# it with one os.replace, so readers never mix files of two
+# generations.
+this.store_dir = os.getenv(
+    'STX_STORE_DIR', os.path.join(os.path.expanduser('~'), '.stx', 'store'))
+this.store_cols = ['o', 'hi', 'lo', 'c', 'v', 'oi']
+this.sync_chunk_days = {'eods': 250, 'intraday': 5}
+this.null_val = np.iinfo(np.int32).min
+this.maps = {}  # (tbl, stk) -> (dt.bin stat, memory-mapped columns)
+this.maps_lock = threading.Lock()
+
+
+def _dt_type(tbl):
+    return 'datetime64[s]' if tbl.startswith('intraday') else \
+        'datetime64[D]'
+
+
+def _stk_dir(tbl, stk):
+    return os.path.join(this.store_dir, tbl, stk)
+
+
+def _watermark_file(tbl):
+    return os.path.join(this.store_dir, tbl, 'synced')
+
+
+# The store for table tbl exists once it was synced at least once
+def has_table(tbl):
+    return os.path.isfile(_watermark_file(tbl))
+
+
+# Last date (for intraday tables, timestamp) synced for table tbl, or
+# None
+def get_watermark(tbl):
+    if not has_table(tbl):
+        return None
+    with open(_watermark_file(tbl)) as f:
+        return f.read().strip()
+
+
+# Watermark form of a date or timestamp: the date for the eods, the
+# timestamp for the intraday tables, where a date stands for its last
+# second
+def _wm_str(tbl, dt):
+    if not tbl.startswith('intraday'):
+        return str(dt)[:10]
+    ts = pd.Timestamp(dt)
+    if len(str(dt)) <= 10:
+        ts += pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+    return str(ts)
+
+
+# The store has all the data of table tbl up to ed (a date or a
+# timestamp); otherwise, the data must be read from the database.  The
+# eods of the current business day are never current: the C loaders
+# rewrite them during the day, without syncing the store.
+def is_current(tbl, ed):
+    wm = get_watermark(tbl)
+    if wm is None:
+        return False
+    if not tbl.startswith('intraday') and \
+            str(ed)[:10] >= stxcal.current_busdate(hr=0):
+        return False
+    return wm >= _wm_str(tbl, ed)
+
+
+def _set_watermark(tbl, dt):
+    wm_file = _watermark_file(tbl)
+    with open(f'{wm_file}.tmp', 'w') as f:
+        f.write(dt)
+    os.replace(f'{wm_file}.tmp', wm_file)
+
+
+# Memory-map the columns of a ticker; the mappings are reused until the
+# ticker files change.  All the files are opened in the generation
+# directory the link pointed to at the start; if that generation is
+# removed in the meantime, the current one is opened instead.  Returns
+# None if the ticker is not in the store.
+def _open(tbl, stk, num_tries=3):
+    gen_dir = os.path.realpath(_stk_dir(tbl, stk))
+    dt_file = os.path.join(gen_dir, 'dt.bin')
+    try:
+        st = os.stat(dt_file)
+    except FileNotFoundError:
+        if num_tries > 1 and os.path.lexists(_stk_dir(tbl, stk)):
+            return _open(tbl, stk, num_tries - 1)
+        return None
+    key, sig = (tbl, stk), (st.st_ino, st.st_size, st.st_mtime_ns)
+    with this.maps_lock:
+        entry = this.maps.get(key)
+    if entry is not None and entry[0] == sig:
+        return entry[1]
+    n = st.st_size // 8
+    if n == 0:
+        return None
+    try:
+        cols = {'dt': np.memmap(dt_file, dtype=_dt_type(tbl), mode='r',
+                                shape=(n,))}
+        for c in this.store_cols:
+            cols[c] = np.memmap(os.path.join(gen_dir, f'{c}.bin'),
+                                dtype=np.int32, mode='r', shape=(n,))
+    except FileNotFoundError:
+        if num_tries > 1:
+            return _open(tbl, stk, num_tries - 1)
+        raise
+    with this.maps_lock:
+        this.maps[key] = (sig, cols)
+    return cols
+
+
+# Zero-copy read of the data of a ticker between sd and ed (inclusive):
+# returns a dictionary of read-only views of the memory-mapped columns
+# (NULL values are null_val), or None if the ticker is not in the store
+def read_cols(stk, tbl='eods', sd=None, ed=None):
+    cols = _open(tbl, stk)
+    if cols is None:
+        return None
+    dts = cols['dt']
+    lo = 0 if sd is None else \
+        np.searchsorted(dts, np.datetime64(sd).astype(dts.dtype), 'left')
+    hi = len(dts) if ed is None else \
+        np.searchsorted(dts, np.datetime64(ed).astype(dts.dtype), 'right')
+    return {c: x[lo: hi] for c, x in cols.items()}
+
+
+# Same data frame as the one returned by stxdb.db_read_frame for a
+# 'SELECT * FROM tbl' query on a ticker, with dt as index: the columns
+# are int64, or float64 with NaN for NULL if they have NULL values
+def read_frame(stk, tbl='eods', sd=None, ed=None):
+    cols = read_cols(stk, tbl, sd, ed)
+    if cols is None:
+        return None
+    data = {}
+    for c in this.store_cols:
+        nulls = cols[c] == this.null_val
+        data[c] = np.where(nulls, np.nan, cols[c]) if nulls.any() else \
+            cols[c].astype(np.int64)
+    df = pd.DataFrame(data, index=pd.DatetimeIndex(cols['dt'], name='dt'))
+    df.insert(0, 'stk', stk)
+    return df
+
+
+# Switch the ticker link to a new generation directory, and remove the
+# previous generation; readers that mapped its files keep them
+def _switch_gen(tbl, stk, gen_dir):
+    link = _stk_dir(tbl, stk)
+    old_dir = os.path.realpath(link) if os.path.lexists(link) else None
+    if old_dir is not None and not os.path.islink(link):
+        # ticker directory written before generations were used
+        old_dir = f'{link}.old'
+        os.replace(link, old_dir)
+    if os.path.lexists(f'{link}.lnk'):
+        os.remove(f'{link}.lnk')
+    os.symlink(os.path.basename(gen_dir), f'{link}.lnk')
+    os.replace(f'{link}.lnk', link)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _remove_stk(tbl, stk):
+    link = _stk_dir(tbl, stk)
+    if os.path.islink(link):
+        gen_dir = os.path.realpath(link)
+        os.remove(link)
+        shutil.rmtree(gen_dir, ignore_errors=True)
+    else:
+        shutil.rmtree(link, ignore_errors=True)
+
+
+# Append the rows of one ticker.  If the new rows overlap the stored
+# ones, the overlapping rows that did not change are skipped; otherwise,
+# a new generation of the ticker files is written, keeping the stored
+# rows before the first new date.  The files are never truncated in
+# place, as other processes may have mapped them.
+def _append_stk(tbl, stk, dts, cols):
+    stk_dir = os.path.realpath(_stk_dir(tbl, stk))
+    dt_file = os.path.join(stk_dir, 'dt.bin')
+    n = os.path.getsize(dt_file) // 8 if os.path.isfile(dt_file) else 0
+    ix = n
+    if n > 0:
+        old = {'dt': np.memmap(dt_file, dtype=dts.dtype, mode='r',
+                               shape=(n,))}
+        ix = int(np.searchsorted(old['dt'], dts[0], 'left'))
+        m = n - ix
+        if 0 < m <= len(dts):
+            for c in this.store_cols:
+                old[c] = np.memmap(os.path.join(stk_dir, f'{c}.bin'),
+                                   dtype=np.int32, mode='r', shape=(n,))
+            if np.array_equal(old['dt'][ix:], dts[:m]) and all(
+                    np.array_equal(old[c][ix:], cols[c][:m])
+                    for c in this.store_cols):
+                dts, cols, ix = dts[m:], {c: x[m:] for c, x in
+                                          cols.items()}, n
+            del old
+    if ix == n and all(os.path.isfile(os.path.join(stk_dir, f'{c}.bin')) and
+                       os.path.getsize(os.path.join(stk_dir, f'{c}.bin')) ==
+                       4 * n for c in this.store_cols):
+        for c in this.store_cols:
+            with open(os.path.join(stk_dir, f'{c}.bin'), 'ab') as f:
+                cols[c].tofile(f)
+        with open(dt_file, 'ab') as f:
+            dts.tofile(f)
+        return
+    # new generation, with the first ix rows of the current one
+    gen_dir = tempfile.mkdtemp(prefix=f'{stk}.',
+                               dir=os.path.join(this.store_dir, tbl))
+    for c, dtype in [(c, np.int32) for c in this.store_cols] + \
+            [('dt', dts.dtype)]:
+        prefix = np.fromfile(os.path.join(stk_dir, f'{c}.bin'), dtype=dtype,
+                             count=ix) if ix else np.zeros(0, dtype=dtype)
+        with open(os.path.join(gen_dir, f'{c}.bin'), 'wb') as f:
+            prefix.tofile(f)
+            (dts if c == 'dt' else cols[c]).tofile(f)
+    os.chmod(gen_dir, 0o755)
+    _switch_gen(tbl, stk, gen_dir)
+
+
+# Append to the store the rows read from the database.  The rows are
+# sorted by ticker and date.
+def _append(tbl, cols):
+    stks = cols['stk']
+    if len(stks) == 0:
+        return
+    dts = np.asarray(cols['dt']).astype(_dt_type(tbl))
+    vals = {}
+    for c in this.store_cols:
+        x = np.asarray(cols[c], dtype=np.float64)
+        vals[c] = np.where(np.isnan(x), this.null_val, x).astype(np.int32)
+    bounds = np.flatnonzero(stks[1:] != stks[:-1]) + 1
+    for s, e in zip(np.r_[0, bounds], np.r_[bounds, len(stks)]):
+        _append_stk(tbl, stks[s], dts[s: e],
+                    {c: x[s: e] for c, x in vals.items()})
+
+
+# Incremental sync of the store with table tbl: copy the rows starting
+# with the last synced date (or sd, if specified), in chunks of
+# sync_chunk_days business days.  The last synced date is read again,
+# in case its data was updated.  The watermark of the intraday tables
+# is the last timestamp synced.  Returns the number of rows copied.
+def sync(tbl='eods', sd=None):
+    if sd is None:
+        sd = get_watermark(tbl)
+    if sd is None:
+        res = stxdb.db_read_cmd(sql.Composed([
+            sql.SQL('SELECT MIN(dt)::date FROM '), sql.Identifier(tbl)
+        ]).as_string(stxdb.db_get_cnx()))
+        if not res or res[0][0] is None:
+            return 0
+        sd = str(res[0][0])
+    res = stxdb.db_read_cmd(sql.Composed([
+        sql.SQL('SELECT MAX(dt) FROM '), sql.Identifier(tbl)
+    ]).as_string(stxdb.db_get_cnx()))
+    if not res or res[0][0] is None:
+        return 0
+    last_date = str(res[0][0])[:10]
+    last_wm = _wm_str(tbl, pd.Timestamp(res[0][0]))
+    os.makedirs(os.path.join(this.store_dir, tbl), exist_ok=True)
+    chunk_days = this.sync_chunk_days.get(tbl, 250)
+    num_rows = 0
+    crt_date = stxcal.next_busday(stxcal.prev_busday(str(sd)[:10]))
+    while crt_date <= last_date:
+        next_date = stxcal.move_busdays(crt_date, chunk_days)
+        q = sql.Composed([
+            sql.SQL('SELECT stk, dt, '),
+            sql.SQL(', ').join([sql.Identifier(c) for c in this.store_cols]),
+            sql.SQL(' FROM '), sql.Identifier(tbl),
+            sql.SQL(' WHERE dt >= '), sql.Literal(crt_date),
+            sql.SQL(' AND dt < '), sql.Literal(next_date),
+            sql.SQL(' ORDER BY stk, dt')
+        ])
+        cols = stxdb.db_read_frame(q, engine='numpy')
+        _append(tbl, cols)
+        num_rows += len(cols['stk'])
+        _set_watermark(tbl, last_wm if next_date > last_date else
+                       _wm_str(tbl, stxcal.prev_busday(next_date)))
+        logging.info(f'{tbl}: synced {len(cols["stk"])} rows between '
+                     f'{crt_date} and {stxcal.prev_busday(next_date)}')
+        crt_date = next_date
+    return num_rows
+
+
+# Reload all the data of stks from table tbl, after its history was
+# changed in the database
+def rebuild(tbl, stks):
+    stks = list(stks)
+    for stk in stks:
+        _remove_stk(tbl, stk)
+    if not stks:
+        return
+    q = sql.Composed([
+        sql.SQL('SELECT stk, dt, '),
+        sql.SQL(', ').join([sql.Identifier(c) for c in this.store_cols]),
+        sql.SQL(' FROM '), sql.Identifier(tbl), sql.SQL(' WHERE stk IN ('),
+        sql.SQL(', ').join([sql.Literal(x) for x in stks]),
+        sql.SQL(') ORDER BY stk, dt')
+    ])
+    _append(tbl, stxdb.db_read_frame(q, engine='numpy'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tables', type=str, default='eods',
+                        help='Comma-separated list of tables to sync')
+    parser.add_argument('-s', '--start_date', type=str,
+                        help='Sync starting with this date')
+    parser.add_argument('-r', '--rebuild', type=str,
+                        help='Comma-separated list of tickers to reload')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] - '
+        '%(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO
+    )
+    for tbl in args.tables.split(','):
+        if args.rebuild:
+            rebuild(tbl, args.rebuild.split(','))
+        else:
+            sync(tbl, args.start_date)
@@ -1,22 +1,188 @@
+from collections import OrderedDict
+import logging
 import numpy as np
+import os
 import pandas as pd
+from psycopg2 import sql
 import stxdb
 import stxcal
+import stxstore
+import sys
+import threading
+
+this = sys.modules[__name__]
+# Process-wide LRU cache of the data read by StxTS: (stk, table, sd, ed)
+# -> prices data frame, and (stk, table, None, None) -> split records.
+# A request is served from any cached range of the same ticker and
+# table that contains it.  Entries are evicted by size, and invalidated
+# when the datafeed uploads new prices or splits (see
+# invalidate_ts_cache).  Set STX_TS_CACHE_MB=0 to disable the cache.
+this.ts_cache = OrderedDict()
+this.ts_cache_ranges = {}  # (stk, table) -> cached (sd, ed) ranges
+this.ts_cache_bytes = 0
+this.ts_cache_max_bytes = int(float(os.getenv('STX_TS_CACHE_MB', '256')) *
+                              (1 << 20))
+this.ts_cache_lock = threading.Lock()
+this.ts_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+this.ts_cache_channel = 'stx_ts_cache'
+# LISTEN connection of the process that opened it; a forked process
+# opens its own, instead of using the socket of its parent
+this.ts_cache_listener = None
+this.ts_cache_listener_pid = None
+# Default source of the StxTS data: 'db', or 'store' to read the prices
+# from the local columnar store (see stxstore), falling back to the
+# database for the tickers that are not in the store
+this.ts_source = os.getenv('STX_TS_SOURCE', 'db')
+
+
+def _cache_bytes(data):
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True, deep=True).sum())
+    return 100 * (len(data) + 1)
+
+
+# Apply the invalidations that other processes sent since the last call
+def _poll_ts_cache_invalidations():
+    try:
+        if this.ts_cache_listener_pid != os.getpid():
+            # dropped without closing it, the parent is still using it
+            this.ts_cache_listener = None
+        if this.ts_cache_listener is None or this.ts_cache_listener.closed:
+            this.ts_cache_listener = stxdb.db_listen(this.ts_cache_channel)
+            this.ts_cache_listener_pid = os.getpid()
+        payloads = stxdb.db_notifications(this.ts_cache_listener)
+    except Exception as ex:
+        # without notifications, the cache could serve stale data
+        logging.warning(f'Cannot listen for cache invalidations: {ex}')
+        this.ts_cache_listener = None
+        _invalidate()
+        return
+    for payload in payloads:
+        tbl, _, stks = payload.partition(':')
+        _invalidate(None if stks == '*' else set(stks.split(',')), tbl)
+
+
+def _invalidate(stks=None, tbl=None):
+    with this.ts_cache_lock:
+        keys = [k for k in this.ts_cache if (tbl is None or k[1] == tbl) and
+                (stks is None or k[0] in stks)]
+        for key in keys:
+            _cache_remove(key)
+        this.ts_cache_stats['invalidations'] += len(keys)
+
+
+# called with ts_cache_lock held
+def _cache_remove(key):
+    data, num_bytes = this.ts_cache.pop(key)
+    this.ts_cache_bytes -= num_bytes
+    if key[2] is not None:
+        this.ts_cache_ranges[key[:2]].remove(key[2:])
+
+
+# The C loaders (see get_quotes in c/stx_ana.h) delete and upload again
+# the eods of the current business day without invalidating the cache,
+# so the ranges that end on or after that day are not cached
+def _cacheable(ed):
+    return ed is None or ed < stxcal.current_busdate(hr=0)
+
+
+def ts_cache_get(stk, tbl, sd=None, ed=None):
+    if this.ts_cache_max_bytes <= 0 or not _cacheable(ed):
+        return None
+    _poll_ts_cache_invalidations()
+    with this.ts_cache_lock:
+        if sd is None:
+            key = (stk, tbl, None, None)
+        else:
+            key = next(((stk, tbl) + x
+                        for x in this.ts_cache_ranges.get((stk, tbl), [])
+                        if x[0] <= sd and ed <= x[1]), None)
+        if key not in this.ts_cache:
+            this.ts_cache_stats['misses'] += 1
+            return None
+        this.ts_cache_stats['hits'] += 1
+        this.ts_cache.move_to_end(key)
+        data = this.ts_cache[key][0]
+    if sd is None:
+        return list(data)
+    return data.loc[pd.to_datetime(sd): pd.to_datetime(ed)].copy()
+
+
+def ts_cache_put(stk, tbl, data, sd=None, ed=None):
+    if not _cacheable(ed):
+        return
+    num_bytes = _cache_bytes(data)
+    if num_bytes > this.ts_cache_max_bytes:
+        return
+    key = (stk, tbl, sd, ed)
+    with this.ts_cache_lock:
+        if key in this.ts_cache:
+            _cache_remove(key)
+        this.ts_cache[key] = (data.copy() if sd is not None else list(data),
+                              num_bytes)
+        this.ts_cache_bytes += num_bytes
+        if sd is not None:
+            this.ts_cache_ranges.setdefault((stk, tbl), []).append((sd, ed))
+        while this.ts_cache_bytes > this.ts_cache_max_bytes:
+            _cache_remove(next(iter(this.ts_cache)))
+            this.ts_cache_stats['evictions'] += 1
+
+
+# Drop the cached data of stks (all the tickers, if stks is None) from
+# table tbl in this process, and notify the other processes to do the
+# same.  Called by the datafeed after writing new prices or splits.
+def invalidate_ts_cache(tbl, stks=None):
+    if stks is not None:
+        stks = list(stks)
+    _invalidate(None if stks is None else set(stks), tbl)
+    payload = f"{tbl}:{'*' if stks is None else ','.join(stks)}"
+    if len(payload) > 7900:  # postgres notification payload limit
+        payload = f'{tbl}:*'
+    try:
+        stxdb.db_notify(this.ts_cache_channel, payload)
+    except Exception as ex:
+        logging.warning(f'Failed to notify the {tbl} cache invalidation: '
+                        f'{ex}')
+
+
+def ts_cache_info():
+    with this.ts_cache_lock:
+        return dict(this.ts_cache_stats, entries=len(this.ts_cache),
+                    bytes=this.ts_cache_bytes,
+                    max_bytes=this.ts_cache_max_bytes)
 
 
 class StxTS:
     # static variables
     busday_us = pd.tseries.offsets.CDay(holidays=stxcal.get_cal().holidays)
+    adj_cols = ['o', 'hi', 'lo', 'c', 'v']
+    # dividend types for which the volume is also adjusted
+    vol_divi_types = [0, 1, 3, 6]
 
-    def __init__(self, stk, sd, ed, eod_tbl='eods', split_tbl='dividends'):
+    # df and s_lst (the split records) can be provided by the caller
+    # (see bulk_load); otherwise, the prices are read from the source
+    # ('db' or 'store', the default is ts_source)
+    def __init__(self, stk, sd, ed, eod_tbl='eods', split_tbl='dividends',
+                 df=None, s_lst=None, source=None):
         self.stk = stk
+        self.eod_tbl = eod_tbl
+        self.split_tbl = split_tbl
+        self.source = this.ts_source if source is None else source
         self.sd = pd.to_datetime(sd)
         self.ed = pd.to_datetime(ed)
-        q = "select * from {0:s} where stk='{1:s}' and dt "\
-            "between '{2:s}' and '{3:s}' order by dt".format(
-            eod_tbl, stk, sd, ed)
-        df = pd.read_sql(q, stxdb.db_get_cnx(), index_col='dt',
-                         parse_dates=['dt'])
+        sd_str, ed_str = str(self.sd.date()), str(self.ed.date())
+        if df is None and self.source == 'store' and \
+                stxstore.is_current(eod_tbl, ed_str):
+            df = stxstore.read_frame(stk, eod_tbl, sd_str, ed_str)
+        if df is None:
+            df = ts_cache_get(stk, eod_tbl, sd_str, ed_str)
+        if df is None:
+            q = "select * from {0:s} where stk='{1:s}' and dt "\
+                "between '{2:s}' and '{3:s}' order by dt".format(
+                eod_tbl, stk, sd, ed)
+            df = stxdb.db_read_frame(q, engine='pandas', index_col='dt')
+            ts_cache_put(stk, eod_tbl, df, sd_str, ed_str)
         if self.sd < df.index[0]:
             self.sd = df.index[0]
         if self.ed > df.index[-1]:
@@ -24,11 +190,14 @@ class StxTS:
         self.sd_str = str(self.sd.date())
         self.ed_str = str(self.ed.date())
         self.gaps = self.get_gaps(df)
-        df.drop(['stk', 'prev_dt', 'prev_date', 'gap'], axis=1, 
-                inplace=True)
-        s_lst = stxdb.db_read_cmd("select dt, ratio, divi_type from "
-                                  "{0:s} where stk='{1:s}'".
-                                  format(split_tbl, stk))
+        df.drop(['stk'], axis=1, inplace=True)
+        if s_lst is None:
+            s_lst = ts_cache_get(stk, split_tbl)
+        if s_lst is None:
+            s_lst = stxdb.db_read_cmd("select dt, ratio, divi_type from "
+                                      "{0:s} where stk='{1:s}'".
+                                      format(split_tbl, stk))
+            ts_cache_put(stk, split_tbl, s_lst)
         # print('stk = {0:s}, s_lst = {1:s}'.format(stk, str(s_lst)))
         self.splits = {pd.to_datetime(stxcal.next_busday(s[0])):
                        [float(s[1]), int(s[2])] for s in s_lst}
@@ -41,34 +210,228 @@ class StxTS:
         self.start = self.num_gaps[0][0]
         self.end = self.num_gaps[0][1]
         self.adj_splits = []
+        self.init_arrays()
+
+    # Struct-of-arrays copy of the unadjusted prices and volumes, and of
+    # the splits that fall inside the time series (sorted by position).
+    # The split adjustments are never applied in place: the adjusted
+    # columns are computed from the raw arrays with one vectorized
+    # multiply by a cumulative split factor vector (see split_factors).
+    # The raw arrays are views of buffers with spare capacity, so that
+    # extend_to can append new days without reallocating them.
+    def init_arrays(self):
+        self.raw_bufs = {}
+        self.raw = {}
+        for c in StxTS.adj_cols:
+            if c in self.df.columns:
+                self.raw_bufs[c] = np.empty(self.l + max(self.l // 4, 64),
+                                            self.df[c].values.dtype)
+                self.raw_bufs[c][: self.l] = self.df[c].values
+                self.raw[c] = self.raw_bufs[c][: self.l]
+        self.split_ixs = np.zeros(0, dtype=np.int64)
+        self.split_ratios = np.zeros(0)
+        self.split_vols = np.zeros(0, dtype=bool)
+        self.split_dts = []
+        self.add_splits(self.sd, self.ed)
+        self.adj_range = (0, 0)
+
+    # Add the splits between sd and ed (inclusive) to the split arrays
+    def add_splits(self, sd, ed):
+        split_list = sorted([(self.find(str(k.date())), v[0],
+                              v[1] in StxTS.vol_divi_types, k)
+                             for k, v in self.splits.items()
+                             if sd <= k <= ed])
+        self.split_ixs = np.append(self.split_ixs, np.array(
+            [x[0] for x in split_list], dtype=np.int64))
+        self.split_ratios = np.append(self.split_ratios,
+                                      [x[1] for x in split_list])
+        self.split_vols = np.append(self.split_vols, np.array(
+            [x[2] for x in split_list], dtype=bool))
+        self.split_dts.extend([x[3] for x in split_list])
+
+    # Roll the time series forward to new_ed: only the days after the
+    # current end date are read from the database, and the gap and
+    # split bookkeeping is only updated for them.  Returns the number
+    # of days added.
+    def extend_to(self, new_ed):
+        new_ed = pd.to_datetime(new_ed)
+        if new_ed <= self.ed:
+            return 0
+        tail_df = None
+        if self.source == 'store' and \
+                stxstore.is_current(self.eod_tbl, new_ed.date()):
+            tail_df = stxstore.read_frame(
+                self.stk, self.eod_tbl,
+                str((self.ed + pd.Timedelta(days=1)).date()),
+                str(new_ed.date()))
+        if tail_df is None:
+            q = "select * from {0:s} where stk='{1:s}' and dt > '{2:s}' "\
+                "and dt <= '{3:s}' order by dt".format(
+                    self.eod_tbl, self.stk, self.ed_str, str(new_ed.date()))
+            tail_df = stxdb.db_read_frame(q, engine='pandas',
+                                          index_col='dt')
+        if tail_df.empty:
+            return 0
+        old_ed = self.ed
+        self.ed = tail_df.index[-1]
+        self.ed_str = str(self.ed.date())
+        # a gap can start at the old end date, or inside the new days
+        _, gap_sds, gap_eds, _ = StxTS.find_gaps(
+            None, np.concatenate([[old_ed.to_datetime64()],
+                                  tail_df.index.values]))
+        gap_sds = [pd.Timestamp(x) for x in gap_sds]
+        gap_eds = [pd.Timestamp(x) for x in gap_eds]
+        self.gaps[-1:] = list(zip([self.gaps[-1][0]] + gap_eds,
+                                  gap_sds + [self.ed]))
+        tail_df.drop(['stk'], axis=1, inplace=True)
+        tail_df = self.fill_gaps(tail_df, stxcal.next_busday(old_ed.date()),
+                                 self.ed, self.raw['c'][-1])
+        num_days = len(tail_df)
+        new_l = self.l + num_days
+        for c, buf in self.raw_bufs.items():
+            if new_l > len(buf):
+                buf = np.resize(buf, max(2 * len(buf), new_l))
+                self.raw_bufs[c] = buf
+            buf[self.l: new_l] = tail_df[c].values
+            self.raw[c] = buf[: new_l]
+        self.df = pd.concat([self.df, tail_df])
+        self.l = new_l
+        self.num_gaps = [tuple([self.find(str(x[0].date())),
+                                self.find(str(x[1].date()))])
+                         for x in self.gaps]
+        self.end = [g[1] for g in self.num_gaps if g[0] == self.start][0]
+        s_lst = stxdb.db_read_cmd("select dt, ratio, divi_type from "
+                                  "{0:s} where stk='{1:s}' and dt >= '{2:s}'".
+                                  format(self.split_tbl, self.stk,
+                                         str(old_ed.date())))
+        for s in s_lst:
+            self.splits[pd.to_datetime(stxcal.next_busday(s[0]))] = \
+                [float(s[1]), int(s[2])]
+        self.add_splits(old_ed + pd.Timedelta(days=1), self.ed)
+        return num_days
+
+    # Load the time series for a list of tickers with two queries, one
+    # for the prices and one for the splits (tickers found in the cache,
+    # or in the store if the source is 'store', are not queried).  sd is
+    # either a date, or a dictionary with the start date for each
+    # ticker.  Returns a dictionary of StxTS objects; tickers without
+    # data are skipped.
+    @staticmethod
+    def bulk_load(stks, sd, ed, eod_tbl='eods', split_tbl='dividends',
+                  source=None):
+        source = this.ts_source if source is None else source
+        stks = list(dict.fromkeys(stks))
+        sds = sd if isinstance(sd, dict) else {stk: sd for stk in stks}
+        sds = {stk: str(pd.to_datetime(sds[stk]).date()) for stk in stks}
+        ed = str(pd.to_datetime(ed).date())
+        eod_dfs, split_dict = {}, {}
+        use_store = source == 'store' and stxstore.is_current(eod_tbl, ed)
+        for stk in stks:
+            df = None
+            if use_store:
+                df = stxstore.read_frame(stk, eod_tbl, sds[stk], ed)
+            if df is None:
+                df = ts_cache_get(stk, eod_tbl, sds[stk], ed)
+            if df is not None:
+                eod_dfs[stk] = df
+            s_lst = ts_cache_get(stk, split_tbl)
+            if s_lst is not None:
+                split_dict[stk] = s_lst
+        db_stks = [stk for stk in stks if stk not in eod_dfs]
+        if db_stks:
+            q = sql.Composed([
+                sql.SQL('SELECT * FROM '), sql.Identifier(eod_tbl),
+                sql.SQL(' WHERE stk IN ('),
+                sql.SQL(', ').join([sql.Literal(x) for x in db_stks]),
+                sql.SQL(') AND dt BETWEEN '),
+                sql.Literal(min(sds[x] for x in db_stks)),
+                sql.SQL(' AND '), sql.Literal(ed), sql.SQL(' ORDER BY stk, dt')
+            ])
+            eod_df = stxdb.db_read_frame(q, engine='pandas', index_col='dt')
+            for stk, df in eod_df.groupby('stk', sort=False):
+                df = df.loc[pd.to_datetime(sds[stk]):]
+                ts_cache_put(stk, eod_tbl, df, sds[stk], ed)
+                eod_dfs[stk] = df.copy()
+        split_stks = [stk for stk in stks if stk not in split_dict]
+        if split_stks:
+            q = sql.Composed([
+                sql.SQL('SELECT stk, dt, ratio, divi_type FROM '),
+                sql.Identifier(split_tbl), sql.SQL(' WHERE stk IN ('),
+                sql.SQL(', ').join([sql.Literal(x) for x in split_stks]),
+                sql.SQL(')')
+            ])
+            for stk in split_stks:
+                split_dict[stk] = []
+            for s in stxdb.db_read_cmd(q.as_string(stxdb.db_get_cnx())):
+                split_dict[s[0]].append(s[1:])
+            for stk in split_stks:
+                ts_cache_put(stk, split_tbl, split_dict[stk])
+        ts_dict = {}
+        for stk in stks:
+            df = eod_dfs.get(stk)
+            if df is None or df.empty:
+                continue
+            ts_dict[stk] = StxTS(stk, sds[stk], ed, eod_tbl, split_tbl,
+                                 df=df, s_lst=split_dict[stk], source=source)
+        return ts_dict
 
     def get_gaps(self, df):
-        df['prev_dt'] = df.index.shift(-1, freq=StxTS.busday_us)
-        df['prev_date'] = df.index
-        df['prev_date'] = df['prev_date'].shift(1)
-        s1 = pd.Series(df['prev_date'])
-        s1[0] = pd.to_datetime(stxcal.prev_busday(df.index[0].date()))
-
-        def gapfun(x):
-            return stxcal.num_busdays(x['prev_date'].date(),
-                                      x['prev_dt'].date())
-        df['gap'] = df.apply(gapfun, axis=1)
-        glist = df.loc[df['gap'] > 20].index.tolist()
-        gaps = []
-        if len(glist) == 0:
-            gaps.append(tuple([self.sd, self.ed]))
-        else:
-            gaps.append(tuple([self.sd, df.loc[glist[0]]['prev_date']]))
-            for i in range(1, len(glist)):
-                gaps.append(
-                    tuple([glist[i - 1], df.loc[glist[i]]['prev_date']]))
-            gaps.append(tuple([glist[-1], self.ed]))
-        return gaps
-
-    def fill_gaps(self, df):
-        idx = pd.date_range(self.sd, self.ed, freq=StxTS.busday_us)
+        _, gap_sds, gap_eds, _ = StxTS.find_gaps(None, df.index.values)
+        gap_sds = [pd.Timestamp(x) for x in gap_sds]
+        gap_eds = [pd.Timestamp(x) for x in gap_eds]
+        return list(zip([self.sd] + gap_eds, gap_sds + [self.ed]))
+
+    # Find the date ranges where data is missing for more than max_gap
+    # business days.  The dates (and the tickers, if there are more than
+    # one) are sorted by ticker and date.  For each gap, return the
+    # ticker, the last date before the gap, the first date after the gap,
+    # and the number of missing business days.
+    @staticmethod
+    def find_gaps(stks, dts, max_gap=20):
+        dts = np.asarray(dts, dtype='datetime64[D]')
+        missing = np.diff(stxcal.busday_ordinal(dts)) - 1
+        gap = missing > max_gap
+        if stks is not None:
+            stks = np.asarray(stks)
+            gap &= stks[1:] == stks[:-1]
+        ixs = np.nonzero(gap)[0]
+        return (None if stks is None else stks[ixs], dts[ixs], dts[ixs + 1],
+                missing[ixs])
+
+    # Universe-wide gap audit: every range where the data for a ticker in
+    # tbl_name is missing for more than max_gap business days.  The rows
+    # are streamed in batches of batch_size; the last row of a batch is
+    # prepended to the next one, to find the gaps across batches.
+    @staticmethod
+    def gap_audit(tbl_name='eods', max_gap=20, batch_size=100000):
+        q = sql.Composed([
+            sql.SQL('SELECT stk, dt FROM '), sql.Identifier(tbl_name),
+            sql.SQL(' ORDER BY stk, dt')
+        ])
+        gaps, last = [], None
+        for batch in stxdb.db_stream_cmd(q, batch_size, fmt='numpy'):
+            stks = np.asarray(batch['stk'], dtype=object)
+            dts = np.asarray(batch['dt'], dtype='datetime64[D]')
+            if last is not None:
+                stks = np.concatenate([last[0], stks])
+                dts = np.concatenate([last[1], dts])
+            gaps.append(StxTS.find_gaps(stks, dts, max_gap))
+            last = (stks[-1:], dts[-1:])
+        cols = ['stk', 'last_dt', 'next_dt', 'missing_days']
+        if not gaps:
+            return pd.DataFrame(columns=cols)
+        return pd.DataFrame({col: np.concatenate([x[ixx] for x in gaps])
+                             for ixx, col in enumerate(cols)})
+
+    # prev_c is the close before sd, used if the data starts after sd
+    def fill_gaps(self, df, sd=None, ed=None, prev_c=None):
+        idx = pd.date_range(self.sd if sd is None else sd,
+                            self.ed if ed is None else ed,
+                            freq=StxTS.busday_us)
         df = df.reindex(idx)
         df['c'] = df['c'].ffill()
+        if prev_c is not None:
+            df['c'] = df['c'].fillna(prev_c)
         df['v'] = df['v'].fillna(0)
         df.loc[df['o'].isnull(), 'o'] = df['c']
         df.loc[df['hi'].isnull(), 'hi'] = df['c']
@@ -111,53 +474,53 @@ class StxTS:
         self.adjust_data(new_pos)
         return new_pos
 
+    # The adjusted data as of position new_pos reflects the splits
+    # between the start of the date range that contains new_pos and
+    # new_pos.  Only the indices of the first and last applied split are
+    # tracked, and the data frame columns are recalculated only if they
+    # change.
     def adjust_data(self, new_pos):
-        # A new date can:
-        # (1) move into a new date range, or (2) stay in the old one
         if self.pos == new_pos:
             return new_pos
-        new_s, new_e = [g for g in self.num_gaps if g[0] <= new_pos <= g[1]][0]
-        # in (1): undo all split adjustments in the old date range,
-        # adjust for splits in the new date range, & reset self.start/self.end
-        if new_s != self.start or new_e != self.end:
-            sdd = self.df.index[self.start]
-            for adj_dt in self.adj_splits:
-                split_ratio, split_divi = self.splits.get(adj_dt)
-                self.adjust(sdd, stxcal.prev_busday(adj_dt), 1 / split_ratio,
-                            ['o', 'hi', 'lo', 'c'])
-                if split_divi in [0, 1, 3, 6]:
-                    self.adjust(sdd, stxcal.prev_busday(adj_dt), split_ratio,
-                                ['volume'])
-            del self.adj_splits[:]
-            self.start = new_s
-            self.end = new_e
-            self.adjust_splits_date_range(self.start, new_pos)
-        # in (2), if moving:
-        # forward, adjust for splits between the old and the new position,
-        # backward, undo split adjustments between the old and the new position
-        else:
-            if new_pos > self.pos:
-                self.adjust_splits_date_range(self.pos, new_pos)
-            else:
-                self.adjust_splits_date_range(new_pos, self.pos, 1)
+        self.start, self.end = [g for g in self.num_gaps
+                                if g[0] <= new_pos <= g[1]][0]
         self.pos = new_pos
+        lo = int(np.searchsorted(self.split_ixs, self.start, side='right'))
+        hi = int(np.searchsorted(self.split_ixs, new_pos, side='right'))
+        adj_range = (lo, hi) if lo < hi else (0, 0)
+        if adj_range != self.adj_range:
+            self.adj_range = adj_range
+            self.adj_splits = self.split_dts[adj_range[0]: adj_range[1]]
+            self.apply_split_factors()
+        return new_pos
 
-    def adjust_splits_date_range(self, s_ix, e_ix, inv=0):
-        bdd = self.df.index[self.start]
-        sdd = self.df.index[s_ix]
-        edd = self.df.index[e_ix]
-        splts = {k: v for k, v in self.splits.items() if sdd < k <= edd}
-        for k, v in splts.items():
-            r = v[0] if inv == 0 else 1 / v[0]
-            self.adjust(bdd, stxcal.prev_busday(str(k.date())),
-                        r, ['o', 'hi', 'lo', 'c'])
-            if v[1] in [0, 1, 3, 6]:
-                self.adjust(bdd, stxcal.prev_busday(str(k.date())), 1 / r, ['v'])
-            self.adj_splits.append(k)
-
-    def adjust(self, s_idx, e_idx, ratio, col_names):
-        for c_name in col_names:
-            self.df.loc[s_idx:e_idx, c_name] = self.df[c_name] * ratio
+    # Cumulative split factors for prices and volumes: a split at
+    # position ix, applied with ratio r, multiplies the prices between
+    # self.start and ix - 1 by r, and the volumes by 1 / r
+    def split_factors(self):
+        lo, hi = self.adj_range
+        px_f = np.ones(self.l)
+        v_f = np.ones(self.l)
+        ixs = self.split_ixs[lo: hi] - 1
+        np.multiply.at(px_f, ixs, self.split_ratios[lo: hi])
+        vol = self.split_vols[lo: hi]
+        np.multiply.at(v_f, ixs[vol], 1 / self.split_ratios[lo: hi][vol])
+        px_f = np.cumprod(px_f[::-1])[::-1]
+        v_f = np.cumprod(v_f[::-1])[::-1]
+        px_f[: self.start] = 1
+        v_f[: self.start] = 1
+        return px_f, v_f
+
+    def apply_split_factors(self):
+        lo, hi = self.adj_range
+        px_f, v_f = self.split_factors() if lo < hi else (None, None)
+        for col, raw in self.raw.items():
+            if col not in self.df.columns:
+                continue
+            if px_f is None:
+                self.df[col] = raw.copy()
+            else:
+                self.df[col] = raw * (v_f if col == 'v' else px_f)
 
     def mergetbl(self, tbl_name, col_list, addl_cond=None):
         q = "select date,%s from %s where stk='%s' and date between '%s' and '%s'"
@@ -234,10 +597,8 @@ class StxTS:
     def gen_tdf(sd, ed):
         tdf = pd.DataFrame(data={'date': pd.date_range(sd, ed,
                                                        freq=StxTS.busday_us)})
-
-        def funexp(x):
-            return stxcal.prev_expiry(np.datetime64(x['date'].date()))
-        tdf['exp'] = tdf.apply(funexp, axis=1)
+        tdf['exp'] = stxcal.prev_expiry_arr(
+            tdf['date'].values.astype('datetime64[D]'))
         return tdf
 
     def get(self, dt, field=None):
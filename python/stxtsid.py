@@ -2,14 +2,15 @@ import pandas as pd
 from psycopg2 import sql
 import stxcal
 import stxdb
+import stxstore
 from stxplot import StxPlot
 from stxplotid import StxPlotID
 from stxts import StxTS
 
 class StxTSID(StxTS):
     def __init__(self, stk, sd, ed, et, id_tbl='intraday', eod_tbl='eods',
-                 split_tbl='dividends'):
-        super().__init__(stk, sd, ed, eod_tbl, split_tbl)
+                 split_tbl='dividends', source=None):
+        super().__init__(stk, sd, ed, eod_tbl, split_tbl, source=source)
         self.id_sd = stxcal.move_busdays(ed, -10)
         self.id_sdt = f'{self.id_sd} 09:35'
         self.id_edt = f'{ed} {et}'
@@ -18,6 +19,12 @@ class StxTSID(StxTS):
         self.idf = self.load_intraday()
 
     def load_intraday(self):
+        if self.source == 'store' and \
+                stxstore.is_current(self.id_tbl, self.id_edt):
+            idf = stxstore.read_frame(self.stk, self.id_tbl, self.id_sdt,
+                                      self.id_edt)
+            if idf is not None:
+                return idf
         q = sql.Composed([
             sql.SQL("SELECT * FROM "),
             sql.Identifier(self.id_tbl),
@@ -29,8 +36,7 @@ class StxTSID(StxTS):
             sql.Literal(self.id_edt),
             sql.SQL(" ORDER BY dt")
         ])
-        idf = pd.read_sql(q, stxdb.db_get_cnx(), index_col='dt',
-                          parse_dates=['dt'])
+        idf = stxdb.db_read_frame(q, engine='pandas', index_col='dt')
         return idf
 
     def mpf_id(self, crt_date):
@@ -10,6 +10,7 @@ import polars as pl
 from psycopg2 import sql
 import stxcal
 import stxdb
+import stxdbasync
 from stxindicators import indicator_filter, watchlist_analysis
 import traceback as tb
 from typing import Any
@@ -26,6 +27,7 @@ from stxplotbin import StxPlotBin
 matplotlib.use('Agg')
 from stxplot import StxPlot
 from stxplotid import StxPlotID
+from stxts import StxTS, ts_cache_info
 
 ixxx = 0
 refresh = 1 # refrsh time in minutes. for realtime, it is 5 minutes
@@ -48,6 +50,65 @@ _lib = ctypes.CDLL(_lib_name)
 
 watchlist = None
 
+stxdb.db_enable_profiling(
+    slow_query_ms=float(os.getenv('STX_DB_SLOW_MS', '500')))
+
+# queries fired on every market page refresh run as prepared statements
+stxdb.db_register_prepared(
+    'ws_current_price',
+    'SELECT c FROM intraday WHERE stk=$1 AND dt=$2',
+    ['varchar', 'timestamp'])
+stxdb.db_register_prepared(
+    'ws_stop_loss_target',
+    'SELECT * FROM stx_risk WHERE mkt=$1 AND stk=$2 AND DATE(dt)=$3 '
+    'AND dt<$4 AND direction=$5 ORDER BY dt DESC LIMIT 1',
+    ['varchar', 'varchar', 'date', 'timestamp', 'smallint'])
+stxdb.db_register_prepared(
+    'ws_watchlist',
+    'SELECT stk FROM market_watch WHERE mkt=$1 ORDER BY stk',
+    ['varchar'])
+stxdb.db_register_prepared(
+    'ws_sr',
+    'SELECT * FROM stx_sr WHERE mkt=$1 AND stk=$2 ORDER BY px1',
+    ['varchar', 'varchar'])
+
+
+@app.teardown_appcontext
+def release_db_cnx(exc):
+    # give the request thread's DB connection back to the pool
+    stxdb.db_release_cnx()
+
+
+@app.route('/db_stats')
+def db_stats():
+    stats = stxdb.db_query_stats()
+    pool_stats = stxdb.db_pool_stats()
+    if request.args.get('reset'):
+        stxdb.db_reset_query_stats()
+        stxdb.db_pool_reset_stats()
+    return {'queries': stats, 'pool': pool_stats,
+            'ts_cache': ts_cache_info()}
+
+
+# Latency of the prepared web queries vs. the same queries sent as text:
+# /db_benchmark?mkt=...&stk=...&dt=YYYY-mm-dd HH:MM:SS
+@app.route('/db_benchmark')
+def db_benchmark():
+    mkt = request.args.get('mkt')
+    stk = request.args.get('stk', 'SPY')
+    mkt_dt = request.args.get('dt')
+    mkt_date = mkt_dt.split(' ')[0]
+    num_runs = int(request.args.get('runs', 200))
+    return {'results': [
+        stxdb.db_benchmark_prepared('ws_current_price', (stk, mkt_dt),
+                                    num_runs),
+        stxdb.db_benchmark_prepared(
+            'ws_stop_loss_target', (mkt, stk, mkt_date, mkt_dt, 1),
+            num_runs),
+        stxdb.db_benchmark_prepared('ws_watchlist', (mkt,), num_runs),
+        stxdb.db_benchmark_prepared('ws_sr', (mkt, stk), num_runs)
+    ]}
+
 
 @app.route('/')
 @app.route('/indexes')
@@ -56,8 +117,11 @@ def index():
     date_dict = {}
     end_date, _ = stxcal.current_intraday_busdatetime()
     start_date = stxcal.move_busdays(end_date, -90)
-    for stxindex in ['^GSPC', '^IXIC', '^DJI']:
-        sp = StxPlot(None, stxindex, start_date, end_date, stk=stxindex)
+    indexes = ['^GSPC', '^IXIC', '^DJI']
+    ts_dict = StxTS.bulk_load(indexes, start_date, end_date)
+    for stxindex in indexes:
+        sp = StxPlot(StxPlot.prepare_ts(ts_dict[stxindex], end_date),
+                     stxindex, start_date, end_date, stk=stxindex)
         date_dict[stxindex] = str(sp.ts.df.index[sp.ts.l - 1].date())
         chartdict = { 'figdata_png': sp.b64_png() }
         charts.append(chartdict)
@@ -143,33 +207,14 @@ def analysis():
 
 
 def get_current_price(stk, mkt_dt):
-    sql_cmd = sql.Composed([
-        sql.SQL("SELECT "), sql.Identifier('c'), sql.SQL(" FROM "),
-        sql.Identifier('intraday'), sql.SQL(" WHERE "),
-        sql.Identifier('stk'), sql.SQL('='), sql.Literal(stk),
-        sql.SQL(" AND "),
-        sql.Identifier('dt'), sql.SQL("="), sql.Literal(mkt_dt)
-    ])
-    logging.debug(sql_cmd.as_string(stxdb.db_get_cnx()))
-    c_res = stxdb.db_read_cmd(sql_cmd.as_string(stxdb.db_get_cnx()))
+    c_res = stxdb.db_exec_prepared('ws_current_price', (stk, mkt_dt))
     current_price = c_res[0][0]
     return current_price
 
 
 def get_stop_loss_target(mkt: str, stk: str, risk_dt: str, risk_date: str, direction: int) -> tuple:
-    sql_cmd = sql.Composed([
-        sql.SQL("SELECT * FROM "), sql.Identifier('stx_risk'),
-        sql.SQL(" WHERE "),
-        sql.Identifier('mkt'), sql.SQL("="), sql.Literal(mkt), sql.SQL(" AND "),
-        sql.Identifier('stk'), sql.SQL("="), sql.Literal(stk),
-        sql.SQL(" AND DATE("), sql.Identifier('dt'), sql.SQL(")="),
-        sql.Literal(risk_date), sql.SQL(" AND "), sql.Identifier('dt'),
-        sql.SQL("<"), sql.Literal(risk_dt), sql.SQL( "AND "),
-        sql.Identifier('direction'), sql.SQL("="), sql.Literal(direction),
-        sql.SQL(" ORDER BY "), sql.Identifier('dt'),
-        sql.SQL(" DESC LIMIT 1")
-    ])
-    risk_res = stxdb.db_read_cmd(sql_cmd.as_string(stxdb.db_get_cnx()))
+    risk_res = stxdb.db_exec_prepared(
+        'ws_stop_loss_target', (mkt, stk, risk_date, risk_dt, direction))
     if len(risk_res) == 0:
         return 0, 0, risk_dt
     sl_datetime = risk_res[0][2]
@@ -191,7 +236,7 @@ def get_trades(mkt_name: str, dt: str, stk_filter: str) -> pl.DataFrame:
         sql_list.append(sql.Literal(stk_filter))
     sql_list.append(sql.SQL(" ORDER BY dt"))
     q_trades = sql.Composed(sql_list)
-    df_trades = pl.read_database(q_trades, stxdb.db_get_cnx())
+    df_trades = stxdb.db_read_frame(q_trades)
     return df_trades
 
 
@@ -324,13 +369,7 @@ def get_portfolio(mkt_name: str, stx: str, mkt_dt: str) -> list:
 
 
 def get_watchlist(mkt_name):
-    q = sql.Composed([
-        sql.SQL("SELECT "), sql.Identifier("stk"), sql.SQL(" FROM "),
-        sql.Identifier("market_watch"), sql.SQL(" WHERE "),
-        sql.Identifier("mkt"), sql.SQL("="), sql.Literal(mkt_name),
-        sql.SQL(" ORDER BY "), sql.Identifier("stk")
-    ])
-    res_db = stxdb.db_read_cmd(q.as_string(stxdb.db_get_cnx()))
+    res_db = stxdb.db_exec_prepared('ws_watchlist', (mkt_name,))
     watchlist = [x[0] for x in res_db]
     logging.info(f"The watchlist for market {mkt_name} is {watchlist}")
     return watchlist
@@ -401,7 +440,11 @@ def get_market(mkt_name, mkt_date, mkt_dt, mkt_cache, mkt_realtime):
         mkt_date = mkt_date.strftime("%Y-%m-%d")
     eod_market = mkt_dt.endswith('16:00:00')
     mktdt = mkt_dt.replace('16:00:00', '15:55:00')
-    portfolio = get_portfolio(mkt_name, '*', mktdt)
+    # portfolio and watchlist queries are independent, run them together
+    portfolio, watchlist = stxdbasync.run_all(
+        stxdbasync.run_db(get_portfolio, mkt_name, '*', mktdt),
+        stxdbasync.run_db(get_watchlist_sorted, mkt_name, mkt_date,
+                          eod_market))
     # pf_list contains stock, in_price, stop_loss and target
     pf_list = [[x[0], x[3], x[7], x[6]] for x in portfolio]
     pf_charts = generate_charts(mkt_name, pf_list, mktdt, 0, 2, '5min') \
@@ -414,7 +457,6 @@ def get_market(mkt_name, mkt_date, mkt_dt, mkt_cache, mkt_realtime):
     idx_charts = generate_charts(mkt_name, idx_list, mktdt, 90, id_days1,
                                  freq1, id_days2, freq2)
     # watchlist = get_watchlist(mkt_name)
-    watchlist = get_watchlist_sorted(mkt_name, mkt_date, eod_market)
     wl_charts = generate_charts(mkt_name, watchlist, mktdt, 90, id_days1,
                                 freq1, id_days2, freq2) if watchlist else []        
     indicator_charts = {}
@@ -653,6 +695,10 @@ def generate_charts(mkt_name, stk_list, end_dt, eod_days, id_days, frequency,
                     id_days1=None, frequency1=None):
     charts = []
     freq = int(frequency[:-3])
+    # fetch the support/resistance lines for all the stocks concurrently
+    sr_stks = [x for x in stk_list if type(x).__name__ != 'list']
+    sr_dict = dict(zip(sr_stks, stxdbasync.map_db(
+        lambda x: get_sr(x, mkt_name), sr_stks)))
     for stk in stk_list:
         if type(stk).__name__ == 'list':
             hlines = stk[1:]
@@ -661,7 +707,7 @@ def generate_charts(mkt_name, stk_list, end_dt, eod_days, id_days, frequency,
         else:
             hlines = []
             alines = []
-            sr_lines = get_sr(stk, mkt_name)
+            sr_lines = sr_dict[stk]
             for dt1, x1, dt2, x2 in sr_lines:
                 if x1 == x2:
                     hlines.append(x1)
@@ -1228,20 +1274,7 @@ def get_jl_html(stk, dt):
 
 def get_sr(stk, mkt):
     # get existing support/resistance from DB
-    q = sql.Composed([
-        sql.SQL("SELECT * FROM "), sql.Identifier("stx_sr"),
-        sql.SQL(" WHERE "),
-        sql.Identifier("mkt"),
-        sql.SQL("="),
-        sql.Literal(mkt),
-        sql.SQL("AND"),
-        sql.Identifier("stk"),
-        sql.SQL("="),
-        sql.Literal(stk),
-        sql.SQL("ORDER BY"),
-        sql.Identifier('px1')
-    ])
-    res_db = stxdb.db_read_cmd(q.as_string(stxdb.db_get_cnx()))
+    res_db = stxdb.db_exec_prepared('ws_sr', (mkt, stk))
     logging.info(f"res_db = {res_db}")
     sr_levels = [(x[2], x[3], x[4], x[5]) for x in res_db]
     return sr_levels
@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+import stxcal
+from stxjl import StxJL
+from stxts import StxTS
+import unittest
+
+
+# Golden output of the original StxJL (stxjl.py in the first commit of
+# the repository), which adjusted the records for splits as soon as
+# they were reached, on the series and splits built in setUpClass: all
+# the pivots, the number of pivots in the last 1, 20, 300, 5000 days,
+# last_rec values and the last five records, for each end date and
+# factor
+golden_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'test_stxjl_golden.json')
+
+
+class TestStxJLSplits(unittest.TestCase):
+    factors = [1.0, 1.5, 2.0, 3.0]
+    sd, ed = '2010-01-04', '2016-12-30'
+    # four splits on pivot dates, the others on regular days; a split
+    # record is applied on the next business day
+    splits = [('2011-03-11', 0.5, 0), ('2011-03-14', 2.0, 0),
+              ('2013-07-31', 0.25, 0), ('2015-05-13', 3.0, 0),
+              ('2015-12-10', 0.9, 0), ('2016-03-15', 1.5, 0),
+              ('2016-06-07', 0.1, 0), ('2016-07-21', 4.0, 0),
+              ('2016-10-06', 0.5, 0)]
+    piv_split_dts = ['2015-05-14', '2015-12-11']
+
+    @classmethod
+    def setUpClass(cls):
+        days = pd.date_range(cls.sd, cls.ed, freq=pd.offsets.CDay(
+            holidays=stxcal.get_cal().holidays))
+        rng = np.random.default_rng(42)
+        c = np.maximum(500, 5000 + rng.integers(-80, 81, len(days)).
+                       cumsum())
+        hi = c + rng.integers(0, 60, len(days))
+        lo = np.maximum(1, c - rng.integers(0, 60, len(days)))
+        cls.df = pd.DataFrame(
+            {'stk': 'X', 'o': c, 'hi': hi, 'lo': lo, 'c': c,
+             'v': rng.integers(100, 1000, len(days)), 'oi': 0},
+            index=pd.DatetimeIndex(days, name='dt'))
+        cls.days = [str(x.date()) for x in days]
+        with open(golden_file) as f:
+            cls.golden = json.load(f)
+
+    @classmethod
+    def ts(cls, splits):
+        return StxTS('X', cls.sd, cls.ed, df=cls.df.copy(), s_lst=splits)
+
+    def assert_same(self, u, v):
+        if isinstance(u, str) or isinstance(v, str):
+            self.assertEqual(u, v)
+        else:
+            self.assertTrue(np.isclose(u, v, rtol=1e-9, atol=1e-6),
+                            f'{u} != {v}')
+
+    def assert_same_pivots(self, pivs, golden_pivs):
+        self.assertEqual(len(pivs), len(golden_pivs))
+        for piv, (dt, state, price, rg) in zip(pivs, golden_pivs):
+            self.assertEqual((piv.dt, piv.state), (dt, state))
+            self.assert_same(piv.price, price)
+            self.assert_same(piv.rg, rg)
+
+    def compare(self, dt, factors):
+        jl = StxJL(self.ts(self.splits), factors)
+        jl.jl(dt)
+        for f in factors:
+            jlf, golden = jl.view(f), self.golden[f'{dt} {f}']
+            pivs = golden['pivots']
+            self.assertEqual(len(jlf.jl_recs) - 1, golden['num_recs'])
+            for rec, golden_rec in zip(jlf.jl_recs[-5:], golden['recs']):
+                for x, y in zip(rec, golden_rec):
+                    self.assert_same(x, y)
+            for num_pivs in [1, 4, 10, 100]:
+                self.assert_same_pivots(jlf.get_num_pivots(num_pivs),
+                                        pivs[-num_pivs:])
+            for num_days, num_pivs in golden['days'].items():
+                self.assert_same_pivots(
+                    jlf.get_pivots_in_days(int(num_days)),
+                    pivs[len(pivs) - num_pivs:])
+            for col, vals in golden['last'].items():
+                for ixx, val in zip([1, 2, 5], vals):
+                    self.assert_same(jlf.last_rec(col, ixx), val)
+        return jl
+
+    def test_splits_on_pivot_dates(self):
+        jl = self.compare(self.ed, self.factors)
+        self.assertTrue(len(jl.split_fs) >= len(self.splits) - 1)
+
+    def test_end_dates(self):
+        # end on a split date, on the day before and after a split
+        for dt in self.piv_split_dts:
+            for n in [-1, 0, 1]:
+                self.compare(stxcal.move_busdays(dt, n), [1.0])
+
+    def test_resume_after_split(self):
+        # a checkpoint holds split adjusted prices; resuming from it
+        # gives the same pivots as a full calculation
+        dt = self.piv_split_dts[1]
+        jl = StxJL(self.ts(self.splits), 2.0)
+        jl.jl(stxcal.move_busdays(dt, 5))
+        res = StxJL(self.ts(self.splits), 2.0, checkpoint=jl.get_state())
+        res.jl(self.ed)
+        self.assertTrue(res.resumed)
+        self.assert_same_pivots(res.get_num_pivots(8),
+                                self.golden[f'{self.ed} 2.0']['pivots'][-8:])
+
+    def test_more_pivots_than_available(self):
+        # asking for more pivots than there are returns all of them
+        jl = StxJL(self.ts(self.splits), self.factors)
+        jl.jl(self.ed)
+        for f in self.factors:
+            pivs = self.golden[f'{self.ed} {f}']['pivots']
+            for num_pivs in [len(pivs), len(pivs) + 1, 10000]:
+                self.assert_same_pivots(jl.view(f).get_num_pivots(num_pivs),
+                                        pivs)
+
+if __name__ == '__main__':
+    unittest.main()